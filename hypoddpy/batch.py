@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Batch relocation of many projects described by a JSON configuration file.
+
+At most max_concurrent_projects projects are relocated at the same time, each
+in its own process. All projects share the caches in cache_dir:
+
+    * waveform_index.json: Start and end times of all traces of every
+      waveform file. Files are only read again if their size or modification
+      time changed. The waveform information of every project is written
+      from it before every run, so no project parses waveform files itself
+      and every project sees the files added since its last run.
+    * binaries: The hypoDD and ph2dt compilations, see HypoDDCompiler.
+    * station_file_cache.json: The parsed station files, see
+      hypodd_stations.
+    * cc_results/<hash of the cross correlation parameters>: The cross
+      correlation results of all finished projects. They are loaded by every
+      project with the same cross correlation parameters.
+
+Configuration
+=============
+
+    {
+        "max_concurrent_projects": 4,
+        "cache_dir": "batch_cache",
+        "defaults": {
+            "relocator": {"cc_time_before": 0.05, "cc_time_after": 0.2,
+                          "cc_maxlag": 0.1, "cc_filter_min_freq": 1.0,
+                          "cc_filter_max_freq": 20.0,
+                          "cc_p_phase_weighting": {"Z": 1.0},
+                          "cc_s_phase_weighting": {"Z": 1.0},
+                          "cc_min_allowed_cross_corr_coeff": 0.4},
+            "velocity_model": {
+                "model_type": "layered_p_velocity_with_constant_vp_vs_ratio",
+                "layer_tops": [[-10000, 5.8]], "vp_vs_ratio": 1.73},
+            "forced_configuration_values": {"MAXSEP": 5.0},
+            "relocation": {"create_plots": false}
+        },
+        "projects": [
+            {"name": "north",
+             "working_dir": "north",
+             "output_event_file": "north/relocated_events.xml",
+             "event_files": ["data/north/events/*.xml"],
+             "station_files": ["data/stations/*.xml"],
+             "waveform_files": ["data/waveforms/*.mseed"]}
+        ]
+    }
+
+Every project may override the "relocator", "velocity_model",
+"forced_configuration_values" and "relocation" dictionaries of the defaults
+key by key. "method" selects start_relocation (default),
+start_tiled_relocation or start_time_windowed_relocation, "relocation" holds
+its keyword arguments and "external_binaries" optionally the hypodd_binary and
+ph2dt_binary to use. Relative paths are relative to the configuration file and
+file lists may contain glob patterns.
+
+Usage
+=====
+
+    hypoddpy-batch batch.json --max-concurrent-projects 8
+"""
+import argparse
+import copy
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+
+METHODS = ["start_relocation", "start_tiled_relocation",
+           "start_time_windowed_relocation"]
+
+SECTIONS = ["relocator", "velocity_model", "forced_configuration_values",
+            "relocation"]
+
+
+def _absolute_path(path, base_dir):
+    return os.path.abspath(os.path.join(base_dir, os.path.expanduser(path)))
+
+
+def _expand_files(patterns, base_dir):
+    """
+    Expands a list of filenames and glob patterns to a sorted list of
+    absolute filenames.
+    """
+    filenames = set()
+    for pattern in patterns:
+        pattern = _absolute_path(pattern, base_dir)
+        if glob.has_magic(pattern):
+            filenames.update(glob.glob(pattern))
+        else:
+            filenames.add(pattern)
+    return sorted(filenames)
+
+
+def read_config(filename):
+    """
+    Reads the batch configuration file and returns it with the defaults
+    merged into every project, all paths made absolute and all glob patterns
+    expanded.
+    """
+    with open(filename, "r") as open_file:
+        config = json.load(open_file)
+    base_dir = os.path.dirname(os.path.abspath(filename))
+    defaults = config.get("defaults", {})
+    config["max_concurrent_projects"] = int(config.get(
+        "max_concurrent_projects", multiprocessing.cpu_count()))
+    config["cache_dir"] = _absolute_path(
+        config.get("cache_dir", "hypoddpy_batch_cache"), base_dir)
+    projects = []
+    names = set()
+    for project in config["projects"]:
+        project = copy.deepcopy(project)
+        if "name" not in project:
+            raise ValueError("Every project needs a name.")
+        if project["name"] in names:
+            raise ValueError("Project name %s is not unique." %
+                             project["name"])
+        names.add(project["name"])
+        for section in SECTIONS:
+            values = copy.deepcopy(defaults.get(section, {}))
+            values.update(project.get(section, {}))
+            project[section] = values
+        project.setdefault("method", defaults.get("method",
+                                                  "start_relocation"))
+        if project["method"] not in METHODS:
+            raise ValueError("Unknown method %s of project %s." % (
+                project["method"], project["name"]))
+        project["working_dir"] = _absolute_path(
+            project.get("working_dir", project["name"]), base_dir)
+        project["output_event_file"] = _absolute_path(
+            project["output_event_file"], base_dir)
+        for key in ["event_files", "station_files", "waveform_files"]:
+            project[key] = _expand_files(project.get(key, []), base_dir)
+        if "external_binaries" in project:
+            project["external_binaries"] = dict(
+                (key, _absolute_path(value, base_dir))
+                for key, value in project["external_binaries"].items())
+        projects.append(project)
+    config["projects"] = projects
+    return config
+
+
+def _index_waveform_file(filename):
+    """
+    Returns the start and end times of all traces in a waveform file as a
+    list of [id, starttime, endtime] lists or None if the file cannot be
+    read. Module level function so it can be used with a multiprocessing
+    pool.
+    """
+    from obspy.core import read
+
+    try:
+        st = read(filename, headonly=True)
+    except Exception:
+        return filename, None
+    return filename, [[tr.id, str(tr.stats.starttime), str(tr.stats.endtime)]
+                      for tr in st]
+
+
+def update_waveform_index(index_file, filenames, processes=None,
+                          log_function=None):
+    """
+    Updates the waveform index for all filenames. Only new files and files
+    whose size or modification time changed are read.
+
+    Returns the index as a dictionary mapping the filenames to dictionaries
+    with the "size", "mtime" and "traces" of the file.
+    """
+    index = {}
+    if os.path.exists(index_file):
+        with open(index_file, "r") as open_file:
+            index = json.load(open_file)
+    outdated = {}
+    for filename in set(filenames):
+        if not os.path.exists(filename):
+            continue
+        stat = os.stat(filename)
+        entry = index.get(filename)
+        if entry is None or entry["size"] != stat.st_size or \
+                entry["mtime"] != stat.st_mtime:
+            outdated[filename] = {"size": stat.st_size,
+                                  "mtime": stat.st_mtime}
+    if log_function:
+        log_function("Waveform index: %i of %i files need to be read." % (
+            len(outdated), len(set(filenames))))
+    if outdated:
+        pool = multiprocessing.Pool(processes=processes)
+        try:
+            for filename, traces in pool.imap_unordered(
+                    _index_waveform_file, sorted(outdated), chunksize=16):
+                outdated[filename]["traces"] = traces
+        finally:
+            pool.close()
+            pool.join()
+        index.update(outdated)
+        temp_file = index_file + ".tmp"
+        with open(temp_file, "w") as open_file:
+            json.dump(index, open_file)
+        os.rename(temp_file, index_file)
+    return index
+
+
+def write_waveform_information(index, filenames, working_dir):
+    """
+    Writes working_dir/working_files/waveform_information.json of a project
+    from the waveform index so the relocator does not parse the waveform
+    files again. An existing file is only rewritten if its content differs,
+    e.g. because files were added to or changed in the index.
+
+    Returns True if the file was written.
+    """
+    working_files = os.path.join(working_dir, "working_files")
+    filename = os.path.join(working_files, "waveform_information.json")
+    waveform_information = {}
+    for waveform_file in filenames:
+        traces = index.get(waveform_file, {}).get("traces")
+        if not traces:
+            continue
+        for trace_id, starttime, endtime in traces:
+            waveform_information.setdefault(trace_id, []).append(
+                {"starttime": starttime, "endtime": endtime,
+                 "filename": waveform_file})
+    if os.path.exists(filename):
+        try:
+            with open(filename, "r") as open_file:
+                if json.load(open_file) == waveform_information:
+                    return False
+        except ValueError:
+            pass
+    if not os.path.exists(working_files):
+        os.makedirs(working_files)
+    temp_file = filename + ".tmp"
+    with open(temp_file, "w") as open_file:
+        json.dump(waveform_information, open_file)
+    os.rename(temp_file, filename)
+    return True
+
+
+def _cc_cache_dir(cache_dir, cc_param):
+    """
+    Directory of the cross correlation results of all projects with the same
+    cross correlation parameters.
+    """
+    key = hashlib.md5(json.dumps(cc_param, sort_keys=True).encode(
+        "utf-8")).hexdigest()
+    return os.path.join(cache_dir, "cc_results", key)
+
+
+def _run_project(project, cache_dir):
+    """
+    Relocates a single project. Runs in its own process.
+    """
+    from hypoddpy.hypodd_relocator import HypoDDRelocator
+
+    relocator = HypoDDRelocator(working_dir=project["working_dir"],
+                                **project["relocator"])
+    relocator.add_event_files(project["event_files"])
+    relocator.add_station_files(project["station_files"])
+    relocator.add_waveform_files(project["waveform_files"])
+    relocator.setup_velocity_model(**project["velocity_model"])
+    for key, value in project["forced_configuration_values"].items():
+        relocator.set_forced_configuration_value(key, value)
+    if "external_binaries" in project:
+        relocator.set_external_binaries(**project["external_binaries"])
+    relocator.set_binary_cache(os.path.join(cache_dir, "binaries"))
+    relocator.station_cache_file = os.path.join(cache_dir,
+                                                "station_file_cache.json")
+
+    cc_dir = _cc_cache_dir(cache_dir, relocator.cc_param)
+    for filename in sorted(glob.glob(os.path.join(cc_dir, "*.json"))):
+        relocator.load_cross_correlation_results(filename)
+    cc_file = os.path.join(project["working_dir"], "cc_results.json")
+    kwargs = dict(project["relocation"])
+    kwargs.setdefault("output_cross_correlation_file", cc_file)
+    getattr(relocator, project["method"])(
+        output_event_file=project["output_event_file"], **kwargs)
+
+    # Publish the cross correlation results for the following projects.
+    cc_file = kwargs["output_cross_correlation_file"]
+    if cc_file and os.path.exists(cc_file):
+        if not os.path.exists(cc_dir):
+            try:
+                os.makedirs(cc_dir)
+            except OSError:
+                pass
+        target = os.path.join(cc_dir, "%s.json" % project["name"])
+        shutil.copy2(cc_file, target + ".tmp")
+        os.rename(target + ".tmp", target)
+
+
+def run_batch(config, max_concurrent_projects=None, project_names=None,
+              log_function=None):
+    """
+    Relocates all projects of a configuration as returned by read_config().
+
+    :param max_concurrent_projects: Overwrites the maximum number of projects
+        relocated at the same time.
+    :param project_names: Only relocate the projects with these names.
+
+    Returns a dictionary mapping the project names to their "status", "ok"
+    or "failed", and their "wall_time".
+    """
+    def log(msg):
+        if log_function:
+            log_function(msg)
+
+    max_concurrent_projects = max_concurrent_projects or \
+        config["max_concurrent_projects"]
+    projects = config["projects"]
+    if project_names:
+        unknown = set(project_names) - set(_i["name"] for _i in projects)
+        if unknown:
+            raise ValueError("Unknown projects: %s" %
+                             ", ".join(sorted(unknown)))
+        projects = [_i for _i in projects if _i["name"] in project_names]
+    cache_dir = config["cache_dir"]
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Index the waveform files of all projects once.
+    index = update_waveform_index(
+        os.path.join(cache_dir, "waveform_index.json"),
+        [_j for _i in projects for _j in _i["waveform_files"]],
+        processes=max_concurrent_projects, log_function=log_function)
+    for project in projects:
+        if write_waveform_information(index, project["waveform_files"],
+                                      project["working_dir"]):
+            log("Wrote the waveform information of project %s." %
+                project["name"])
+    del index
+
+    # Every project runs in its own non daemonic process so it can start
+    # processes itself, e.g. for tiled relocations.
+    results = {}
+    pending = list(projects)
+    running = {}
+    while pending or running:
+        while pending and len(running) < max_concurrent_projects:
+            project = pending.pop(0)
+            process = multiprocessing.Process(target=_run_project,
+                                              args=(project, cache_dir))
+            process.start()
+            running[project["name"]] = (process, time.time())
+            log("Started project %s (%i running, %i pending)." % (
+                project["name"], len(running), len(pending)))
+        for name, (process, start_time) in list(running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del running[name]
+            results[name] = {
+                "status": "ok" if process.exitcode == 0 else "failed",
+                "exitcode": process.exitcode,
+                "wall_time": time.time() - start_time}
+            log("Project %s %s after %.1f s." % (
+                name, "finished" if process.exitcode == 0 else "failed",
+                results[name]["wall_time"]))
+        time.sleep(0.5)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Relocate many projects with hypoDDpy.")
+    parser.add_argument("config", help="JSON configuration file.")
+    parser.add_argument("--max-concurrent-projects", type=int,
+                        help="Maximum number of projects relocated at the "
+                             "same time. Overwrites the configuration.")
+    parser.add_argument("--projects", nargs="+",
+                        help="Only relocate these projects.")
+    parser.add_argument("--summary",
+                        help="JSON file for the status of all projects.")
+    args = parser.parse_args(argv)
+
+    def log(msg):
+        print(">>> %s" % msg)
+        sys.stdout.flush()
+
+    config = read_config(args.config)
+    results = run_batch(config,
+                        max_concurrent_projects=args.max_concurrent_projects,
+                        project_names=args.projects, log_function=log)
+    if args.summary:
+        with open(args.summary, "w") as open_file:
+            json.dump(results, open_file, indent=2, sort_keys=True)
+        log("Summary written to %s." % args.summary)
+    failed = sorted(_i for _i, _j in results.items() if _j["status"] != "ok")
+    if failed:
+        log("Failed projects: %s" % ", ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
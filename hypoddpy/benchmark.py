@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stage level benchmarks of the relocation pipeline.
+
+Every benchmarked stage of HypoDDRelocator runs in its own process on a
+synthetic data set so wall time, CPU time and peak memory can be attributed
+to it. All stages it depends on are run beforehand and are loaded from the
+serialized intermediate files of the working directory.
+
+The peak RSS of the process includes the loaded prerequisites and is
+reported as peak_rss. The memory of the stage itself is stage_peak_rss, the
+amount the stage raised the peak RSS above the one after loading the
+prerequisites (rss_before).
+
+Benchmarked stages:
+
+    * read_event_information: Parsing the QuakeML event files.
+    * write_ph2dt_inp_file: Determining MAXDIST and MAXSEP.
+    * parse_waveform_files: Indexing the waveform files.
+    * find_data: Looking up the waveform files of picks.
+    * cross_correlate_picks: Cross correlating the picks of the event pairs
+      selected by ph2dt.
+
+Usage
+=====
+
+    python -m hypoddpy.benchmark --sizes 1000 10000 100000 \\
+        --output benchmark.json
+
+The results are written as JSON so different versions can be compared.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import time
+
+from hypoddpy.hypodd_synthetic import generate_dataset, \
+    write_standin_binaries
+
+
+SIZES = [1000, 10000, 100000]
+
+STAGES = ["read_event_information", "write_ph2dt_inp_file",
+          "parse_waveform_files", "find_data", "cross_correlate_picks"]
+
+# Cross correlation parameters used for all benchmarks.
+CC_PARAMETERS = {
+    "cc_time_before": 0.2,
+    "cc_time_after": 0.8,
+    "cc_maxlag": 0.3,
+    "cc_filter_min_freq": 1.0,
+    "cc_filter_max_freq": 8.0,
+    "cc_p_phase_weighting": {"Z": 1.0},
+    "cc_s_phase_weighting": {"Z": 1.0},
+    "cc_min_allowed_cross_corr_coeff": 0.4}
+
+
+def _create_relocator(working_dir, dataset, quiet=True):
+    from hypoddpy.hypodd_relocator import HypoDDRelocator
+
+    relocator = HypoDDRelocator(working_dir=working_dir, **CC_PARAMETERS)
+    relocator.add_event_files(dataset["event_files"])
+    relocator.add_waveform_files(dataset["waveform_files"])
+    if quiet:
+        relocator.log = lambda *args, **kwargs: None
+    return relocator
+
+
+def _prepare_working_dir(working_dir, dataset):
+    """
+    Creates the working directory with the serialized station information so
+    no station files have to be parsed.
+    """
+    if os.path.exists(working_dir):
+        shutil.rmtree(working_dir)
+    os.makedirs(os.path.join(working_dir, "working_files"))
+    with open(os.path.join(working_dir, "working_files", "stations.json"),
+              "w") as open_file:
+        json.dump(dataset["stations"], open_file)
+
+
+def _rusage():
+    """
+    Returns the CPU time in seconds and the peak RSS in bytes of the current
+    process.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    peak_rss = usage.ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    if sys.platform != "darwin":
+        peak_rss *= 1024
+    return usage.ru_utime + usage.ru_stime, peak_rss
+
+
+def _run_stage(stage, working_dir, dataset, options, queue):
+    """
+    Runs a single stage in the current process and puts the measurements in
+    the queue. All prerequisites are loaded before the measurement starts.
+    """
+    relocator = _create_relocator(working_dir, dataset,
+                                  quiet=options["quiet"])
+    relocator._parse_station_files()
+    if stage != "read_event_information":
+        relocator._read_event_information()
+    if stage in ("find_data", "cross_correlate_picks"):
+        relocator._parse_waveform_files()
+    if stage == "cross_correlate_picks":
+        relocator._create_event_id_map()
+    if stage == "find_data":
+        picks = [pick for event in relocator.events
+                 for pick in event["picks"]]
+        rng = random.Random(options["seed"])
+        picks = [rng.choice(picks) for _ in range(options["find_data_calls"])]
+
+    cpu_before, rss_before = _rusage()
+    wall_before = time.time()
+    if stage == "read_event_information":
+        relocator._read_event_information()
+    elif stage == "write_ph2dt_inp_file":
+        relocator._write_ph2dt_inp_file()
+    elif stage == "parse_waveform_files":
+        relocator._parse_waveform_files()
+    elif stage == "find_data":
+        for pick in picks:
+            relocator._find_data(pick["station_id"], pick["pick_time"] - 0.05,
+                                 0.25)
+    elif stage == "cross_correlate_picks":
+        relocator._cross_correlate_picks()
+    wall_time = time.time() - wall_before
+    cpu_after, rss_after = _rusage()
+
+    result = {"wall_time": wall_time, "cpu_time": cpu_after - cpu_before,
+              "rss_before": rss_before, "peak_rss": rss_after,
+              "stage_peak_rss": rss_after - rss_before}
+    if stage == "read_event_information":
+        result["events_per_second"] = len(relocator.events) / wall_time
+        result["picks_per_second"] = sum(
+            len(event["picks"]) for event in relocator.events) / wall_time
+    elif stage == "parse_waveform_files":
+        result["files_indexed_per_second"] = \
+            len(relocator.waveform_files) / wall_time
+    elif stage == "find_data":
+        result["calls"] = len(picks)
+        result["calls_per_second"] = len(picks) / wall_time
+    elif stage == "cross_correlate_picks":
+        with open(os.path.join(working_dir, "working_files",
+                               "cc_results.jsonl"), "r") as open_file:
+            pick_pairs = sum(1 for _ in open_file)
+        result["pick_pairs"] = pick_pairs
+        result["pick_pairs_per_second"] = pick_pairs / wall_time
+    queue.put(result)
+
+
+def _limit_event_pairs(working_dir, max_pairs):
+    """
+    Truncates dt.ct to the first max_pairs event pairs.
+    """
+    dt_ct = os.path.join(working_dir, "input_files", "dt.ct")
+    lines = []
+    pair_count = 0
+    with open(dt_ct, "r") as open_file:
+        for line in open_file:
+            if line.startswith("#"):
+                pair_count += 1
+                if pair_count > max_pairs:
+                    break
+            lines.append(line)
+    with open(dt_ct, "w") as open_file:
+        open_file.write("".join(lines))
+
+
+def benchmark_size(event_count, directory, options):
+    """
+    Benchmarks all stages for a synthetic data set with event_count events.
+
+    Returns a dictionary mapping the stage names to their measurements.
+    """
+    data_dir = os.path.join(directory, "data_%i" % event_count)
+    working_dir = os.path.join(directory, "working_dir_%i" % event_count)
+    dataset = generate_dataset(data_dir, event_count, station_count=6,
+                               sampling_rate=20.0, seed=options["seed"])
+    _prepare_working_dir(working_dir, dataset)
+
+    results = {}
+    for stage in options["stages"]:
+        if stage == "cross_correlate_picks":
+            # Select the event pairs with the stand-in ph2dt. Not measured.
+            relocator = _create_relocator(working_dir, dataset)
+            relocator.set_external_binaries(*write_standin_binaries(
+                os.path.join(directory, "standin_binaries")))
+            relocator._parse_station_files()
+            relocator._read_event_information()
+            relocator.set_forced_configuration_value("MAXSEP", 5.0)
+            relocator._write_ph2dt_inp_file()
+            relocator._create_event_id_map()
+            relocator._write_station_input_file()
+            relocator._write_catalog_input_file()
+            relocator._compile_hypodd()
+            relocator._run_ph2dt()
+            _limit_event_pairs(working_dir, options["max_event_pairs"])
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_run_stage,
+            args=(stage, working_dir, dataset, options, queue))
+        process.start()
+        process.join(options["timeout"])
+        if process.is_alive():
+            process.terminate()
+            process.join()
+            results[stage] = {"timeout": options["timeout"]}
+        elif process.exitcode != 0:
+            results[stage] = {"error": "exit code %i" % process.exitcode}
+        else:
+            results[stage] = queue.get()
+        print("%i events - %s: %s" % (event_count, stage,
+                                      json.dumps(results[stage])))
+    return results
+
+
+def run_benchmarks(sizes, directory, stages=None, max_event_pairs=1000,
+                   find_data_calls=10000, timeout=3600, seed=12345,
+                   quiet=True):
+    """
+    Runs the benchmarks for all sizes and returns the results.
+
+    :param sizes: List of the number of events of the synthetic catalogs.
+    :param directory: Directory for the synthetic data and working dirs.
+    :param stages: The stages to benchmark. Defaults to all.
+    :param max_event_pairs: Maximum number of event pairs to cross
+        correlate.
+    :param find_data_calls: Number of _find_data() calls to time.
+    :param timeout: Maximum time per stage in seconds.
+    :param seed: Seed of the random number generators.
+    :param quiet: Disable the logging of the relocator.
+    """
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "VERSION.txt")) as open_file:
+        version = open_file.read().strip()
+    options = {"stages": stages or STAGES,
+               "max_event_pairs": max_event_pairs,
+               "find_data_calls": find_data_calls, "timeout": timeout,
+               "seed": seed, "quiet": quiet}
+    results = {
+        "hypoddpy_version": version,
+        "python_version": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "options": options,
+        "sizes": {}}
+    for size in sizes:
+        results["sizes"][str(size)] = benchmark_size(size, directory,
+                                                     options)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the stages of the hypoDDpy relocation.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES,
+                        help="Number of events of the synthetic catalogs.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES,
+                        help="Stages to benchmark. Defaults to all.")
+    parser.add_argument("--directory", default="hypoddpy_benchmark",
+                        help="Directory for the synthetic data.")
+    parser.add_argument("--output", default="benchmark.json",
+                        help="JSON file for the results.")
+    parser.add_argument("--max-event-pairs", type=int, default=1000,
+                        help="Maximum number of event pairs to correlate.")
+    parser.add_argument("--find-data-calls", type=int, default=10000)
+    parser.add_argument("--timeout", type=float, default=3600,
+                        help="Maximum time per stage in seconds.")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.directory, stages=args.stages,
+                             max_event_pairs=args.max_event_pairs,
+                             find_data_calls=args.find_data_calls,
+                             timeout=args.timeout)
+    with open(args.output, "w") as open_file:
+        json.dump(results, open_file, indent=2, sort_keys=True)
+    print("Benchmark results written to %s." % args.output)
+
+
+if __name__ == "__main__":
+    main()
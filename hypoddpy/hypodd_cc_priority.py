@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Time budgeted cross correlation of the pick pairs in the order of their
+expected value.
+
+With HypoDDRelocator.cc_time_budget set, the cross correlation stage first
+selects the pick pairs of the event pairs of dt.ct with the highest
+pick_pair_priority(). They are correlated in batches in this order until
+the next batch would exceed the budget. dt.cc is then written as usual in
+dt.ct order, containing the differential times of all pick pairs that were
+correlated in time. A CorrelationCoverage tells how much of the work was
+done.
+
+The memory usage does not depend on the number of pick pairs:
+
+    * select_pick_pairs() keeps at most MAX_SELECTED_PICK_PAIRS pick pairs
+      of a pass over dt.ct in a heap. If the budget is not used up by them,
+      the next pass selects the following pick pairs, sized for the
+      remaining budget at the throughput achieved so far.
+    * The results are spilled to disk by a ResultSpill in sorted runs,
+      which are merged in dt.ct order while dt.cc is written.
+
+The priority of a pick pair is the product of four factors, each between 0
+and 1 except for the magnitude factor:
+
+    * Close events have similar waveforms:
+      1 / (1 + inter event distance / EVENT_DISTANCE_SCALE)
+    * Accurate picks keep the phase inside the correlation window:
+      1 / (1 + (pick_time_error_1 + pick_time_error_2) / window)
+    * Larger events have a better signal to noise ratio:
+      10 ** (MAGNITUDE_SCALE * smaller magnitude)
+    * Close stations have a better signal to noise ratio:
+      1 / (1 + station distance / STATION_DISTANCE_SCALE)
+
+Unknown pick time errors count as half the correlation window, unknown
+magnitudes as magnitude 0.
+"""
+import heapq
+import json
+import math
+import os
+import shutil
+
+
+# Rough conversion factor from degree to km.
+DEG2KM = 111.0
+
+# Distances in km at which the distance factors drop to 0.5.
+EVENT_DISTANCE_SCALE = 1.0
+STATION_DISTANCE_SCALE = 20.0
+
+# Exponent of the magnitude factor per magnitude unit.
+MAGNITUDE_SCALE = 0.5
+
+# Number of pick pairs correlated between two checks of the time budget.
+BUDGET_BATCH_SIZE = 256
+
+# Maximum number of pick pairs selected by a single pass over dt.ct.
+MAX_SELECTED_PICK_PAIRS = 200000
+
+# Factor on the number of pick pairs expected to be correlated in the
+# remaining budget when sizing the next selection.
+SELECTION_HEADROOM = 1.5
+
+# Number of results sorted in memory before a ResultSpill writes them.
+RESULT_RUN_SIZE = 100000
+
+
+def _distance_km(latitude_1, longitude_1, depth_1, latitude_2, longitude_2,
+                 depth_2):
+    """
+    Flat earth distance in km. Depths are in km.
+    """
+    x = (longitude_2 - longitude_1) * DEG2KM * \
+        math.cos(math.radians((latitude_1 + latitude_2) / 2.0))
+    y = (latitude_2 - latitude_1) * DEG2KM
+    return math.sqrt(x ** 2 + y ** 2 + (depth_2 - depth_1) ** 2)
+
+
+def pick_pair_priority(event_1, event_2, pick_1, pick_2, station, window):
+    """
+    Returns the expected value of cross correlating a pick pair. Larger is
+    better.
+
+    :param event_1: The event dictionary of pick_1.
+    :param event_2: The event dictionary of pick_2.
+    :param station: The station dictionary of the picks with latitude,
+        longitude and elevation in m.
+    :param window: Length of the cross correlation window in seconds.
+    """
+    depth_1 = (event_1["origin_depth"] or 0.0) / 1000.0
+    depth_2 = (event_2["origin_depth"] or 0.0) / 1000.0
+    event_distance = _distance_km(
+        event_1["origin_latitude"], event_1["origin_longitude"], depth_1,
+        event_2["origin_latitude"], event_2["origin_longitude"], depth_2)
+
+    errors = 0.0
+    for pick in (pick_1, pick_2):
+        error = pick.get("pick_time_error")
+        errors += window / 2.0 if error is None else error
+
+    magnitudes = [_i["magnitude"] for _i in (event_1, event_2)
+                  if _i.get("magnitude") is not None]
+    magnitude = min(magnitudes) if magnitudes else 0.0
+
+    station_distance = _distance_km(
+        (event_1["origin_latitude"] + event_2["origin_latitude"]) / 2.0,
+        (event_1["origin_longitude"] + event_2["origin_longitude"]) / 2.0,
+        (depth_1 + depth_2) / 2.0,
+        station["latitude"], station["longitude"],
+        -station["elevation"] / 1000.0)
+
+    return (1.0 / (1.0 + event_distance / EVENT_DISTANCE_SCALE) *
+            1.0 / (1.0 + errors / window) *
+            10.0 ** (MAGNITUDE_SCALE * magnitude) *
+            1.0 / (1.0 + station_distance / STATION_DISTANCE_SCALE))
+
+
+def pick_pair_rank(priority, position):
+    """
+    Returns a key sorting pick pairs by decreasing priority and then by
+    their position in dt.ct.
+    """
+    return (-priority, position[0], position[1])
+
+
+def select_pick_pairs(candidates, count, after=None):
+    """
+    Selects the count pick pairs with the highest priority.
+
+    Returns a list of the selected (priority, position, pick_1, pick_2)
+    tuples by decreasing priority and True if more candidates were left
+    out.
+
+    :param candidates: Iterable of (priority, position, pick_1, pick_2)
+        tuples. The unique position of the pick pair in dt.ct, a
+        (event pair index, pick pair index) tuple, breaks ties.
+    :param after: Rank as returned by pick_pair_rank() of the last pick
+        pair of the previous selection. Only pick pairs ranked after it are
+        selected.
+    """
+    # Min-heap of the selected pick pairs with the worst one on top.
+    heap = []
+    more = False
+    for priority, position, pick_1, pick_2 in candidates:
+        if after is not None and \
+                pick_pair_rank(priority, position) <= after:
+            continue
+        item = (priority, -position[0], -position[1], pick_1, pick_2)
+        if len(heap) < count:
+            heapq.heappush(heap, item)
+            continue
+        more = True
+        if item[:3] > heap[0][:3]:
+            heapq.heapreplace(heap, item)
+    heap.sort(key=lambda _i: _i[:3], reverse=True)
+    return [(_i[0], (-_i[1], -_i[2]), _i[3], _i[4]) for _i in heap], more
+
+
+class ResultSpill(object):
+    """
+    Collects cross correlation results in any order and yields them in
+    dt.ct order with bounded memory. Runs of up to run_size results are
+    sorted and written to directory as JSON lines and finally merged.
+
+    :param directory: Directory of the runs. Removed by close().
+    """
+    def __init__(self, directory, run_size=RESULT_RUN_SIZE):
+        self.directory = directory
+        self.run_size = run_size
+        self.runs = []
+        self.buffer = []
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
+
+    def add(self, position, pick_id_1, pick_id_2, result):
+        self.buffer.append((tuple(position), pick_id_1, pick_id_2, result))
+        if len(self.buffer) >= self.run_size:
+            self._write_run()
+
+    def _write_run(self):
+        if not self.buffer:
+            return
+        self.buffer.sort(key=lambda _i: _i[0])
+        filename = os.path.join(self.directory,
+                                "run_%06i.jsonl" % len(self.runs))
+        with open(filename, "w") as open_file:
+            for item in self.buffer:
+                open_file.write(json.dumps(item) + "\n")
+        self.runs.append(filename)
+        self.buffer = []
+
+    def _iter_run(self, filename):
+        with open(filename, "r") as open_file:
+            for line in open_file:
+                position, pick_id_1, pick_id_2, result = json.loads(line)
+                yield tuple(position), pick_id_1, pick_id_2, result
+
+    def __iter__(self):
+        """
+        Yields all (position, pick_id_1, pick_id_2, result) tuples ordered
+        by position.
+        """
+        self._write_run()
+        # Positions are unique so the merge never compares the rest.
+        return heapq.merge(*[self._iter_run(_i) for _i in self.runs])
+
+    def close(self):
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+
+
+class CorrelationCoverage(object):
+    """
+    Coverage achieved by a time budgeted cross correlation.
+    """
+    def __init__(self, time_budget):
+        self.time_budget = time_budget
+        self.pick_pairs = 0
+        self.pick_pairs_loaded = 0
+        self.pick_pairs_correlated = 0
+        self.priority_total = 0.0
+        self.priority_correlated = 0.0
+        self.elapsed_time = 0.0
+        self.budget_exhausted = False
+
+    def as_dict(self):
+        """
+        Returns the coverage as a dictionary, with the fraction of the pick
+        pairs and of the summed priority of all pick pairs that were
+        correlated or loaded.
+        """
+        pick_pairs = self.pick_pairs + self.pick_pairs_loaded
+        done = self.pick_pairs_correlated + self.pick_pairs_loaded
+        return {
+            "time_budget": self.time_budget,
+            "elapsed_time": self.elapsed_time,
+            "budget_exhausted": self.budget_exhausted,
+            "pick_pairs": pick_pairs,
+            "pick_pairs_loaded": self.pick_pairs_loaded,
+            "pick_pairs_correlated": self.pick_pairs_correlated,
+            "pick_pairs_skipped": self.pick_pairs -
+            self.pick_pairs_correlated,
+            "pick_pair_coverage": float(done) / pick_pairs
+            if pick_pairs else 1.0,
+            "priority_coverage": min(1.0, self.priority_correlated /
+                                     self.priority_total)
+            if self.priority_total else 1.0}
+
+
+class PrecomputedCorrelator(object):
+    """
+    Stands in for a CrossCorrelator once the time budgeted correlation is
+    done. correlate_tasks() fills in the results correlated in time and
+    None for all other pick pairs, which are skipped silently. The tasks
+    have to be passed chunk by chunk in dt.ct order.
+
+    :param spill: ResultSpill with the results. Closed by close().
+    :param correlator: The CrossCorrelator that computed them. Closed by
+        close().
+    """
+    def __init__(self, spill, correlator):
+        self.spill = spill
+        self.results = iter(spill)
+        self.correlator = correlator
+        self.skipped = 0
+        self._next = None
+        self._advance()
+
+    def _advance(self):
+        self._next = next(self.results, None)
+
+    def correlate_tasks(self, tasks):
+        # The results of this chunk are the next ones in dt.ct order.
+        keys = set((_i["pick_1"]["id"], _i["pick_2"]["id"]) for _i in tasks)
+        results = {}
+        while self._next is not None and \
+                (self._next[1], self._next[2]) in keys:
+            results[(self._next[1], self._next[2])] = self._next[3]
+            self._advance()
+        for task in tasks:
+            key = (task["pick_1"]["id"], task["pick_2"]["id"])
+            if key in results:
+                task["result"] = results[key]
+                continue
+            task["result"] = None
+            if task["pick_1"]["phase"] in ("P", "S"):
+                self.skipped += 1
+
+    def drain(self):
+        counters = {"pick_pairs_skipped_budget": self.skipped}
+        self.skipped = 0
+        return counters, []
+
+    def close(self):
+        self.spill.close()
+        self.correlator.close()
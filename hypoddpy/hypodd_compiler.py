@@ -13,6 +13,15 @@ the hypoDD.inc file used for the compilation.
 If all three files are present and the hypoDD.inc that would be used for a new
 compilation is identical to the one already present nothing will happen as the
 end result would be the same.
+
+Alternatively the compiler can be pointed at already existing hypoDD and ph2dt
+executables, e.g. the stand-in binaries of hypodd_synthetic. These are then
+simply copied to the binary directory and no archive is needed.
+
+Compilations can be shared between working directories with a binary cache
+directory. Every compilation is stored in a subdirectory named after the md5
+hash of its hypoDD.inc file and is copied from there instead of compiling it
+again.
 """
 import md5
 import os
@@ -50,12 +59,31 @@ class HypoDDCompiler(object):
     >>> hyp_comp.configure()
     >>> hyp_comp.make()
     """
-    def __init__(self, working_dir, log_function):
+    def __init__(self, working_dir, log_function, hypodd_binary=None,
+                 ph2dt_binary=None, binary_cache_dir=None):
         """
         :param working_dir: The working directory. Everything will happen in
             there.
         :param log_function: Function to use to log activity.
+        :param hypodd_binary: Use this hypoDD executable instead of compiling
+            it. Has to be given together with ph2dt_binary.
+        :param ph2dt_binary: Use this ph2dt executable instead of compiling
+            it.
+        :param binary_cache_dir: Directory of compilations shared with other
+            working directories.
         """
+        if (hypodd_binary is None) != (ph2dt_binary is None):
+            msg = "hypodd_binary and ph2dt_binary have to be given together."
+            raise HypoDDCompilationError(msg)
+        self.external_binaries = None
+        if hypodd_binary is not None:
+            for binary in [hypodd_binary, ph2dt_binary]:
+                if not os.path.exists(binary):
+                    msg = "Binary %s could not be found." % binary
+                    raise HypoDDCompilationError(msg)
+            self.external_binaries = {"hypoDD_binary": hypodd_binary,
+                                      "ph2dt_binary": ph2dt_binary}
+        self.binary_cache_dir = binary_cache_dir
         # Set the log function.
         self.log = log_function
         # Set the working dir and create it if necessary.
@@ -63,7 +91,8 @@ class HypoDDCompiler(object):
         if not os.path.exists(self.working_dir):
             os.makedirs(self.working_dir)
         # Make sure the given HypoDD archive is valid.
-        self.verify_archive()
+        if self.external_binaries is None:
+            self.verify_archive()
         # Setup and determine all the necessary paths.
         self.determine_paths()
         self.is_configured = False
@@ -178,19 +207,86 @@ class HypoDDCompiler(object):
         if self.is_configured is not True:
             msg = "Compiler object need to be configured first."
             raise HypoDDCompilationError(msg)
-        # Unpack the archive.
-        self.unpack_archive()
+        if self.external_binaries is not None:
+            self.install_external_binaries()
+            return
         # Create the hypoDD_inc file.
         self.hypodd_inc_file = self.create_hypoDD_inc_file()
         # Check the current HypoDD compilation (if any).
         if self.is_current_hypodd_compilation_valid() is True:
-            shutil.rmtree(self.paths["hypodd_unpack_dir"])
             self.log("Current compilation is up to date.")
             return
+        if self.install_cached_binaries() is True:
+            return
+        # Unpack the archive.
+        self.unpack_archive()
         # Finally compile it.
         self.compile_hypodd()
         # Cleanup.
         shutil.rmtree(self.paths["hypodd_unpack_dir"])
+        self.store_cached_binaries()
+
+    def get_cache_directory(self):
+        """
+        Returns the directory of the current configuration in the binary
+        cache or None if no cache is used.
+        """
+        if self.binary_cache_dir is None:
+            return None
+        return os.path.join(self.binary_cache_dir,
+                            md5.md5(self.hypodd_inc_file).hexdigest())
+
+    def install_cached_binaries(self):
+        """
+        Copies the binaries compiled with the current hypoDD.inc file from the
+        binary cache to the binary directory. Returns True if they were
+        found, False otherwise.
+        """
+        cache_dir = self.get_cache_directory()
+        if cache_dir is None or not os.path.exists(cache_dir):
+            return False
+        for key in ["hypoDD_binary", "ph2dt_binary", "old hypoDD.inc file"]:
+            shutil.copy2(os.path.join(cache_dir,
+                                      os.path.basename(self.paths[key])),
+                         self.paths[key])
+        self.log("Installed cached compilation %s." % cache_dir)
+        return True
+
+    def store_cached_binaries(self):
+        """
+        Stores the compiled binaries and the hypoDD.inc file in the binary
+        cache. They are copied to a temporary directory first which is then
+        renamed, so concurrent compilations never see incomplete entries.
+        """
+        cache_dir = self.get_cache_directory()
+        if cache_dir is None or os.path.exists(cache_dir):
+            return
+        temp_dir = "%s.%i.tmp" % (cache_dir, os.getpid())
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+        os.makedirs(temp_dir)
+        for key in ["hypoDD_binary", "ph2dt_binary", "old hypoDD.inc file"]:
+            shutil.copy2(self.paths[key], temp_dir)
+        try:
+            os.rename(temp_dir, cache_dir)
+        except OSError:
+            # Another process stored the same compilation in the meantime.
+            shutil.rmtree(temp_dir)
+            return
+        self.log("Stored compilation in %s." % cache_dir)
+
+    def install_external_binaries(self):
+        """
+        Copies the external binaries to the binary directory.
+        """
+        for key, binary in self.external_binaries.items():
+            shutil.copy2(binary, self.paths[key])
+        # The external binaries are not compiled with any hypoDD.inc file.
+        if os.path.exists(self.paths["old hypoDD.inc file"]):
+            os.remove(self.paths["old hypoDD.inc file"])
+        self.log("Installed external binaries %s and %s." % (
+            self.external_binaries["hypoDD_binary"],
+            self.external_binaries["ph2dt_binary"]))
 
     def create_hypoDD_inc_file(self):
         """
@@ -0,0 +1,757 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Streaming cross correlation of the event pairs selected by ph2dt.
+
+The stage is a pipeline whose memory usage does not depend on the number of
+event or pick pairs:
+
+    * iter_dt_ct_pairs() lazily reads the event pairs from dt.ct.
+    * The pairs are processed in chunks of CHUNK_SIZE event pairs. The pick
+      pairs of a chunk are correlated by a CrossCorrelator, ordered by
+      schedule_pick_pairs() so that pick pairs reading the same waveform
+      files follow each other and are served from its LRUStreamCache.
+      Pick pairs are only reordered within a chunk. dt.ct is ordered by
+      event, so a chunk of a long catalog holds the pick pairs of few
+      events and the same waveform files are read again in later chunks.
+      Waveform files the following pick pairs need and that are not cached
+      are read ahead in background threads by a WaveformPrefetcher.
+    * With more than one process a ParallelCrossCorrelator decodes every
+      needed waveform file once and publishes it in a SharedWaveformStore.
+      The worker processes attach to the published arrays as read only
+      memory maps, so the waveform memory does not grow with the number of
+      workers.
+    * Every finished chunk is appended to dt.cc and its new cross
+      correlation results to a JSON lines file by a CrossCorrelationSink.
+      The sink records its progress after every chunk so an interrupted run
+      continues with the next chunk.
+
+Cross correlation results are stored as for
+HypoDDRelocator.cc_results: Either a (time correction, coefficient) tuple or
+an error message. In JSON lines files every line is a
+[pick_id_1, pick_id_2, result] list.
+"""
+import collections
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import pickle
+import shutil
+import warnings
+
+import numpy as np
+
+
+# Number of event pairs processed and written together.
+CHUNK_SIZE = 1000
+
+# Length of the time blocks in seconds the pick pairs of a station are
+# grouped by. Matches the common day files.
+SCHEDULE_TIME_BLOCK = 86400.0
+
+# Maximum size of the decoded waveform data kept by the LRUStreamCache.
+STREAM_CACHE_BYTES = 256 * 1024 ** 2
+
+# Number of threads reading waveform files ahead and the maximum number of
+# waveform files read ahead.
+PREFETCH_THREADS = 4
+READ_AHEAD = 16
+
+# Number of pick pair batches per worker process and chunk. More batches
+# balance the load better, fewer keep more pick pairs of a station together.
+BATCHES_PER_PROCESS = 4
+
+
+def iter_dt_ct_pairs(filename):
+    """
+    Yields the (event_id_1, event_id_2) tuples of all event pairs in a dt.ct
+    file in the order of the file.
+    """
+    with open(filename, "r") as open_file:
+        for line in open_file:
+            if not line.startswith("#"):
+                continue
+            event_id_1, event_id_2 = map(int, line[1:].split()[:2])
+            yield event_id_1, event_id_2
+
+
+def count_dt_ct_pairs(filename):
+    """
+    Returns the number of event pairs in a dt.ct file.
+    """
+    with open(filename, "r") as open_file:
+        return sum(1 for line in open_file if line.startswith("#"))
+
+
+def chunked(iterable, size):
+    """
+    Yields lists of up to size consecutive items of iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def common_picks(event_1, event_2):
+    """
+    Returns a list of (pick_1, pick_2) tuples of all picks of event_1 with a
+    pick of the same station and phase in event_2.
+    """
+    picks_2 = {}
+    for pick in event_2["picks"]:
+        picks_2.setdefault((pick["station_id"], pick["phase"]), pick)
+    pairs = []
+    for pick_1 in event_1["picks"]:
+        pick_2 = picks_2.get((pick_1["station_id"], pick_1["phase"]))
+        if pick_2 is not None:
+            pairs.append((pick_1, pick_2))
+    return pairs
+
+
+def schedule_pick_pairs(tasks, time_block=SCHEDULE_TIME_BLOCK):
+    """
+    Returns the pick pair tasks, dictionaries with "pick_1" and "pick_2",
+    ordered by station and then by the time blocks of both picks. Tasks
+    with the same key keep their order.
+
+    Only the given tasks, usually those of one chunk, are ordered. Waveform
+    files are not reused across chunks beyond what the LRUStreamCache
+    still holds.
+    """
+    def key(task):
+        return (task["pick_1"]["station_id"],
+                int(math.floor(task["pick_1"]["pick_time"].timestamp /
+                               time_block)),
+                int(math.floor(task["pick_2"]["pick_time"].timestamp /
+                               time_block)))
+    return sorted(tasks, key=key)
+
+
+class LRUStreamCache(object):
+    """
+    Keeps the most recently used decoded waveform files up to a total size of
+    max_bytes of waveform data.
+
+    get() returns a new Stream object with the cached traces, the traces
+    themselves are shared and must not be modified.
+    """
+    def __init__(self, read_waveform, max_bytes=STREAM_CACHE_BYTES):
+        self.read_waveform = read_waveform
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._streams = collections.OrderedDict()
+
+    def get(self, waveform_file):
+        from obspy.core import Stream
+
+        if waveform_file in self._streams:
+            self.hits += 1
+            stream, size = self._streams.pop(waveform_file)
+        else:
+            self.misses += 1
+            stream = self.read_waveform(waveform_file)
+            size = sum(_i.data.nbytes for _i in stream)
+            self.size += size
+        self._streams[waveform_file] = (stream, size)
+        # Evict the least recently used files, but always keep the last one.
+        while self.size > self.max_bytes and len(self._streams) > 1:
+            _, (_, evicted_size) = self._streams.popitem(last=False)
+            self.size -= evicted_size
+        return Stream(traces=list(stream))
+
+    def __contains__(self, waveform_file):
+        return waveform_file in self._streams
+
+    def clear(self):
+        self._streams.clear()
+        self.size = 0
+
+
+class WaveformPrefetcher(object):
+    """
+    Reads waveform files in background threads before they are needed.
+
+    At most read_ahead files are read ahead. get() returns the read ahead
+    stream of a file or reads it directly if it was not read ahead.
+    """
+    def __init__(self, read_waveform, threads=PREFETCH_THREADS,
+                 read_ahead=READ_AHEAD):
+        from multiprocessing.pool import ThreadPool
+
+        self.read_waveform = read_waveform
+        self.read_ahead = read_ahead
+        self.pool = ThreadPool(processes=threads)
+        self._pending = {}
+        self.used = 0
+
+    def has_capacity(self):
+        return len(self._pending) < self.read_ahead
+
+    def prefetch(self, waveform_file):
+        if waveform_file not in self._pending:
+            self._pending[waveform_file] = self.pool.apply_async(
+                self.read_waveform, (waveform_file,))
+
+    def get(self, waveform_file):
+        if waveform_file in self._pending:
+            self.used += 1
+            # Errors of the read are raised here.
+            return self._pending.pop(waveform_file).get()
+        return self.read_waveform(waveform_file)
+
+    def discard(self):
+        """
+        Waits for and drops all files read ahead but not used.
+        """
+        for result in self._pending.values():
+            result.wait()
+        self._pending.clear()
+
+    def close(self):
+        self.discard()
+        self.pool.close()
+        self.pool.join()
+
+
+class SharedWaveformStore(object):
+    """
+    Decoded waveform files shared by processes as memory mapped .npy files.
+
+    The parent process decodes a waveform file once with publish(). Every
+    trace is written to directory as a .npy file and the trace headers to a
+    pickle file written last. attach() returns a Stream whose trace data are
+    read only memory maps of these files, so all processes share the same
+    pages of the page cache. Put directory on a tmpfs such as /dev/shm to
+    keep the published files in memory only.
+
+    Published files exceeding max_bytes are removed again by evict(), least
+    recently published first.
+    """
+    def __init__(self, directory, read_waveform=None,
+                 max_bytes=STREAM_CACHE_BYTES):
+        self.directory = directory
+        self.read_waveform = read_waveform
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.published = 0
+        self._files = collections.OrderedDict()
+
+    def _path(self, waveform_file, suffix):
+        name = hashlib.md5(waveform_file.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, name + suffix)
+
+    def publish(self, waveform_file):
+        """
+        Decodes and publishes a waveform file if it is not yet published.
+        """
+        if waveform_file in self._files:
+            self._files[waveform_file] = self._files.pop(waveform_file)
+            return
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        stream = self.read_waveform(waveform_file)
+        traces = []
+        size = 0
+        for _i, trace in enumerate(stream):
+            if isinstance(trace.data, np.ma.MaskedArray):
+                # Masked arrays can not be memory mapped, pickle them.
+                traces.append((trace.stats, trace.data))
+                continue
+            data_file = self._path(waveform_file, "_%i.npy" % _i)
+            np.save(data_file, trace.data)
+            traces.append((trace.stats, data_file))
+            size += trace.data.nbytes
+        header_file = self._path(waveform_file, ".pickle")
+        with open(header_file + ".tmp", "wb") as open_file:
+            pickle.dump(traces, open_file, protocol=2)
+        os.rename(header_file + ".tmp", header_file)
+        self._files[waveform_file] = (size, len(traces))
+        self.size += size
+        self.published += 1
+
+    def evict(self, keep=()):
+        """
+        Removes the least recently published files not in keep until the
+        published data fit into max_bytes. Processes still attached to a
+        removed file keep their memory maps.
+        """
+        for waveform_file in list(self._files):
+            if self.size <= self.max_bytes:
+                break
+            if waveform_file in keep:
+                continue
+            size, trace_count = self._files.pop(waveform_file)
+            self.size -= size
+            os.remove(self._path(waveform_file, ".pickle"))
+            for _i in range(trace_count):
+                data_file = self._path(waveform_file, "_%i.npy" % _i)
+                if os.path.exists(data_file):
+                    os.remove(data_file)
+
+    def attach(self, waveform_file):
+        """
+        Returns the Stream of a published waveform file without copying the
+        data.
+        """
+        from obspy.core import Stream, Trace
+
+        with open(self._path(waveform_file, ".pickle"), "rb") as open_file:
+            traces = pickle.load(open_file)
+        stream = Stream()
+        for stats, data in traces:
+            if not isinstance(data, np.ndarray):
+                data = np.load(data, mmap_mode="r")
+            stream.append(Trace(data=data, header=stats))
+        return stream
+
+    def close(self):
+        """
+        Removes all published files.
+        """
+        self._files.clear()
+        self.size = 0
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+
+
+def iter_cc_results(filename):
+    """
+    Yields the (pick_id_1, pick_id_2, result) tuples of a JSON lines cross
+    correlation results file.
+    """
+    with open(filename, "r") as open_file:
+        for line in open_file:
+            if line.strip():
+                pick_id_1, pick_id_2, result = json.loads(line)
+                yield pick_id_1, pick_id_2, result
+
+
+class CrossCorrelator(object):
+    """
+    Cross correlates single pick pairs.
+
+    Counters and problems are buffered until they are collected with
+    drain(), so the correlator can also run in worker processes.
+
+    :param cc_param: The cross correlation parameters of the relocator.
+    :param find_data: Function returning the waveform files of a station
+        for a time span or False, see HypoDDRelocator._find_data().
+    :param read_waveform: Function returning the Stream of a waveform file,
+        see HypoDDRelocator._read_waveform().
+    :param cache_bytes: Size of the LRUStreamCache of decoded waveform files.
+    :param prefetch_threads: Number of threads reading waveform files ahead.
+        0 disables the read ahead.
+    :param read_ahead: Maximum number of waveform files read ahead.
+    """
+    def __init__(self, cc_param, find_data, read_waveform,
+                 cache_bytes=STREAM_CACHE_BYTES,
+                 prefetch_threads=PREFETCH_THREADS, read_ahead=READ_AHEAD):
+        self.cc_param = cc_param
+        self.find_data = find_data
+        self.prefetcher = None
+        if prefetch_threads:
+            self.prefetcher = WaveformPrefetcher(
+                read_waveform, threads=prefetch_threads,
+                read_ahead=read_ahead)
+            read_waveform = self.prefetcher.get
+        self.cache = LRUStreamCache(read_waveform, max_bytes=cache_bytes)
+        self.counters = {}
+        self.problems = []
+
+    def close(self):
+        """
+        Stops the read ahead threads.
+        """
+        if self.prefetcher is not None:
+            self.prefetcher.close()
+
+    def increment(self, counter, value=1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def problem(self, reason, message, level="warning", **kwargs):
+        self.problems.append((reason, message, level, kwargs))
+
+    def drain(self):
+        """
+        Returns and resets the buffered counters and problems.
+        """
+        self.increment("waveform_files_decoded", self.cache.misses)
+        self.increment("waveform_cache_hits", self.cache.hits)
+        self.cache.hits = self.cache.misses = 0
+        if self.prefetcher is not None:
+            self.increment("waveform_files_read_ahead", self.prefetcher.used)
+            self.prefetcher.used = 0
+        counters, problems = self.counters, self.problems
+        self.counters, self.problems = {}, []
+        return counters, problems
+
+    def find_pick_pair_data(self, pick_1, pick_2):
+        """
+        Returns the lists of the waveform files covering the cross
+        correlation windows of both picks or None if any pick has no data.
+        """
+        files = []
+        for pick in (pick_1, pick_2):
+            data_files = self.find_data(
+                pick["station_id"],
+                pick["pick_time"] - self.cc_param["cc_time_before"],
+                self.cc_param["cc_time_before"] +
+                self.cc_param["cc_time_after"])
+            if data_files is False:
+                return None
+            files.append(data_files)
+        return files
+
+    def read_streams(self, data_files):
+        """
+        Returns the streams of the waveform files of both picks as returned
+        by find_pick_pair_data().
+        """
+        from obspy.core import Stream
+
+        streams = []
+        for pick_files in data_files:
+            stream = Stream()
+            for waveform_file in pick_files:
+                stream += self.cache.get(waveform_file)
+            streams.append(stream)
+        return streams
+
+    def correlate_tasks(self, tasks):
+        """
+        Correlates the pick pairs of all tasks, dictionaries with "pick_1"
+        and "pick_2", in the given order and stores the results as
+        task["result"]. The waveform files of the following tasks are read
+        ahead.
+        """
+        def task_data(task):
+            if "data_files" not in task:
+                task["data_files"] = None
+                if task["pick_1"]["phase"] in ("P", "S"):
+                    task["data_files"] = self.find_pick_pair_data(
+                        task["pick_1"], task["pick_2"])
+            return task["data_files"]
+
+        ahead = 0
+        for _i, task in enumerate(tasks):
+            ahead = max(ahead, _i + 1)
+            while self.prefetcher is not None and ahead < len(tasks) and \
+                    self.prefetcher.has_capacity():
+                for pick_files in task_data(tasks[ahead]) or []:
+                    for waveform_file in pick_files:
+                        if waveform_file not in self.cache:
+                            self.prefetcher.prefetch(waveform_file)
+                ahead += 1
+            task["result"] = self.correlate(task["pick_1"], task["pick_2"],
+                                            data_files=task_data(task))
+            del task["data_files"]
+        if self.prefetcher is not None:
+            self.prefetcher.discard()
+
+    def correlate(self, pick_1, pick_2, data_files=None):
+        """
+        Cross correlates all weighted channels of a pick pair.
+
+        :param data_files: The waveform files of both picks as returned by
+            find_pick_pair_data(). Searched if not given.
+
+        Returns a (time correction of pick_2, cross correlation coefficient)
+        tuple combining all successfully correlated channels, an error
+        message if no channel could be correlated or None if the pair is
+        silently skipped.
+        """
+        if self.cc_param.get("cc_coarse_to_fine"):
+            from hypodd_lag_search import coarse_to_fine_pick_correction \
+                as xcorr_pick_correction
+        else:
+            from obspy.signal.cross_correlation import xcorr_pick_correction
+
+        if pick_1["phase"] == "P":
+            pick_weight_dict = self.cc_param["cc_p_phase_weighting"]
+        elif pick_1["phase"] == "S":
+            pick_weight_dict = self.cc_param["cc_s_phase_weighting"]
+        else:
+            return None
+        if data_files is None:
+            data_files = self.find_pick_pair_data(pick_1, pick_2)
+        # If any pick has no data, skip this pick pair.
+        if data_files is None:
+            self.increment("pick_pairs_skipped_no_data")
+            return None
+        stream_1, stream_2 = self.read_streams(data_files)
+        station_id = pick_1["station_id"]
+        all_cross_correlations = []
+        # Loop over all picks and weight them.
+        for channel, channel_weight in sorted(pick_weight_dict.items()):
+            if channel_weight == 0.0:
+                continue
+            # Filter the files to obtain the correct trace.
+            network, station = station_id.split(".")
+            st_1 = stream_1.select(network=network, station=station,
+                                   channel="*%s" % channel)
+            st_2 = stream_2.select(network=network, station=station,
+                                   channel="*%s" % channel)
+            max_starttime_st_1 = pick_1["pick_time"] - \
+                self.cc_param["cc_time_before"]
+            min_endtime_st_1 = pick_1["pick_time"] + \
+                self.cc_param["cc_time_after"]
+            max_starttime_st_2 = pick_2["pick_time"] - \
+                self.cc_param["cc_time_before"]
+            min_endtime_st_2 = pick_2["pick_time"] + \
+                self.cc_param["cc_time_after"]
+            # Attempt to find the correct trace.
+            for trace in list(st_1):
+                if trace.stats.starttime > max_starttime_st_1 or \
+                   trace.stats.endtime < min_endtime_st_1:
+                    st_1.remove(trace)
+            for trace in list(st_2):
+                if trace.stats.starttime > max_starttime_st_2 or \
+                   trace.stats.endtime < min_endtime_st_2:
+                    st_2.remove(trace)
+
+            # cleanup merges, in case the event is included in multiple
+            # traces (happens for events with very close origin times)
+            st_1.merge(-1)
+            st_2.merge(-1)
+
+            if len(st_1) > 1 or len(st_2) > 1:
+                self.problem("multiple_traces",
+                             "More than one matching trace found for {pick}",
+                             pick=pick_1)
+                continue
+            elif len(st_1) == 0 or len(st_2) == 0:
+                self.problem("no_trace", "No matching trace found for {pick}",
+                             pick=pick_1)
+                continue
+            trace_1 = st_1[0]
+            trace_2 = st_2[0]
+
+            if trace_1.id != trace_2.id:
+                msg = "Non matching ids during cross correlation. "
+                msg += "(%s and %s)" % (trace_1.id, trace_2.id)
+                self.problem("non_matching_ids", msg)
+                continue
+            if trace_1.stats.sampling_rate != trace_2.stats.sampling_rate:
+                msg = ("Non matching sampling rates during cross "
+                       "correlation. ")
+                msg += "(%s and %s)" % (trace_1.id, trace_2.id)
+                self.problem("non_matching_sampling_rates", msg)
+                continue
+
+            # Call the cross correlation function.
+            self.increment("cc_calls")
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                try:
+                    pick2_corr, cross_corr_coeff = xcorr_pick_correction(
+                        pick_1["pick_time"], trace_1,
+                        pick_2["pick_time"], trace_2,
+                        t_before=self.cc_param["cc_time_before"],
+                        t_after=self.cc_param["cc_time_after"],
+                        cc_maxlag=self.cc_param["cc_maxlag"],
+                        filter="bandpass",
+                        filter_options={
+                            "freqmin": self.cc_param["cc_filter_min_freq"],
+                            "freqmax": self.cc_param["cc_filter_max_freq"]},
+                        plot=False)
+                except Exception as err:
+                    self.increment("cc_calls_failed")
+                    # XXX: Maybe maxlag is too short?
+                    if not str(err).startswith("Less than 3"):
+                        msg = "Error during cross correlating: " + str(err)
+                        self.problem("cc_error", msg, level="error")
+                    # Skip this channel.
+                    continue
+            all_cross_correlations.append((pick2_corr, cross_corr_coeff,
+                                           channel_weight))
+        if len(all_cross_correlations) == 0:
+            return "No cross correlations performed"
+        # Now combine all of them based upon their weight.
+        weight = sum([_i[2] for _i in all_cross_correlations])
+        pick2_corr = sum([_i[0] * _i[2] for _i in
+                          all_cross_correlations]) / weight
+        cross_corr_coeff = sum([_i[1] * _i[2] for _i in
+                                all_cross_correlations]) / weight
+        return (pick2_corr, cross_corr_coeff)
+
+
+# The CrossCorrelator of a worker process of a ParallelCrossCorrelator.
+_worker_correlator = None
+
+
+def _init_correlation_worker(cc_param, store_directory, cache_bytes):
+    """
+    Initializer of the worker processes of a ParallelCrossCorrelator.
+    """
+    global _worker_correlator
+    store = SharedWaveformStore(store_directory)
+    _worker_correlator = CrossCorrelator(
+        cc_param, None, store.attach, cache_bytes=cache_bytes,
+        prefetch_threads=0)
+
+
+def _correlate_in_worker(tasks):
+    """
+    Correlates a batch of (pick_1, pick_2, data_files) tuples in a worker
+    process. Returns the results, counters and problems.
+    """
+    results = [_worker_correlator.correlate(pick_1, pick_2,
+                                            data_files=data_files)
+               for pick_1, pick_2, data_files in tasks]
+    counters, problems = _worker_correlator.drain()
+    # Workers only attach to the files decoded by the parent process.
+    counters["waveform_files_attached"] = counters.pop(
+        "waveform_files_decoded", 0)
+    return results, counters, problems
+
+
+class ParallelCrossCorrelator(CrossCorrelator):
+    """
+    CrossCorrelator distributing the pick pairs over worker processes.
+
+    The waveform files are decoded once in the calling process and shared
+    with the workers by a SharedWaveformStore in store_directory. The
+    scheduled pick pairs are split into contiguous batches so pick pairs of
+    the same waveform files mostly stay in the same worker.
+
+    :param processes: Number of worker processes. Defaults to the number of
+        CPUs.
+    """
+    def __init__(self, cc_param, find_data, read_waveform, store_directory,
+                 processes=None, cache_bytes=STREAM_CACHE_BYTES):
+        # Imported before the workers are forked so they do not all import
+        # it again.
+        import obspy.signal.cross_correlation  # NOQA
+
+        super(ParallelCrossCorrelator, self).__init__(
+            cc_param, find_data, read_waveform, cache_bytes=cache_bytes,
+            prefetch_threads=0)
+        self.processes = processes or multiprocessing.cpu_count()
+        self.store = SharedWaveformStore(store_directory, read_waveform,
+                                         max_bytes=cache_bytes)
+        self.pool = multiprocessing.Pool(
+            processes=self.processes, initializer=_init_correlation_worker,
+            initargs=(cc_param, store_directory, cache_bytes))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.store.close()
+
+    def drain(self):
+        self.increment("waveform_files_decoded", self.store.published)
+        self.store.published = 0
+        return super(ParallelCrossCorrelator, self).drain()
+
+    def correlate_tasks(self, tasks):
+        batch = []
+        for task in tasks:
+            data_files = None
+            if task["pick_1"]["phase"] in ("P", "S"):
+                data_files = self.find_pick_pair_data(task["pick_1"],
+                                                      task["pick_2"])
+            batch.append((task["pick_1"], task["pick_2"], data_files))
+        needed = set()
+        for _, _, data_files in batch:
+            for waveform_file in itertools.chain(*(data_files or [])):
+                if waveform_file not in needed:
+                    needed.add(waveform_file)
+                    self.store.publish(waveform_file)
+        self.store.evict(keep=needed)
+
+        batch_size = max(1, int(math.ceil(
+            len(batch) / float(self.processes * BATCHES_PER_PROCESS))))
+        batches = [batch[_i:_i + batch_size]
+                   for _i in range(0, len(batch), batch_size)]
+        results = []
+        for batch_results, counters, problems in self.pool.map(
+                _correlate_in_worker, batches):
+            results.extend(batch_results)
+            for counter, value in counters.items():
+                self.increment(counter, value)
+            self.problems.extend(problems)
+        for task, result in zip(tasks, results):
+            task["result"] = result
+
+
+class CrossCorrelationSink(object):
+    """
+    Appends the finished chunks to a partial dt.cc file and their new cross
+    correlation results to a JSON lines file.
+
+    After every chunk the number of finished event pairs and the sizes of
+    both files are written to the progress file. A new sink for the same
+    files truncates them to the last finished chunk and completed_pairs
+    tells how many event pairs of dt.ct are already done.
+
+    Usage
+    =====
+
+    >>> sink = CrossCorrelationSink("dt.cc.partial", "cc_results.jsonl",
+    ...                             "cc_progress.json")
+    >>> sink.write_chunk(["# 1  2 0.0\\nBW.FURT 0.123456 0.9000 P"],
+    ...                  [("pick_1", "pick_2", (0.01, 0.9))], 1)
+    >>> sink.finish("dt.cc")
+    """
+    def __init__(self, dt_cc_file, results_file, progress_file):
+        self.dt_cc_file = dt_cc_file
+        self.results_file = results_file
+        self.progress_file = progress_file
+        progress = {"event_pairs": 0, "dt_cc_bytes": 0, "results_bytes": 0}
+        if os.path.exists(progress_file) and os.path.exists(dt_cc_file) \
+                and os.path.exists(results_file):
+            with open(progress_file, "r") as open_file:
+                progress = json.load(open_file)
+        self.completed_pairs = progress["event_pairs"]
+        self._dt_cc = open(dt_cc_file, "a+")
+        self._dt_cc.truncate(progress["dt_cc_bytes"])
+        self._results = open(results_file, "a+")
+        self._results.truncate(progress["results_bytes"])
+        self._dt_cc.seek(0, os.SEEK_END)
+        self._results.seek(0, os.SEEK_END)
+
+    def write_chunk(self, blocks, results, pair_count):
+        """
+        Appends a finished chunk.
+
+        :param blocks: The dt.cc blocks of all event pairs of the chunk in
+            dt.ct order, each a string starting with the "#" line.
+        :param results: List of the (pick_id_1, pick_id_2, result) tuples of
+            all new cross correlation results of the chunk.
+        :param pair_count: The number of event pairs of the chunk.
+        """
+        for block in blocks:
+            self._dt_cc.write(block)
+            self._dt_cc.write("\n")
+        for result in results:
+            self._results.write(json.dumps(result))
+            self._results.write("\n")
+        self._dt_cc.flush()
+        self._results.flush()
+        self.completed_pairs += pair_count
+        temp_file = self.progress_file + ".tmp"
+        with open(temp_file, "w") as open_file:
+            json.dump({"event_pairs": self.completed_pairs,
+                       "dt_cc_bytes": self._dt_cc.tell(),
+                       "results_bytes": self._results.tell()}, open_file)
+        os.rename(temp_file, self.progress_file)
+
+    def close(self):
+        self._dt_cc.close()
+        self._results.close()
+
+    def finish(self, dt_cc):
+        """
+        Closes the files and moves the partial dt.cc file to dt_cc.
+        """
+        self.close()
+        os.rename(self.dt_cc_file, dt_cc)
+        os.remove(self.progress_file)
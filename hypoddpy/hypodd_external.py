@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Accounting for the runs of the external ph2dt and hypoDD executables.
+
+run_external() runs an executable, streams its output line by line with the
+time since the start of the run and measures the CPU time and the peak
+memory of the child from its resource usage. A warning is logged whenever the
+executable has not written anything for stall_warning seconds.
+
+parse_hypodd_log() parses the output of hypoDD, either hypoDD.log or the
+streamed output, into structured metrics: the counts of the data reading and
+clustering steps and one record per iteration with the values of the
+iteration table. If the lines have timestamps, the iterations get their
+duration.
+"""
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+
+
+# Poll interval of the child process in seconds.
+POLL_INTERVAL = 0.05
+
+
+def _read_output(stream, lines, start_time, output_file, log_function):
+    """
+    Reads all lines of stream and appends (elapsed time, line) tuples to
+    lines. Runs in its own thread.
+
+    The raw bytes of every line are written to output_file. Failures to write
+    or log a line do not stop the reading as the child would otherwise block
+    on the full pipe.
+    """
+    for raw_line in iter(stream.readline, b""):
+        raw_line = raw_line.rstrip()
+        line = raw_line.decode("utf-8", "replace")
+        elapsed = time.time() - start_time
+        lines.append((elapsed, line))
+        if output_file is not None:
+            try:
+                output_file.write(("[%10.3f] " % elapsed).encode("ascii") +
+                                  raw_line + b"\n")
+                output_file.flush()
+            except Exception:
+                # Stop writing the output but keep draining the pipe.
+                output_file = None
+        if log_function is not None and line.strip():
+            try:
+                log_function(line)
+            except Exception:
+                pass
+    stream.close()
+
+
+def run_external(command, cwd, output_filename=None, log_function=None,
+                 stall_warning=600.0, warning_function=None):
+    """
+    Runs command in cwd and returns a dictionary with the metrics of the run.
+
+    :param command: The command as a list.
+    :param cwd: The directory to run the command in.
+    :param output_filename: If given, the stdout and stderr of the command
+        are written to this file with the elapsed time in front of every line.
+    :param log_function: Called with every non-empty output line.
+    :param stall_warning: Seconds without output after which the run is
+        considered stalling.
+    :param warning_function: Called with a message whenever the run is
+        stalling.
+
+    The returned dictionary has the keys "command", "returncode",
+    "wall_time", "user_cpu_time", "system_cpu_time" and "peak_rss" (bytes)
+    as well as "output", the list of (elapsed time, line) tuples, and
+    "stall_warnings", the number of stall warnings. The CPU times and the
+    peak RSS are None if os.wait4() is not available.
+    """
+    output_file = open(output_filename, "wb") if output_filename else None
+    start_time = time.time()
+    lines = []
+    # Keep gfortran from buffering the output written to the pipe so the
+    # lines arrive when they are written.
+    env = dict(os.environ)
+    env["GFORTRAN_UNBUFFERED_PRECONNECTED"] = "y"
+    try:
+        process = subprocess.Popen(command, cwd=cwd, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, env=env)
+        reader = threading.Thread(
+            target=_read_output, args=(process.stdout, lines, start_time,
+                                       output_file, log_function))
+        reader.daemon = True
+        reader.start()
+
+        usage = None
+        stall_warnings = 0
+        last_activity = start_time
+        line_count = 0
+        while True:
+            if hasattr(os, "wait4"):
+                pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+                if pid != 0:
+                    if os.WIFSIGNALED(status):
+                        returncode = -os.WTERMSIG(status)
+                    else:
+                        returncode = os.WEXITSTATUS(status)
+                    # The child is reaped. Keep Popen from waiting for it.
+                    process.returncode = returncode
+                    break
+            else:
+                returncode = process.poll()
+                if returncode is not None:
+                    break
+            time.sleep(POLL_INTERVAL)
+            now = time.time()
+            if len(lines) != line_count:
+                line_count = len(lines)
+                last_activity = now
+            elif stall_warning and now - last_activity > stall_warning:
+                stall_warnings += 1
+                last_activity = now
+                if warning_function is not None:
+                    warning_function(
+                        "%s has not written any output for %.0f seconds." %
+                        (os.path.basename(command[0]), stall_warning))
+        wall_time = time.time() - start_time
+        reader.join()
+    finally:
+        if output_file is not None:
+            output_file.close()
+
+    metrics = {"command": " ".join(command),
+               "returncode": returncode,
+               "wall_time": wall_time,
+               "user_cpu_time": None,
+               "system_cpu_time": None,
+               "peak_rss": None,
+               "output": lines,
+               "stall_warnings": stall_warnings}
+    if usage is not None:
+        metrics["user_cpu_time"] = usage.ru_utime
+        metrics["system_cpu_time"] = usage.ru_stime
+        # Linux reports kilobytes, macOS bytes.
+        metrics["peak_rss"] = usage.ru_maxrss * \
+            (1 if sys.platform == "darwin" else 1024)
+    return metrics
+
+
+_COUNT_PATTERN = re.compile(r"^\s*#\s*([^=]+?)\s*=\s*([-+0-9.eE]+)\s*$")
+_CLUSTER_PATTERN = re.compile(r"RELOCATION OF CLUSTER:\s*(\d+)")
+
+
+def _to_number(value):
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+
+def parse_hypodd_log(lines):
+    """
+    Parses the output of hypoDD.
+
+    :param lines: Either the lines of hypoDD.log as strings or the
+        (elapsed time, line) tuples of run_external().
+
+    Returns a dictionary with:
+
+        * "counts": The "# name = value" lines, e.g. {"events": 1000}.
+        * "iterations": One dictionary per iteration with the values of the
+          iteration table keyed by the column names (IT, EV, CT, CC, RMSCT,
+          RMSCC, ...), the "cluster" and, for timestamped lines, the
+          "elapsed" time since the start and the "duration" of the iteration.
+        * "final_rms": The RMSCT and RMSCC values of the last iteration.
+    """
+    counts = {}
+    iterations = []
+    columns = None
+    cluster = None
+    previous_time = 0.0
+    for line in lines:
+        if isinstance(line, (tuple, list)):
+            elapsed, line = line
+        else:
+            elapsed = None
+        match = _CLUSTER_PATTERN.search(line)
+        if match:
+            cluster = int(match.group(1))
+            continue
+        match = _COUNT_PATTERN.match(line)
+        if match:
+            value = _to_number(match.group(2))
+            if value is not None:
+                counts[match.group(1).strip()] = value
+            continue
+        items = line.split()
+        if not items:
+            continue
+        if items[0] == "IT" and "EV" in items:
+            columns = items
+            continue
+        if columns is None or not items[0].isdigit():
+            continue
+        values = [_to_number(_i) for _i in items]
+        iteration = {"cluster": cluster}
+        if len(values) == len(columns):
+            iteration.update(zip(columns, values))
+        else:
+            iteration["IT"] = values[0]
+            iteration["values"] = values
+        if elapsed is not None:
+            iteration["elapsed"] = elapsed
+            iteration["duration"] = elapsed - previous_time
+            previous_time = elapsed
+        iterations.append(iteration)
+    final_rms = {}
+    if iterations:
+        for key in ["RMSCT", "RMSCC"]:
+            if key in iterations[-1]:
+                final_rms[key] = iterations[-1][key]
+    return {"counts": counts, "iterations": iterations,
+            "final_rms": final_rms}
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Coarse-to-fine lag search for the cross correlation of pick pairs.
+
+obspy.signal.cross_correlation.xcorr_pick_correction() evaluates the cross
+correlation function at every lag up to cc_maxlag at the full sampling
+rate. For long maximum lags on high rate data this dominates the cost of
+the cross correlation. coarse_to_fine_pick_correction() is a drop-in
+replacement that
+
+    * preprocesses both traces exactly like xcorr_pick_correction(),
+    * correlates the band limited snippets decimated to about
+      COARSE_OVERSAMPLING times the upper filter frequency over all lags,
+    * evaluates the cross correlation function at the full rate around all
+      coarse peaks that could be the highest peak, as decimation lowers a
+      peak by at most the factor cos(pi * frequency / coarse rate), to find
+      the maximum and
+    * extends the full rate neighbourhood of the maximum until it contains
+      the convex part xcorr_pick_correction() fits the parabola to.
+
+The full rate values are the same as those of xcorr_pick_correction(), so
+the time correction and the coefficient agree unless energy far above the
+upper filter frequency hides the highest peak from the coarse search. If
+the data can not be decimated, xcorr_pick_correction() is used.
+
+Usage
+=====
+
+>>> pick2_corr, coeff = coarse_to_fine_pick_correction(
+...     pick_1, trace_1, pick_2, trace_2, t_before=0.05, t_after=0.2,
+...     cc_maxlag=2.0, filter="bandpass",
+...     filter_options={"freqmin": 1.0, "freqmax": 20.0})
+"""
+import numpy as np
+
+
+# Sampling rate of the coarse search in multiples of the upper filter
+# frequency.
+COARSE_OVERSAMPLING = 4.0
+
+# Highest frequency in multiples of the upper filter frequency considered
+# when estimating how much decimation lowers a peak, accounting for the
+# roll-off of the filter.
+ROLL_OFF = 1.5
+
+# Initial half width in coarse samples of the neighbourhood of the maximum
+# evaluated at the full rate.
+REFINE_RADIUS = 2
+
+
+def _slice_data(pick, trace, t_before, t_after, cc_maxlag, filter,
+                filter_options, index):
+    """
+    Checks and preprocesses a trace like xcorr_pick_correction() and
+    returns the data of the correlated slice.
+    """
+    from obspy.signal.invsim import cosine_taper
+
+    start = pick - t_before - (cc_maxlag / 2.0)
+    end = pick + t_after + (cc_maxlag / 2.0)
+    if trace.stats.starttime > start:
+        raise Exception("Trace %s starts too late." % index)
+    if trace.stats.endtime < end:
+        raise Exception("Trace %s ends too early." % index)
+    if filter:
+        trace = trace.copy()
+        trace.data = trace.data.astype(np.float64)
+        trace.detrend(type="demean")
+        trace.data *= cosine_taper(len(trace), 0.1)
+        trace.filter(type=filter, **filter_options)
+    return trace.slice(start, end).data
+
+
+def _padded(a, b, shift):
+    """
+    Zero pads a or b like obspy's direct correlation so that a "valid"
+    correlation yields the lags -shift to shift.
+    """
+    dif = len(a) - len(b) - 2 * shift
+    if dif > 0:
+        b = np.hstack([np.zeros(dif // 2), b, np.zeros(dif // 2)])
+    else:
+        a = np.hstack([np.zeros(-dif // 2), a, np.zeros(-dif // 2)])
+    return a, b
+
+
+def coarse_to_fine_pick_correction(pick1, trace1, pick2, trace2, t_before,
+                                   t_after, cc_maxlag, filter=None,
+                                   filter_options={}, plot=False):
+    """
+    Same as obspy.signal.cross_correlation.xcorr_pick_correction() with a
+    coarse-to-fine search of the lag. Returns the (time correction of pick2,
+    cross correlation coefficient) tuple.
+    """
+    import scipy.signal
+    from obspy.signal.cross_correlation import correlate, \
+        xcorr_pick_correction
+
+    samp_rate = trace1.stats.sampling_rate
+    shift_len = int(cc_maxlag * samp_rate)
+    decimation = 1
+    if filter and "freqmax" in filter_options:
+        decimation = int(samp_rate / (COARSE_OVERSAMPLING *
+                                      filter_options["freqmax"]))
+    if plot or decimation < 2 or shift_len < 2 * REFINE_RADIUS * decimation \
+            or trace1.stats.sampling_rate != trace2.stats.sampling_rate:
+        return xcorr_pick_correction(
+            pick1, trace1, pick2, trace2, t_before=t_before, t_after=t_after,
+            cc_maxlag=cc_maxlag, filter=filter,
+            filter_options=filter_options, plot=plot)
+
+    a = _slice_data(pick1, trace1, t_before, t_after, cc_maxlag, filter,
+                    filter_options, 0)
+    b = _slice_data(pick2, trace2, t_before, t_after, cc_maxlag, filter,
+                    filter_options, 1)
+    a = a - np.mean(a)
+    b = b - np.mean(b)
+    norm = (np.sum(a ** 2) * np.sum(b ** 2)) ** 0.5
+    if norm <= np.finfo(float).eps:
+        norm = np.inf
+
+    # Coarse search over all lags.
+    coarse_shift = shift_len // decimation
+    coarse = correlate(a[::decimation], b[::decimation], coarse_shift,
+                       demean=False, normalize=None, method="direct")
+    a, b = _padded(a, b, shift_len)
+    length = len(a) - len(b) + 1
+
+    def full_rate(low, high):
+        return scipy.signal.correlate(a[low:high + len(b)], b, mode="valid",
+                                      method="direct") / norm
+
+    # Evaluate all coarse peaks that might be the maximum at the full rate.
+    threshold = coarse.max() * np.cos(min(
+        np.pi / 2.0, np.pi * ROLL_OFF * filter_options["freqmax"] *
+        decimation / samp_rate))
+    padded = np.hstack([[-np.inf], coarse, [-np.inf]])
+    candidates = np.nonzero((coarse >= threshold) &
+                            (coarse >= padded[:-2]) &
+                            (coarse >= padded[2:]))[0]
+    center, best = 0, -np.inf
+    for candidate in candidates:
+        index = shift_len + (int(candidate) - coarse_shift) * decimation
+        low = min(max(index - decimation, 0), length - 1)
+        high = min(max(index + decimation, 0), length - 1)
+        cc = full_rate(low, high)
+        if cc.max() > best:
+            center, best = low + int(cc.argmax()), cc.max()
+
+    # Refine at the full rate around the peak until the neighbourhood
+    # contains the convex part around the maximum.
+    radius = REFINE_RADIUS * decimation
+    while True:
+        low = max(center - radius, 0)
+        high = min(center + radius, length - 1)
+        cc = full_rate(low, high)
+
+        def curvature(index):
+            # As in xcorr_pick_correction() the curvature at both ends of
+            # the cross correlation function is 0. None if unknown.
+            if index == 0 or index == length - 1:
+                return 0.0
+            if low < index < high:
+                return cc[index - low + 1] - 2 * cc[index - low] + \
+                    cc[index - low - 1]
+            return None
+
+        peak = low + int(cc.argmax())
+        complete = (peak > low or low == 0) and (peak < high or
+                                                 high == length - 1)
+        first = last = peak
+        while complete and first > 0:
+            value = curvature(first - 1)
+            if value is None:
+                complete = False
+            elif value > 0:
+                break
+            else:
+                first -= 1
+        while complete and last < length - 1:
+            value = curvature(last + 1)
+            if value is None:
+                complete = False
+            elif value > 0:
+                break
+            else:
+                last += 1
+        if complete:
+            break
+        center = peak
+        radius *= 2
+
+    num_samples = last - first + 1
+    if num_samples < 3:
+        msg = "Less than 3 samples selected for fit to cross " + \
+              "correlation: %s" % num_samples
+        raise Exception(msg)
+    cc_t = np.linspace(-cc_maxlag, cc_maxlag, shift_len * 2 + 1)
+    coeffs = np.polyfit(cc_t[first:last + 1],
+                        cc[first - low:last - low + 1], deg=2)
+    dt = -coeffs[1] / 2.0 / coeffs[0]
+    coeff = (4 * coeffs[0] * coeffs[2] - coeffs[1] ** 2) / (4 * coeffs[0])
+    return (-dt, coeff)
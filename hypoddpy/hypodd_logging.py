@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Logging helpers for hot loops.
+
+AsyncLog moves the actual logging, writing the log file and printing to the
+terminal, to a background thread so the loop only has to put the message in
+a queue.
+
+LogAggregator counts problems by reason and only passes a few samples per
+reason on: the first samples_per_reason messages and afterwards at most one
+per sample_interval seconds. Messages are only formatted if they are passed
+on. At the end a summary table of all reasons is available.
+"""
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class AsyncLog(object):
+    """
+    Calls log_function(string, level=level) in a background thread.
+
+    Usage
+    =====
+
+    >>> log = AsyncLog(relocator.log)
+    >>> log("Message", level="warning")
+    >>> log.close()
+    """
+    def __init__(self, log_function):
+        self.log_function = log_function
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            string, level = item
+            self.log_function(string, level=level)
+
+    def __call__(self, string, level="info"):
+        self.queue.put((string, level))
+
+    def close(self):
+        """
+        Logs all queued messages and stops the thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+
+
+class LogAggregator(object):
+    """
+    Counts problems by reason and logs rate limited samples of them.
+
+    :param log_function: Function called with the message and the level.
+    :param samples_per_reason: Number of messages logged per reason before
+        the rate limit applies.
+    :param sample_interval: Minimum time in seconds between two further
+        messages of the same reason.
+    """
+    def __init__(self, log_function, samples_per_reason=3,
+                 sample_interval=60.0):
+        self.log_function = log_function
+        self.samples_per_reason = samples_per_reason
+        self.sample_interval = sample_interval
+        self.counts = {}
+        self._last_sample = {}
+
+    def __call__(self, reason, message, level="warning", **kwargs):
+        """
+        Counts a problem. message is formatted with kwargs only if it is
+        logged.
+        """
+        count = self.counts.get(reason, 0) + 1
+        self.counts[reason] = count
+        now = time.time()
+        if count > self.samples_per_reason and \
+                now - self._last_sample[reason] < self.sample_interval:
+            return
+        self._last_sample[reason] = now
+        if kwargs:
+            message = message.format(**kwargs)
+        if count > 1:
+            message = "%s [%i times so far]" % (message, count)
+        self.log_function(message, level=level)
+
+    def summary_lines(self):
+        """
+        Returns the lines of a table with the count of every reason.
+        """
+        if not self.counts:
+            return []
+        width = max(len(_i) for _i in self.counts)
+        lines = ["%s %10s" % ("Reason".ljust(width), "Count")]
+        for reason, count in sorted(self.counts.items(),
+                                    key=lambda _i: (-_i[1], _i[0])):
+            lines.append("%s %10i" % (reason.ljust(width), count))
+        return lines
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Fast readers for the HypoDD output files.
+
+Every reader returns a NumPy structured array with one field per column. It
+can directly be used to create a pandas DataFrame. The numeric columns of
+the whole file are parsed at once by numpy.fromstring. numpy.loadtxt parses
+every field in Python on the numpy versions supporting Python 2 and is about
+seven times slower there.
+
+Column names are taken from the HypoDD 2.1b manual:
+
+    * hypoDD.loc and hypoDD.reloc: ID LAT LON DEPTH X Y Z EX EY EZ YR MO DY
+      HR MI SC MAG NCCP NCCS NCTP NCTS RCC RCT CID
+    * hypoDD.sta: STA LAT LON DIST AZ NCCP NCCS NCTP NCTS RCC RCT CID
+    * hypoDD.res: STA DT C1 C2 IDX QUAL RES WT OFFS
+    * hypoDD.src: Not documented. Columns are called COL1, COL2, ...
+"""
+import os
+import warnings
+
+import numpy as np
+
+
+RELOC_COLUMNS = ["ID", "LAT", "LON", "DEPTH", "X", "Y", "Z", "EX", "EY",
+                 "EZ", "YR", "MO", "DY", "HR", "MI", "SC", "MAG", "NCCP",
+                 "NCCS", "NCTP", "NCTS", "RCC", "RCT", "CID"]
+STA_COLUMNS = ["STA", "LAT", "LON", "DIST", "AZ", "NCCP", "NCCS", "NCTP",
+               "NCTS", "RCC", "RCT", "CID"]
+RES_COLUMNS = ["STA", "DT", "C1", "C2", "IDX", "QUAL", "RES", "WT", "OFFS"]
+
+# Columns that are converted to integers.
+INTEGER_COLUMNS = set(["ID", "YR", "MO", "DY", "HR", "MI", "NCCP", "NCCS",
+                       "NCTP", "NCTS", "CID", "C1", "C2", "IDX"])
+
+
+def _read_columns(filename, names=None, has_station_column=False):
+    """
+    Reads a whitespace separated file into a structured array.
+
+    :param names: Names of the columns. If None or if the number of columns
+        does not match, the columns are called COL1, COL2, ...
+    :param has_station_column: If True, the first column is a string column.
+    """
+    # Determine the number of header lines and the number of columns.
+    header_lines = 0
+    column_count = None
+    with open(filename, "r") as open_file:
+        for line in open_file:
+            items = line.split()
+            if not items:
+                header_lines += 1
+                continue
+            try:
+                float(items[-1])
+                float(items[1 if has_station_column else 0])
+            except (ValueError, IndexError):
+                header_lines += 1
+                continue
+            column_count = len(items)
+            break
+    if names is None or \
+            (column_count is not None and len(names) != column_count):
+        names = ["COL%i" % (_i + 1) for _i in range(column_count or 0)]
+    dtype = []
+    for _i, name in enumerate(names):
+        if _i == 0 and has_station_column:
+            dtype.append((name, "U16"))
+        elif name in INTEGER_COLUMNS:
+            dtype.append((name, np.int64))
+        else:
+            dtype.append((name, np.float64))
+    if column_count is None:
+        return np.empty(0, dtype=dtype)
+    with open(filename, "r") as open_file:
+        lines = [line for line in open_file.read().splitlines()[header_lines:]
+                 if line.strip()]
+    numeric_columns = column_count
+    if has_station_column:
+        lines = [line.split(None, 1) for line in lines]
+        stations = [_i[0] for _i in lines]
+        lines = [_i[1] if len(_i) > 1 else "" for _i in lines]
+        numeric_columns -= 1
+    # Fields that are no numbers, e.g. the asterisks of overflowing Fortran
+    # fields, end the parsing with a warning on older and an error on newer
+    # numpy versions.
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        try:
+            values = np.fromstring(" ".join(lines), dtype=np.float64,
+                                   sep=" ")
+        except ValueError:
+            values = None
+    if values is None or values.size != len(lines) * numeric_columns:
+        msg = "%s does not contain %i numeric columns in every line." % (
+            filename, numeric_columns)
+        raise ValueError(msg)
+    values = values.reshape(len(lines), numeric_columns)
+    data = np.empty(len(lines), dtype=dtype)
+    for _i, name in enumerate(names):
+        if _i == 0 and has_station_column:
+            data[name] = stations
+        else:
+            data[name] = values[:, _i - 1 if has_station_column else _i]
+    return data
+
+
+def read_reloc(filename):
+    """
+    Reads a hypoDD.reloc or hypoDD.loc file.
+    """
+    return _read_columns(filename, RELOC_COLUMNS)
+
+
+def read_sta(filename):
+    """
+    Reads a hypoDD.sta file.
+    """
+    return _read_columns(filename, STA_COLUMNS, has_station_column=True)
+
+
+def read_res(filename):
+    """
+    Reads a hypoDD.res file.
+    """
+    return _read_columns(filename, RES_COLUMNS, has_station_column=True)
+
+
+def read_src(filename):
+    """
+    Reads a hypoDD.src file.
+    """
+    return _read_columns(filename)
+
+
+READERS = {
+    "hypoDD.loc": read_reloc,
+    "hypoDD.reloc": read_reloc,
+    "hypoDD.sta": read_sta,
+    "hypoDD.res": read_res,
+    "hypoDD.src": read_src}
+
+
+def export_columnar(output_dir, filename):
+    """
+    Reads all HypoDD output files in output_dir and writes them to a single
+    compressed NumPy .npz file. The arrays are named "<file>.<column>", e.g.
+    "reloc.LAT" or "res.RES".
+
+    Returns the list of exported arrays.
+    """
+    arrays = {}
+    for output_file, reader in sorted(READERS.items()):
+        path = os.path.join(output_dir, output_file)
+        if not os.path.exists(path):
+            continue
+        prefix = output_file.split(".")[-1]
+        data = reader(path)
+        for name in data.dtype.names:
+            arrays["%s.%s" % (prefix, name)] = data[name]
+    np.savez_compressed(filename, **arrays)
+    return sorted(arrays.keys())
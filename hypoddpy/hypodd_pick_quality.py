@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Data quality screening of the picks before the cross correlation.
+
+Every P and S pick is assessed once on all channels it would be correlated
+on. A channel fails if its data
+
+    * do not cover min_coverage of the cross correlation window
+      ("coverage"),
+    * have a gap in the cross correlation window, it is not covered by a
+      single trace ("gap"),
+    * are clipped, at least CLIP_SAMPLES consecutive samples in the cross
+      correlation window stay at the largest absolute value of the window
+      ("clipped"). Single samples at the peak are common in low amplitude
+      integer data, plateaus are not, or
+    * have a signal to noise ratio below min_snr in the cross correlation
+      band ("low_snr"). The signal is the cross correlation window, the
+      noise the noise_length seconds before it.
+
+A pick fails if all its channels fail and is then excluded from all pick
+pairs. The reason of the first failing channel is kept.
+
+Usage
+=====
+
+>>> quality = screen_picks(picks, relocator._find_data,
+...                        relocator._read_waveform, relocator.cc_param,
+...                        {"min_snr": 2.0, "min_coverage": 1.0,
+...                         "reject_gaps": True, "reject_clipped": True,
+...                         "noise_length": None})
+>>> quality["smi:local/pick/1"]
+'low_snr'
+"""
+import warnings
+
+import numpy as np
+
+from hypodd_cross_correlation import LRUStreamCache, STREAM_CACHE_BYTES
+
+
+# Number of consecutive samples at the largest absolute value marking
+# clipped data.
+CLIP_SAMPLES = 3
+
+# Default length of the noise window in multiples of the cross correlation
+# window.
+NOISE_WINDOWS = 3.0
+
+# Minimum available fraction of the noise window to estimate the SNR.
+MIN_NOISE_FRACTION = 0.5
+
+
+def _rms(data):
+    return np.sqrt(np.mean(np.asarray(data, dtype=np.float64) ** 2))
+
+
+def _longest_run(mask):
+    """
+    Returns the length of the longest run of True values in mask.
+    """
+    edges = np.flatnonzero(np.diff(np.concatenate(
+        [[0], np.asarray(mask, dtype=np.int8), [0]])))
+    if not len(edges):
+        return 0
+    return int((edges[1::2] - edges[::2]).max())
+
+
+def _is_clipped(data):
+    """
+    Returns True if data have a plateau of at least CLIP_SAMPLES samples at
+    the largest absolute value.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    peak = np.abs(data).max()
+    if peak == 0:
+        return False
+    return max(_longest_run(data == peak),
+               _longest_run(data == -peak)) >= CLIP_SAMPLES
+
+
+def assess_channel(traces, pick_time, cc_param, quality_param):
+    """
+    Returns the failure reason of the traces of one channel of a pick or
+    None if they pass.
+    """
+    window_start = pick_time - cc_param["cc_time_before"]
+    window_end = pick_time + cc_param["cc_time_after"]
+    window = window_end - window_start
+    noise_length = quality_param["noise_length"] or NOISE_WINDOWS * window
+    noise_start = window_start - noise_length
+
+    in_window = [_i for _i in traces if _i.stats.starttime < window_end and
+                 _i.stats.endtime > window_start]
+    if not in_window:
+        return "coverage"
+    covered = sum(min(_i.stats.endtime, window_end) -
+                  max(_i.stats.starttime, window_start) for _i in in_window)
+    if min(covered / window, 1.0) < quality_param["min_coverage"]:
+        return "coverage"
+    # As for the cross correlation, a single trace has to cover the window.
+    covering = [_i for _i in in_window if _i.stats.starttime <= window_start
+                and _i.stats.endtime >= window_end]
+    if not covering:
+        return "gap" if quality_param["reject_gaps"] else None
+    trace = covering[0].slice(window_start, window_end)
+    if quality_param["reject_gaps"] and \
+            isinstance(trace.data, np.ma.MaskedArray):
+        return "gap"
+    if not trace.stats.npts:
+        return "coverage"
+    if quality_param["reject_clipped"] and _is_clipped(trace.data):
+        return "clipped"
+
+    # The SNR in the cross correlation band. Slices share the data of the
+    # cached traces, so filter a copy.
+    trace = covering[0].slice(noise_start, window_end).copy()
+    noise_available = window_start - max(trace.stats.starttime, noise_start)
+    if noise_available < MIN_NOISE_FRACTION * noise_length or \
+            trace.stats.npts < 2 * CLIP_SAMPLES:
+        # The SNR can not be estimated.
+        return None
+    trace.data = np.require(trace.data, dtype=np.float64)
+    trace.detrend("demean")
+    trace.taper(max_percentage=0.05)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        trace.filter("bandpass", freqmin=cc_param["cc_filter_min_freq"],
+                     freqmax=cc_param["cc_filter_max_freq"], zerophase=True)
+    noise = trace.slice(noise_start, window_start).data
+    signal = trace.slice(window_start, window_end).data
+    noise_rms = _rms(noise)
+    if noise_rms > 0 and _rms(signal) / noise_rms < quality_param["min_snr"]:
+        return "low_snr"
+    return None
+
+
+def assess_pick(pick, stream, cc_param, quality_param):
+    """
+    Returns the failure reason of a pick or None if at least one of its
+    weighted channels passes.
+    """
+    if pick["phase"] == "P":
+        weighting = cc_param["cc_p_phase_weighting"]
+    elif pick["phase"] == "S":
+        weighting = cc_param["cc_s_phase_weighting"]
+    else:
+        return None
+    network, station = pick["station_id"].split(".")
+    reason = None
+    for channel, weight in sorted(weighting.items()):
+        if weight == 0.0:
+            continue
+        traces = stream.select(network=network, station=station,
+                               channel="*%s" % channel)
+        channel_reason = assess_channel(traces, pick["pick_time"], cc_param,
+                                        quality_param)
+        if channel_reason is None:
+            return None
+        reason = reason or channel_reason
+    return reason
+
+
+def screen_picks(picks, find_data, read_waveform, cc_param, quality_param,
+                 cache_bytes=STREAM_CACHE_BYTES):
+    """
+    Returns a dictionary with the failure reason, "no_data" or None for
+    every pick by its id.
+
+    The picks are assessed in station and time order so their waveform
+    files are mostly served from an LRUStreamCache.
+
+    :param find_data: Function returning the waveform files of a station
+        and time span or False, see HypoDDRelocator._find_data().
+    :param read_waveform: Function returning the Stream of a waveform file.
+    :param quality_param: Dictionary with min_snr, min_coverage,
+        reject_gaps, reject_clipped and noise_length.
+    """
+    from obspy.core import Stream
+
+    cache = LRUStreamCache(read_waveform, max_bytes=cache_bytes)
+    window = cc_param["cc_time_before"] + cc_param["cc_time_after"]
+    noise_length = quality_param["noise_length"] or NOISE_WINDOWS * window
+    quality = {}
+    for pick in sorted(picks, key=lambda _i: (_i["station_id"],
+                                              _i["pick_time"])):
+        if pick["phase"] not in ("P", "S"):
+            quality[pick["id"]] = None
+            continue
+        # The same search as for the cross correlation decides about the
+        # data, files also covering the noise window are preferred.
+        data_files = find_data(
+            pick["station_id"],
+            pick["pick_time"] - cc_param["cc_time_before"], window)
+        if data_files is False:
+            quality[pick["id"]] = "no_data"
+            continue
+        data_files = find_data(
+            pick["station_id"],
+            pick["pick_time"] - cc_param["cc_time_before"] - noise_length,
+            noise_length + window) or data_files
+        stream = Stream()
+        for waveform_file in data_files:
+            stream += cache.get(waveform_file)
+        quality[pick["id"]] = assess_pick(pick, stream, cc_param,
+                                          quality_param)
+    return quality
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Cost estimates of a relocation before running it.
+
+All estimates only use the parsed events, stations and waveform index. Counts
+that would need the full ph2dt neighbour search are estimated from a random
+sample of events:
+
+    * For every sampled event the ph2dt neighbour selection is simulated:
+      neighbours within MAXSEP are visited in order of increasing distance,
+      pairs need MINOBS common picks and the search stops after MAXNGH strong
+      links.
+    * A pair selected from both of its events is only counted once by
+      weighting every selected pair with the inverse of the number of its
+      events that select it.
+    * The pick pairs of an event pair are all common picks (this is what is
+      cross correlated), the catalog observations are limited to MAXOBS.
+"""
+import math
+import random
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+# Rough conversion factor from degree to km.
+DEG2KM = 111.0
+
+# Data kept around every snippet for the taper and the filter in periods of
+# the lowest filter frequency.
+SNIPPET_PADDING_PERIODS = 1.0
+
+
+def _event_coordinates(events):
+    """
+    Local cartesian coordinates of all events in km.
+    """
+    latitudes = np.array([_i["origin_latitude"] for _i in events])
+    longitudes = np.array([_i["origin_longitude"] for _i in events])
+    depths = np.array([_i["origin_depth"] for _i in events]) / 1000.0
+    reference = latitudes.mean() if len(events) else 0.0
+    return np.column_stack([
+        longitudes * DEG2KM * math.cos(math.radians(reference)),
+        latitudes * DEG2KM, depths])
+
+
+def _pick_keys(event):
+    """
+    Set of (station_id, phase) of all P and S picks of an event.
+    """
+    return set((pick["station_id"], pick["phase"].upper())
+               for pick in event["picks"]
+               if pick["phase"].upper() in ("P", "S"))
+
+
+class _Ph2dtSimulation(object):
+    """
+    Simulates the neighbour selection of ph2dt for single events.
+    """
+    def __init__(self, events, values):
+        self.events = events
+        self.values = values
+        self.coordinates = _event_coordinates(events)
+        self.tree = cKDTree(self.coordinates) if len(events) else None
+        self._keys = {}
+        self._selections = {}
+
+    def keys(self, index):
+        if index not in self._keys:
+            self._keys[index] = _pick_keys(self.events[index])
+        return self._keys[index]
+
+    def selection(self, index):
+        """
+        Returns a list of (neighbour index, number of common picks) of all
+        pairs ph2dt would select for the event.
+        """
+        if index in self._selections:
+            return self._selections[index]
+        neighbours = np.array(self.tree.query_ball_point(
+            self.coordinates[index], self.values["MAXSEP"]), dtype=np.int64)
+        neighbours = neighbours[neighbours != index]
+        distances = np.sqrt(((self.coordinates[neighbours] -
+                              self.coordinates[index]) ** 2).sum(axis=1))
+        neighbours = neighbours[np.argsort(distances, kind="mergesort")]
+        selected = []
+        strong = 0
+        keys = self.keys(index)
+        for neighbour in neighbours:
+            if strong >= self.values["MAXNGH"]:
+                break
+            common = len(keys & self.keys(neighbour))
+            if common < self.values["MINOBS"]:
+                continue
+            selected.append((int(neighbour), common))
+            if min(common, self.values["MAXOBS"]) >= self.values["MINLNK"]:
+                strong += 1
+        self._selections[index] = selected
+        return selected
+
+
+def estimate_pairs(events, values, sample_size=1000, seed=12345):
+    """
+    Estimates the event pairs ph2dt selects and the observations and pick
+    pairs they contain from a random sample of events.
+
+    :param events: The events in the form of HypoDDRelocator.events.
+    :param values: The ph2dt control parameters MAXSEP, MAXNGH, MINLNK,
+        MINOBS and MAXOBS.
+    :param sample_size: Number of sampled events.
+
+    Returns a dictionary with the estimated "event_pairs", "pick_pairs",
+    "catalog_observations" and "linked_events" and the "sampled_events".
+    """
+    result = {"event_pairs": 0, "pick_pairs": 0, "catalog_observations": 0,
+              "linked_events": 0, "sampled_events": 0}
+    if len(events) < 2:
+        return result
+    simulation = _Ph2dtSimulation(events, values)
+    rng = random.Random(seed)
+    sample = rng.sample(range(len(events)), min(sample_size, len(events)))
+    event_pairs = pick_pairs = observations = 0.0
+    linked = 0
+    for index in sample:
+        selection = simulation.selection(index)
+        if selection:
+            linked += 1
+        for neighbour, common in selection:
+            reciprocal = any(_i == index
+                             for _i, _ in simulation.selection(neighbour))
+            weight = 0.5 if reciprocal else 1.0
+            event_pairs += weight
+            pick_pairs += weight * common
+            observations += weight * min(common, values["MAXOBS"])
+    factor = len(events) / float(len(sample))
+    result.update({
+        "event_pairs": int(round(event_pairs * factor)),
+        "pick_pairs": int(round(pick_pairs * factor)),
+        "catalog_observations": int(round(observations * factor)),
+        "linked_events": int(round(linked * factor)),
+        "sampled_events": len(sample)})
+    return result
+
+
+def estimate_maxsep(events, sample_size=100000, seed=12345):
+    """
+    Estimates the automatically determined MAXSEP, the 10-percentile of all
+    inter-event distances, from a random sample of event pairs. Uses the
+    same distance measure as HypoDDRelocator._get_ph2dt_values().
+    """
+    rng = random.Random(seed)
+    distances = []
+    for _ in range(sample_size):
+        event_1 = events[rng.randrange(len(events))]
+        event_2 = events[rng.randrange(len(events))]
+        lat_range = abs(event_1["origin_latitude"] -
+                        event_2["origin_latitude"]) * 111.0
+        long_range = abs(event_1["origin_longitude"] -
+                         event_2["origin_longitude"]) * 111.0
+        depth_range = abs(event_1["origin_depth"] - event_2["origin_depth"])
+        distances.append(math.sqrt(lat_range ** 2 + long_range ** 2 +
+                                   depth_range ** 2))
+    distances.sort()
+    return distances[int(math.floor(len(distances) * 0.10))]
+
+
+def snippet_bytes(cc_param, sampling_rate):
+    """
+    Bytes of a single float32 snippet of one channel around a pick including
+    the maximum lag and the padding for the taper and the filter.
+    """
+    length = cc_param["cc_time_before"] + cc_param["cc_time_after"] + \
+        2 * cc_param["cc_maxlag"] + \
+        2 * SNIPPET_PADDING_PERIODS / cc_param["cc_filter_min_freq"]
+    return int(math.ceil(length * sampling_rate)) * 4
+
+
+def recommend_workers(event_count, required_memory, memory_budget,
+                      cpu_count, max_neighbours=10, max_observations=50):
+    """
+    Recommends how to run the relocation.
+
+    Returns a dictionary with the recommended "method" and, for tiled
+    relocations, the "processes" and "max_events_per_tile".
+    """
+    from hypodd_tiling import estimate_tile_capacity
+
+    if required_memory <= memory_budget:
+        return {"method": "start_relocation"}
+    # Use as many parallel tiles as possible as long as every tile still
+    # holds a reasonable number of events.
+    for processes in range(cpu_count, 0, -1):
+        try:
+            capacity = estimate_tile_capacity(
+                memory_budget / float(processes),
+                max_neighbours=max_neighbours,
+                max_observations=max_observations)
+        except ValueError:
+            continue
+        if capacity >= min(event_count, 1000) or processes == 1:
+            break
+    else:
+        return {"method": "start_tiled_relocation", "processes": 1,
+                "max_events_per_tile": None,
+                "warning": "The memory budget is too small for any tile."}
+    return {"method": "start_tiled_relocation",
+            "processes": min(processes, int(math.ceil(
+                event_count / float(capacity)))),
+            "max_events_per_tile": min(capacity, event_count)}
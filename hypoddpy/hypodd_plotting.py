@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Location plots of the original and relocated events.
+
+All coordinates are passed as NumPy arrays. The rendering method is chosen
+from the number of events:
+
+    * "scatter": Vector scatter plots. Only suitable for small catalogs.
+    * "rasterized": Scatter plots rasterized inside the PDF. Files stay small
+      and open quickly for up to some 100k events.
+    * "density": 2D histograms of the event density. Independent of the
+      number of events but loses the cluster coloring.
+"""
+import numpy as np
+
+
+# Maximum number of events for the vector and rasterized plot styles.
+MAX_SCATTER_EVENTS = 5000
+MAX_RASTERIZED_EVENTS = 200000
+
+PLOT_STYLES = ["auto", "scatter", "rasterized", "density"]
+
+
+def choose_plot_style(event_count, plot_style="auto"):
+    """
+    Returns the plot style to use for event_count events.
+    """
+    if plot_style not in PLOT_STYLES:
+        msg = "plot_style has to be one of %s." % ", ".join(PLOT_STYLES)
+        raise ValueError(msg)
+    if plot_style != "auto":
+        return plot_style
+    if event_count <= MAX_SCATTER_EVENTS:
+        return "scatter"
+    if event_count <= MAX_RASTERIZED_EVENTS:
+        return "rasterized"
+    return "density"
+
+
+def _limits(values):
+    """
+    Returns the plot limits for an array of values with a 5 percent margin.
+    """
+    if not len(values):
+        return (0.0, 1.0)
+    low, high = float(np.nanmin(values)), float(np.nanmax(values))
+    margin = max((high - low) * 0.05, 1E-3)
+    return (low - margin, high + margin)
+
+
+def _plot_panel(axis, x, y, colors, style, limits, xlabel, ylabel):
+    if style == "density":
+        axis.hist2d(x, y, bins=200, range=[sorted(_i) for _i in limits],
+                    cmap="Greys", cmin=1)
+    else:
+        size = 20 if style == "scatter" else 2
+        axis.scatter(x, y, c=colors, s=size, lw=0,
+                     rasterized=(style == "rasterized"))
+    axis.set_xlim(limits[0])
+    axis.set_ylim(limits[1])
+    axis.set_xlabel(xlabel)
+    axis.set_ylabel(ylabel)
+
+
+def render_location_plots(original, relocated, cluster_ids, filenames,
+                          plot_style="auto"):
+    """
+    Renders the original and the relocated event locations to two files.
+
+    The limits of the relocated plot are the same as for the original one.
+
+    :param original: Tuple of latitude, longitude and depth (km) arrays of the
+        original locations.
+    :param relocated: Same for the relocated locations. Events that have not
+        been relocated should have their original location.
+    :param cluster_ids: Array with the HypoDD cluster id of every event. Not
+        relocated events have a negative cluster id.
+    :param filenames: Tuple of the output filenames for the original and the
+        relocated plot.
+    :param plot_style: One of "auto", "scatter", "rasterized" or "density".
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import ColorConverter
+
+    style = choose_plot_style(len(cluster_ids), plot_style)
+    # The colors will be used to distinguish between different event types.
+    # grey: event will/have not been relocated.
+    # Otherwise: the color of the cluster id.
+    cmap = plt.get_cmap("Paired", 12)
+    colors = cmap(np.clip(cluster_ids, 0, 11))
+    colors[cluster_ids < 0] = ColorConverter().to_rgba("grey")
+
+    latitudes, longitudes, depths = original
+    # Depth axes are inverted.
+    limits = [(_limits(latitudes), _limits(depths)[::-1]),
+              (_limits(longitudes), _limits(depths)[::-1]),
+              (_limits(longitudes), _limits(latitudes))]
+    for (latitudes, longitudes, depths), filename in \
+            zip((original, relocated), filenames):
+        figure = plt.figure()
+        _plot_panel(figure.add_subplot(221), latitudes, depths, colors,
+                    style, limits[0], "Latitude", "Depth in km")
+        _plot_panel(figure.add_subplot(222), longitudes, depths, colors,
+                    style, limits[1], "Longitude", "Depth in km")
+        _plot_panel(figure.add_subplot(212), longitudes, latitudes, colors,
+                    style, limits[2], "Longitude", "Latitude")
+        figure.savefig(filename, dpi=150)
+        plt.close(figure)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Event by event reading and writing of QuakeML files.
+
+Reading a whole catalog into an ObsPy Catalog object and writing it at once
+needs a lot of memory for big catalogs. The functions in here only ever hold
+a single event in memory.
+"""
+import os
+
+from lxml import etree
+from obspy.core.event import Catalog, read_events, ResourceIdentifier
+from obspy.io.quakeml.core import Pickler, Unpickler
+
+
+QUAKEML_NAMESPACE = "http://quakeml.org/xmlns/quakeml/1.2"
+BED_NAMESPACE = "http://quakeml.org/xmlns/bed/1.2"
+
+DOCUMENT_HEADER = \
+    "<?xml version='1.0' encoding='utf-8'?>\n" + \
+    "<q:quakeml xmlns:q=\"%s\" xmlns=\"%s\">\n" % (QUAKEML_NAMESPACE,
+                                                    BED_NAMESPACE) + \
+    "  <eventParameters publicID=\"%s\">\n"
+DOCUMENT_FOOTER = "  </eventParameters>\n</q:quakeml>\n"
+
+
+def is_quakeml(filename):
+    """
+    Returns True if the root element of the file is a QuakeML 1.2 document.
+    Only the first element is parsed.
+    """
+    try:
+        # Opened here so the file is closed after the first element.
+        with open(filename, "rb") as open_file:
+            for _, element in etree.iterparse(open_file, events=("start",)):
+                return element.tag == "{%s}quakeml" % QUAKEML_NAMESPACE
+    except (etree.XMLSyntaxError, IOError):
+        pass
+    return False
+
+
+def iter_events(filename):
+    """
+    Yields all events in an event file one at a time.
+
+    QuakeML files are parsed incrementally. Every other format ObsPy can read
+    is read as a whole and then yielded event by event.
+    """
+    if not is_quakeml(filename):
+        for event in read_events(filename):
+            yield event
+        return
+    for _, element in etree.iterparse(filename, events=("end",),
+                                      tag="{%s}event" % BED_NAMESPACE):
+        document = (DOCUMENT_HEADER % "smi:local/streaming_reader") + \
+            etree.tostring(element).decode("utf-8") + DOCUMENT_FOOTER
+        catalog = Unpickler().loads(document.encode("utf-8"))
+        # Free the memory of the already parsed elements.
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+        for event in catalog:
+            yield event
+
+
+class QuakeMLStreamWriter(object):
+    """
+    Writes a QuakeML file one event at a time.
+
+    The events are written to filename + ".tmp" which is renamed to filename
+    once all events are written. If an exception is raised while writing,
+    the temporary file is removed and filename is not touched.
+
+    Usage
+    =====
+
+    >>> with QuakeMLStreamWriter("events.xml") as writer:
+    ...     for event in events:
+    ...         writer.write(event)
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.count = 0
+
+    def __enter__(self):
+        self.file = open(self.filename + ".tmp", "wb")
+        self.file.write((DOCUMENT_HEADER %
+                         str(ResourceIdentifier())).encode("utf-8"))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.file.close()
+            os.remove(self.filename + ".tmp")
+            return
+        self.file.write(DOCUMENT_FOOTER.encode("utf-8"))
+        self.file.close()
+        os.rename(self.filename + ".tmp", self.filename)
+
+    def write(self, event):
+        """
+        Serializes a single event and appends it to the file.
+        """
+        document = Pickler().dumps(Catalog(events=[event]))
+        root = etree.fromstring(document)
+        for element in root.iter("{%s}event" % BED_NAMESPACE):
+            self.file.write(etree.tostring(element, pretty_print=True))
+        self.count += 1
@@ -1,32 +1,92 @@
 import copy
 import fnmatch
-import glob
+import hashlib
+import itertools
 import json
 import logging
 import math
-from obspy.core import read, Stream, UTCDateTime
-from obspy.core.event import Catalog, Comment, Origin, read_events, \
-    ResourceIdentifier
-from obspy.signal.cross_correlation import xcorr_pick_correction
-from obspy.io.xseed import Parser
 import os
-import progressbar
 import shutil
-import subprocess
 import sys
 import warnings
 
 from hypodd_compiler import HypoDDCompiler
+from hypodd_external import parse_hypodd_log, run_external
+from hypodd_logging import AsyncLog, LogAggregator
+from hypodd_report import RunReport
+from hypodd_sizing import hypodd_array_sizes, read_link_statistics
+from hypodd_tiling import estimate_tile_capacity, \
+    partition_events_into_tiles, partition_events_into_time_windows, \
+    tile_centrality, time_window_centrality, _try_relocate_tile
 
 
 class HypoDDException(Exception):
     pass
 
 
+# Prefix of the waveform ids of in-memory streams.
+MEMORY_PREFIX = "memory://"
+
+# The in-memory streams of the relocator whose subset or shard worker pool is
+# running. Only set while the pool runs so the relocators in the forked
+# workers see them and they are released afterwards.
+_INHERITED_MEMORY_STREAMS = {}
+
+# Formats of the compact origin files next to the output event file.
+ORIGIN_SIDECAR_FORMATS = (None, "csv", "npz")
+
+
+def _memory_stream_id(stream):
+    """
+    Returns the waveform id of an in-memory stream. It is derived from the
+    content of the stream so that it stays the same across sessions and
+    relocators and never refers to another stream.
+    """
+    import numpy as np
+
+    content_hash = hashlib.md5()
+    for trace in stream:
+        content_hash.update(("%s|%s|%s|%i|%r|%s|" % (
+            trace.id, trace.stats.starttime, trace.stats.endtime,
+            trace.stats.npts, trace.stats.sampling_rate,
+            trace.data.dtype.str)).encode("utf-8"))
+        content_hash.update(np.ascontiguousarray(trace.data))
+    return "%s%s" % (MEMORY_PREFIX, content_hash.hexdigest())
+
+
+def _serialize_events(events, filename):
+    """
+    Serialize a list of event dictionaries as a JSON file. All times are
+    converted to strings.
+    """
+    events = copy.deepcopy(events)
+    for event in events:
+        event["origin_time"] = str(event["origin_time"])
+        for pick in event["picks"]:
+            pick["pick_time"] = str(pick["pick_time"])
+    with open(filename, "w") as open_file:
+        json.dump(events, open_file)
+
+
+def _serialize_waveform_information(waveform_information, filename):
+    """
+    Serialize the waveform information dictionary as a JSON file. All times
+    are converted to strings.
+    """
+    waveform_information = copy.deepcopy(waveform_information)
+    for value in waveform_information.values():
+        for item in value:
+            item["starttime"] = str(item["starttime"])
+            item["endtime"] = str(item["endtime"])
+    with open(filename, "w") as open_file:
+        json.dump(waveform_information, open_file)
+
+
 class HypoDDRelocator(object):
     def __init__(self, working_dir, cc_time_before, cc_time_after, cc_maxlag,
                  cc_filter_min_freq, cc_filter_max_freq, cc_p_phase_weighting,
-                 cc_s_phase_weighting, cc_min_allowed_cross_corr_coeff):
+                 cc_s_phase_weighting, cc_min_allowed_cross_corr_coeff,
+                 cc_coarse_to_fine=False):
         """
         :param working_dir: The working directory where all temporary and final
             files will be placed.
@@ -55,6 +115,10 @@ class HypoDDRelocator(object):
         :param cc_min_allowed_cross_corr_coeff: The minimum allowed
             cross-correlation coefficient for a differential travel time to be
             accepted.
+        :param cc_coarse_to_fine: If True, the lag is searched on decimated
+            data first and refined at the full sampling rate only around the
+            peak, see hypodd_lag_search. Faster for large cc_maxlag on data
+            sampled far above cc_filter_max_freq. Defaults to False.
         """
         self.working_dir = working_dir
         if not os.path.exists(working_dir):
@@ -84,6 +148,10 @@ class HypoDDRelocator(object):
             "cc_p_phase_weighting": cc_p_phase_weighting,
             "cc_s_phase_weighting": cc_s_phase_weighting,
             "cc_min_allowed_cross_corr_coeff": cc_min_allowed_cross_corr_coeff}
+        # Only recorded if enabled so the keys of existing caches and shard
+        # manifests stay valid.
+        if cc_coarse_to_fine:
+            self.cc_param["cc_coarse_to_fine"] = True
         self.cc_results = {}
 
         # Setup logging.
@@ -94,16 +162,49 @@ class HypoDDRelocator(object):
         self.event_files = []
         self.station_files = []
         self.waveform_files = []
+        # In-memory ObsPy catalogs and inventories.
+        self.catalogs = []
+        self.inventories = []
+        # Streams added with add_streams() by their waveform id.
+        self.memory_streams = {}
 
         # Dictionary to store forced configuration values.
         self.forced_configuration_values = {}
 
+        # hypoDD and ph2dt executables to use instead of compiling them.
+        self.external_binaries = {}
+        # Directory of compilations shared with other relocations.
+        self.binary_cache_dir = None
+
+        # Number of processes cross correlating the pick pairs. With more
+        # than one process the decoded waveforms are shared in
+        # cc_shared_dir, see hypodd_cross_correlation.SharedWaveformStore.
+        self.cc_processes = 1
+        self.cc_shared_dir = os.path.join(self.working_dir, "working_files",
+                                          "cc_shared")
+        # Seconds the cross correlation may take. If set, the pick pairs
+        # are correlated by priority until the budget is used up, see
+        # hypodd_cc_priority.
+        self.cc_time_budget = None
+        # Thresholds of the pick quality screen, see
+        # setup_pick_quality_screen(), and the ids of the excluded picks.
+        self.pick_quality_param = None
+        self.excluded_picks = set()
+
+        # Parsed station files by the hash of their content.
+        self.station_cache_file = os.path.join(
+            self.working_dir, "working_files", "station_file_cache.json")
+
+        # Stage timings and hot path counters.
+        self.report = RunReport()
+
         # Configure the paths.
         self._configure_paths()
 
     def start_relocation(self, output_event_file,
                          output_cross_correlation_file=None,
-                         create_plots=True):
+                         create_plots=True, origin_sidecar=None,
+                         plot_style="auto"):
         """
         Start the relocation with HypoDD and write the output to
         output_event_file.
@@ -115,7 +216,14 @@ class HypoDDRelocator(object):
         :type output_cross_correlation_file: str
         :param create_plots: If true, some plots will be created in
             working_dir/output_files. Defaults to True.
+        :param origin_sidecar: If "csv" or "npz", the relocated origins are
+            also written to a compact file next to output_event_file.
+        :param plot_style: One of "auto", "scatter", "rasterized" or
+            "density", see the hypodd_plotting module. "auto" chooses
+            depending on the number of events.
         """
+        self._check_origin_sidecar(origin_sidecar)
+        self._check_plot_style(plot_style)
         self.output_event_file = output_event_file
         if os.path.exists(self.output_event_file):
             msg = "The output_event_file already exists. Nothing to do."
@@ -123,21 +231,691 @@ class HypoDDRelocator(object):
             return
 
         self.log("Starting relocator...")
+        stages = self._preparation_stages() + [
+            (self._cross_correlate_picks,
+             {"outfile": output_cross_correlation_file}),
+            (self._resize_hypodd, {}),
+            (self._write_hypoDD_inp_file, {}),
+            (self._run_hypodd, {}),
+            (self._create_output_event_file,
+             {"origin_sidecar": origin_sidecar})]
+        if create_plots:
+            stages.append((self._create_plots, {"plot_style": plot_style}))
+        self._run_stages(stages)
+
+    def _preparation_stages(self):
+        """
+        Returns the stages up to the cross correlation.
+        """
+        return [
+            (self._parse_station_files, {}),
+            (self._write_station_input_file, {}),
+            (self._read_event_information, {}),
+            (self._write_ph2dt_inp_file, {}),
+            (self._create_event_id_map, {}),
+            (self._write_catalog_input_file, {}),
+            (self._compile_hypodd, {}),
+            (self._run_ph2dt, {}),
+            (self._parse_waveform_files, {}),
+            (self._screen_picks, {})]
+
+    def _run_stages(self, stages, report_file=None):
+        """
+        Runs all stages and records them in the run report which is written
+        to working_dir/run_report.json, also if a stage fails.
+
+        :param stages: List of (method, kwargs) tuples. The stage names are
+            the method names without the leading underscore.
+        :param report_file: Write the run report to this file instead.
+        """
+        try:
+            for method, kwargs in stages:
+                with self.report.stage(method.__name__.lstrip("_")):
+                    method(**kwargs)
+        finally:
+            if report_file is None:
+                report_file = os.path.join(self.working_dir,
+                                           "run_report.json")
+            self.report.write(report_file)
+            self.log("Wrote run report to %s." % report_file)
+
+    def plan(self, sample_size=1000, memory_budget=None, cpu_count=None):
+        """
+        Estimates the size of the relocation without running it. Only the
+        station, event and waveform files are parsed and serialized as in a
+        normal run. Estimates that would need the ph2dt neighbour search are
+        made from a sample of the events, see hypodd_planner.
+
+        :param sample_size: Number of sampled events and picks.
+        :param memory_budget: Memory available for HypoDD in bytes. Defaults
+            to the physical memory.
+        :param cpu_count: Number of available CPUs. Defaults to all CPUs.
+
+        Returns a dictionary with the estimates and recommendations. It is
+        also written to working_dir/plan.json.
+        """
+        import multiprocessing
+        import random
+        from hypodd_planner import estimate_pairs, recommend_workers, \
+            snippet_bytes
+        from hypodd_tiling import estimate_hypodd_memory
+
         self._parse_station_files()
-        self._write_station_input_file()
         self._read_event_information()
-        self._write_ph2dt_inp_file()
-        self._create_event_id_map()
-        self._write_catalog_input_file()
-        self._compile_hypodd()
-        self._run_ph2dt()
         self._parse_waveform_files()
-        self._cross_correlate_picks(outfile=output_cross_correlation_file)
-        self._write_hypoDD_inp_file()
-        self._run_hypodd()
-        self._create_output_event_file()
+        if memory_budget is None:
+            memory_budget = os.sysconf("SC_PAGE_SIZE") * \
+                os.sysconf("SC_PHYS_PAGES")
+        if cpu_count is None:
+            cpu_count = multiprocessing.cpu_count()
+
+        self.log("Estimating the event pairs from %i sampled events..." %
+                 min(sample_size, len(self.events)))
+        values = self._get_ph2dt_values(maxsep_sample_size=100 * sample_size)
+        pairs = estimate_pairs(self.events, values, sample_size=sample_size)
+
+        # Number of correlated channels per pick.
+        channels = {}
+        for phase in ["P", "S"]:
+            weighting = self.cc_param["cc_%s_phase_weighting" % phase.lower()]
+            channels[phase] = len([_i for _i in weighting.values() if _i])
+        picks = [pick for event in self.events for pick in event["picks"]
+                 if pick["phase"].upper() in channels]
+        mean_channels = sum(channels[pick["phase"].upper()]
+                            for pick in picks) / float(max(len(picks), 1))
+
+        # Bytes of the waveform files read per pick and their sampling rate.
+        window = self.cc_param["cc_time_before"] + \
+            self.cc_param["cc_time_after"]
+        rng = random.Random(12345)
+        file_sizes = {}
+        bytes_per_pick = []
+        for pick in rng.sample(picks, min(sample_size, len(picks))):
+            filenames = self._find_data(
+                pick["station_id"],
+                pick["pick_time"] - self.cc_param["cc_time_before"], window)
+            if filenames is False:
+                bytes_per_pick.append(0)
+                continue
+            for filename in filenames:
+                if filename not in file_sizes:
+                    file_sizes[filename] = self._get_waveform_size(filename)
+            bytes_per_pick.append(sum(file_sizes[_i] for _i in filenames))
+        sampling_rate = 0.0
+        for filename in sorted(file_sizes)[:10]:
+            for trace in self._read_waveform(filename, headonly=True):
+                sampling_rate = max(sampling_rate, trace.stats.sampling_rate)
+        indexed_files = set(item["filename"]
+                            for items in self.waveform_information.values()
+                            for item in items)
+        # Picks of all linked events.
+        linked_picks = len(picks) * pairs["linked_events"] / \
+            float(max(len(self.events), 1))
+
+        configured_sizes = self._get_hypodd_array_sizes(len(self.events))
+        # The cluster structure is unknown. Assume a single cluster.
+        observations = pairs["catalog_observations"] + pairs["pick_pairs"]
+        required_sizes = self._get_hypodd_array_sizes(
+            pairs["linked_events"], statistics={
+                "observations": observations,
+                "clusters": [(pairs["linked_events"], observations)]})
+        required_memory = estimate_hypodd_memory(**required_sizes)
+
+        plan = {
+            "events": len(self.events),
+            "stations": len(self.stations),
+            "picks": len(picks),
+            "ph2dt_values": values,
+            "sampled_events": pairs["sampled_events"],
+            "event_pairs": pairs["event_pairs"],
+            "linked_events": pairs["linked_events"],
+            "catalog_observations": pairs["catalog_observations"],
+            "pick_pairs": pairs["pick_pairs"],
+            "cross_correlations": int(pairs["pick_pairs"] * mean_channels),
+            "waveform_files": len(indexed_files),
+            "waveform_bytes_indexed": sum(
+                self._get_waveform_size(_i) for _i in indexed_files
+                if _i.startswith(MEMORY_PREFIX) or os.path.exists(_i)),
+            # Every pick pair reads the files of both picks.
+            "waveform_bytes_read": int(2 * pairs["pick_pairs"] * sum(
+                bytes_per_pick) / float(max(len(bytes_per_pick), 1))),
+            "sampling_rate": sampling_rate,
+            "snippet_store_bytes": int(
+                linked_picks * mean_channels *
+                snippet_bytes(self.cc_param, sampling_rate)),
+            "configured_hypodd_array_sizes": configured_sizes,
+            "configured_hypodd_memory": estimate_hypodd_memory(
+                **configured_sizes),
+            "required_hypodd_array_sizes": required_sizes,
+            "required_hypodd_memory": required_memory,
+            "memory_budget": memory_budget,
+            "cpu_count": cpu_count}
+        plan["recommendation"] = recommend_workers(
+            len(self.events), required_memory, memory_budget, cpu_count,
+            max_neighbours=values["MAXNGH"],
+            max_observations=values["MAXOBS"])
+
+        for key in ["event_pairs", "pick_pairs", "cross_correlations",
+                    "waveform_bytes_read", "snippet_store_bytes",
+                    "required_hypodd_memory"]:
+            self.log("Estimated %s: %i" % (key.replace("_", " "), plan[key]))
+        self.log("Recommendation: %s" % json.dumps(plan["recommendation"]))
+        plan_file = os.path.join(self.working_dir, "plan.json")
+        with open(plan_file, "w") as open_file:
+            json.dump(plan, open_file, indent=2, sort_keys=True)
+        self.log("Wrote plan to %s." % plan_file)
+        return plan
+
+    def start_tiled_relocation(self, output_event_file, max_events_per_tile=None,
+                               tile_memory_budget=None, tile_overlap=5.0,
+                               processes=None,
+                               output_cross_correlation_file=None,
+                               create_plots=True, origin_sidecar=None,
+                               plot_style="auto"):
+        """
+        Relocate a very large catalog by cutting it into overlapping spatial
+        tiles that are relocated independently and in parallel. Every tile has
+        its own ph2dt, cross correlation and HypoDD run in
+        working_dir/tiles/XXXX. The final location of every event is
+        taken from the tile in which it is most central. MAXSEP is
+        determined once for the whole catalog. If a tile fails, its error is
+        logged and the results of all other tiles are still stitched.
+
+        :type output_event_file: str
+        :param output_event_file: The filename of the final QuakeML file.
+        :param max_events_per_tile: The maximum number of events in a tile,
+            including the overlap margin.
+        :param tile_memory_budget: Alternatively to max_events_per_tile, the
+            memory in bytes available for a single HypoDD run. The number of
+            events per tile will be estimated from it. HypoDD is recompiled
+            in every tile with arrays sized for its actual data.
+        :param tile_overlap: Width of the overlap margin around the core of
+            each tile in km. Should be at least MAXSEP.
+        :param processes: Number of tiles relocated in parallel. Defaults to
+            the number of CPUs.
+        :param output_cross_correlation_file: Filename of the merged cross
+            correlation results of all tiles.
+        :param create_plots: If true, some plots will be created in
+            working_dir/output_files. Defaults to True.
+        :param origin_sidecar: If "csv" or "npz", the relocated origins are
+            also written to a compact file next to output_event_file.
+        :param plot_style: One of "auto", "scatter", "rasterized" or
+            "density", see the hypodd_plotting module. "auto" chooses
+            depending on the number of events.
+        """
+        self._check_origin_sidecar(origin_sidecar)
+        self._check_plot_style(plot_style)
+        self.output_event_file = output_event_file
+        if os.path.exists(self.output_event_file):
+            msg = "The output_event_file already exists. Nothing to do."
+            self.log(msg)
+            return
+        if max_events_per_tile is None:
+            if tile_memory_budget is None:
+                msg = "Either max_events_per_tile or tile_memory_budget " + \
+                    "has to be given."
+                raise HypoDDException(msg)
+            max_events_per_tile = estimate_tile_capacity(tile_memory_budget)
+
+        self.log("Starting tiled relocator...")
+        stages = [
+            (self._parse_station_files, {}),
+            (self._read_event_information, {}),
+            (self._create_event_id_map, {}),
+            (self._parse_waveform_files, {}),
+            (self._relocate_tiles,
+             {"max_events_per_tile": max_events_per_tile,
+              "tile_overlap": tile_overlap, "processes": processes,
+              "output_cross_correlation_file":
+              output_cross_correlation_file}),
+            (self._create_output_event_file,
+             {"origin_sidecar": origin_sidecar})]
+        if create_plots:
+            stages.append((self._create_plots, {"plot_style": plot_style}))
+        self._run_stages(stages)
+
+    def _relocate_tiles(self, max_events_per_tile, tile_overlap,
+                        processes=None, output_cross_correlation_file=None):
+        """
+        Partitions the events into spatial tiles and relocates them, see
+        start_tiled_relocation().
+        """
+        tiles = partition_events_into_tiles(
+            self.events, max_events_per_tile=max_events_per_tile,
+            overlap=tile_overlap)
+        self.log("Partitioned %i events into %i tiles." %
+                 (len(self.events), len(tiles)))
+        largest_tile = max(len(tile["events"]) for tile in tiles)
+        if largest_tile > max_events_per_tile:
+            msg = "The densest tile holds %i events which is more than " + \
+                "the requested maximum of %i."
+            self.log(msg % (largest_tile, max_events_per_tile),
+                     level="warning")
+
+        # Compile once for the largest tile and share the binaries. Every tile
+        # resizes hypoDD for its data before running it.
+        self._compile_hypodd(event_count=largest_tile)
+
+        # Keep every event from the tile where it is most central.
+        def centrality(tile, event, items):
+            return tile_centrality(tile, float(items[1]), float(items[2]))
+
+        self._relocate_subsets(
+            tiles, subset_dir="tiles", centrality=centrality,
+            processes=processes,
+            output_cross_correlation_file=output_cross_correlation_file)
+
+    def start_time_windowed_relocation(self, output_event_file,
+                                       window_length, window_overlap,
+                                       processes=None,
+                                       output_cross_correlation_file=None,
+                                       create_plots=True,
+                                       origin_sidecar=None,
+                                       plot_style="auto"):
+        """
+        Relocate a long catalog in overlapping time windows that are relocated
+        independently and in parallel in working_dir/time_windows/XXXX.
+        All windows share the parsed waveform information. Windows are run in
+        two waves (every other window) so that windows of the second wave
+        reuse the cross correlations of the overlapping windows of the first
+        wave. The final location of every event is taken from the window in
+        which it is most central. As for start_tiled_relocation(), MAXSEP is
+        determined once for the whole catalog and failing windows do not
+        abort the relocation.
+
+        :type output_event_file: str
+        :param output_event_file: The filename of the final QuakeML file.
+        :param window_length: The length of each time window in seconds.
+        :param window_overlap: The overlap of neighbouring time windows in
+            seconds. Must be less than half the window_length.
+        :param processes: Number of windows relocated in parallel. Defaults to
+            the number of CPUs.
+        :param output_cross_correlation_file: Filename of the merged cross
+            correlation results of all windows.
+        :param create_plots: If true, some plots will be created in
+            working_dir/output_files. Defaults to True.
+        :param origin_sidecar: If "csv" or "npz", the relocated origins are
+            also written to a compact file next to output_event_file.
+        :param plot_style: One of "auto", "scatter", "rasterized" or
+            "density", see the hypodd_plotting module. "auto" chooses
+            depending on the number of events.
+        """
+        self._check_origin_sidecar(origin_sidecar)
+        self._check_plot_style(plot_style)
+        self.output_event_file = output_event_file
+        if os.path.exists(self.output_event_file):
+            msg = "The output_event_file already exists. Nothing to do."
+            self.log(msg)
+            return
+        if not 0 <= window_overlap < window_length / 2.0:
+            msg = "window_overlap has to be less than half the window_length."
+            raise HypoDDException(msg)
+
+        self.log("Starting time windowed relocator...")
+        stages = [
+            (self._parse_station_files, {}),
+            (self._read_event_information, {}),
+            (self._create_event_id_map, {}),
+            (self._parse_waveform_files, {}),
+            (self._relocate_time_windows,
+             {"window_length": window_length,
+              "window_overlap": window_overlap, "processes": processes,
+              "output_cross_correlation_file":
+              output_cross_correlation_file}),
+            (self._create_output_event_file,
+             {"origin_sidecar": origin_sidecar})]
         if create_plots:
-            self._create_plots()
+            stages.append((self._create_plots, {"plot_style": plot_style}))
+        self._run_stages(stages)
+
+    def _relocate_time_windows(self, window_length, window_overlap,
+                               processes=None,
+                               output_cross_correlation_file=None):
+        """
+        Partitions the events into overlapping time windows and relocates
+        them, see start_time_windowed_relocation().
+        """
+        windows = partition_events_into_time_windows(
+            self.events, window_length=window_length, overlap=window_overlap)
+        self.log("Partitioned %i events into %i time windows." %
+                 (len(self.events), len(windows)))
+        self._compile_hypodd(
+            event_count=max(len(window["events"]) for window in windows))
+
+        def centrality(window, event, items):
+            return time_window_centrality(window, event["origin_time"])
+
+        self._relocate_subsets(
+            windows, subset_dir="time_windows", centrality=centrality,
+            processes=processes,
+            output_cross_correlation_file=output_cross_correlation_file,
+            share_cc_results=True)
+
+    def _relocate_subsets(self, subsets, subset_dir, centrality,
+                          processes=None, output_cross_correlation_file=None,
+                          share_cc_results=False):
+        """
+        Relocates all subsets of the events in parallel and stitches the
+        results in working_dir/output_files/hypoDD.reloc.
+
+        MAXSEP is determined once for the whole catalog and used in every
+        subset. A failing subset is logged and its events are left out of
+        the stitched results. Raises a HypoDDException if all subsets fail.
+
+        :param subsets: List of dictionaries, each with at least an "events"
+            key.
+        :param subset_dir: Subfolder of the working dir for all subsets.
+        :param centrality: Function called with the subset, the event
+            dictionary and the split hypoDD.reloc line of the event. Each
+            event keeps the solution with the smallest returned value.
+        :param processes: Number of subsets relocated in parallel.
+        :param output_cross_correlation_file: Filename of the merged cross
+            correlation results of all subsets.
+        :param share_cc_results: If True, subsets are relocated in two waves
+            and every subset of the second wave preloads the cross correlation
+            results of its neighbours from the first wave. Only useful if
+            subsets overlap only with their direct neighbours.
+        """
+        from hypodd_planner import estimate_maxsep
+
+        forced_configuration_values = dict(self.forced_configuration_values)
+        if "MAXSEP" not in forced_configuration_values:
+            # Estimated from a sample of event pairs as the exact percentile
+            # is quadratic in the number of events.
+            forced_configuration_values["MAXSEP"] = \
+                estimate_maxsep(self.events)
+            self.log("MAXSEP for all subsets estimated to %f." %
+                     forced_configuration_values["MAXSEP"])
+
+        specs = []
+        for _i, subset in enumerate(subsets):
+            working_dir = os.path.join(self.working_dir, subset_dir,
+                                       "%04i" % (_i + 1))
+            self._setup_subset_working_dir(working_dir, subset["events"])
+            specs.append({
+                "working_dir": working_dir,
+                "cc_param": self.cc_param,
+                "forced_configuration_values": forced_configuration_values,
+                "forward_model_string": self._get_forward_model_string(),
+                "external_binaries": self.external_binaries,
+                "binary_cache_dir": self.binary_cache_dir,
+                "pick_quality_param": self.pick_quality_param,
+                "output_cross_correlation_file":
+                os.path.join(working_dir, "cc_results.json")
+                if output_cross_correlation_file or share_cc_results
+                else None,
+                "cc_results_files": []})
+        if share_cc_results:
+            for _i in range(1, len(specs), 2):
+                specs[_i]["cc_results_files"] = [
+                    specs[_j]["output_cross_correlation_file"]
+                    for _j in (_i - 1, _i + 1) if _j < len(specs)]
+            waves = [range(0, len(specs), 2), range(1, len(specs), 2)]
+        else:
+            waves = [range(len(specs))]
+
+        self.log("Relocating %i subsets in %s..." % (len(specs), subset_dir))
+        results = [None] * len(specs)
+        failed = []
+        pool = self._start_worker_pool(processes)
+        try:
+            for wave in waves:
+                wave_results = pool.map(_try_relocate_tile,
+                                        [specs[_i] for _i in wave])
+                for _i, (result, error) in zip(wave, wave_results):
+                    if error is not None:
+                        self.log("Relocation in %s failed: %s" %
+                                 (specs[_i]["working_dir"], error),
+                                 level="error")
+                        failed.append(_i)
+                        result = []
+                    results[_i] = result
+        finally:
+            self._stop_worker_pool(pool)
+        self.report.increment("subsets_relocated", len(specs) - len(failed))
+        self.report.increment("subsets_failed", len(failed))
+        if specs and len(failed) == len(specs):
+            msg = "The relocation of all %i subsets failed." % len(specs)
+            raise HypoDDException(msg)
+
+        events = dict((event["event_id"], event) for event in self.events)
+        best = {}
+        for subset, subset_results in zip(subsets, results):
+            for event_id, line in subset_results:
+                items = line.split()
+                value = centrality(subset, events[event_id], items)
+                if event_id in best and best[event_id][0] <= value:
+                    continue
+                best[event_id] = (value, items)
+        self.log("Stitched %i relocated events from %i of %i subsets." %
+                 (len(best), len(specs) - len(failed), len(specs)))
+        reloc_lines = []
+        for event_id, (_, items) in best.iteritems():
+            items[0] = str(self.event_map[event_id])
+            reloc_lines.append((self.event_map[event_id], " ".join(items)))
+        reloc_lines.sort()
+        with open(os.path.join(self.paths["output_files"], "hypoDD.reloc"),
+                  "w") as open_file:
+            open_file.write("\n".join(_i[1] for _i in reloc_lines))
+
+        if output_cross_correlation_file:
+            for spec in specs:
+                if os.path.exists(spec["output_cross_correlation_file"]):
+                    self.load_cross_correlation_results(
+                        spec["output_cross_correlation_file"])
+            self.save_cross_correlation_results(output_cross_correlation_file)
+
+    def prepare_cross_correlation(self):
+        """
+        Runs all stages up to the cross correlation, including ph2dt, so the
+        working directory is ready for cross_correlate_shard().
+        """
+        self.log("Preparing the cross correlation...")
+        self._run_stages(self._preparation_stages())
+
+    def cross_correlate_shard(self, shard_index, shard_count):
+        """
+        Cross correlates one of shard_count shards of the event pairs of
+        dt.ct, see hypodd_sharding. The working directory has to be
+        prepared with prepare_cross_correlation() and every shard can run in
+        a separate invocation, also on another node seeing the same working
+        directory and waveform files.
+
+        With self.cc_time_budget set, every shard gets the full budget and
+        writes its coverage to its shard directory. The run report of the
+        shard is written there as well.
+        """
+        from hypodd_sharding import shard_directory
+
+        if not os.path.exists(os.path.join(self.paths["input_files"],
+                                           "dt.ct")):
+            msg = ("dt.ct does not exists. Prepare the working directory "
+                   "with prepare_cross_correlation() first.")
+            raise HypoDDException(msg)
+        directory = shard_directory(self.paths["working_files"], shard_index,
+                                    shard_count)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.log("Cross correlating shard %i of %i..." % (shard_index,
+                                                          shard_count))
+        self._run_stages([
+            (self._parse_station_files, {}),
+            (self._read_event_information, {}),
+            (self._create_event_id_map, {}),
+            (self._parse_waveform_files, {}),
+            (self._screen_picks, {}),
+            (self._cross_correlate_picks,
+             {"shard": (shard_index, shard_count)})],
+            report_file=os.path.join(directory, "run_report.json"))
+
+    def merge_cross_correlation_shards(self, shard_count, outfile=None):
+        """
+        Merges all shards of cross_correlate_shard() into dt.cc and
+        working_dir/working_files/cc_results.jsonl. A following
+        start_relocation() uses the merged dt.cc.
+
+        Raises a HypoDDException if any shard is not finished, was
+        correlated for another dt.ct or with other cross correlation
+        parameters or if two shards have different results for a pick pair.
+
+        :param outfile: Filename of cross correlation results output.
+        """
+        from hypodd_cross_correlation import count_dt_ct_pairs
+        from hypodd_sharding import merge_shards, read_shard_manifest, \
+            shard_directory, shard_range
+        from hypodd_stations import file_hash
+
+        dt_cc_path = os.path.join(self.paths["input_files"], "dt.cc")
+        if os.path.exists(dt_cc_path):
+            self.log("dt.cc input file already exists")
+            return
+        dt_ct_path = os.path.join(self.paths["input_files"], "dt.ct")
+        if not os.path.exists(dt_ct_path):
+            msg = "dt.ct does not exists. Did ph2dt run successfully?"
+            raise HypoDDException(msg)
+        pair_count = count_dt_ct_pairs(dt_ct_path)
+        expected = json.loads(json.dumps({
+            "shard_count": shard_count,
+            "dt_ct_md5": file_hash(dt_ct_path),
+            "cc_param": self.cc_param,
+            "pick_quality_param": self.pick_quality_param}))
+        shard_dirs = []
+        unfinished = []
+        for shard_index in range(shard_count):
+            directory = shard_directory(self.paths["working_files"],
+                                        shard_index, shard_count)
+            manifest = read_shard_manifest(directory)
+            if manifest is None or \
+                    not os.path.exists(os.path.join(directory, "dt.cc")):
+                unfinished.append(shard_index)
+                continue
+            expected["shard_index"] = shard_index
+            expected["event_pairs"] = list(shard_range(
+                pair_count, shard_index, shard_count))
+            conflicts = sorted(_i for _i in expected
+                               if manifest.get(_i) != expected[_i])
+            if conflicts:
+                msg = "Shard %i does not match this relocation: %s" % (
+                    shard_index, ", ".join(conflicts))
+                raise HypoDDException(msg)
+            shard_dirs.append(directory)
+        if unfinished:
+            msg = "Shards %s are not finished." % ", ".join(
+                str(_i) for _i in unfinished)
+            raise HypoDDException(msg)
+
+        conflicts = merge_shards(
+            shard_dirs, dt_cc_path,
+            os.path.join(self.paths["working_files"], "cc_results.jsonl"))
+        if conflicts:
+            for pick_id_1, pick_id_2, result_1, result_2 in conflicts[:10]:
+                self.log("Conflicting cross correlation results for %s and "
+                         "%s: %s and %s" % (pick_id_1, pick_id_2, result_1,
+                                            result_2), level="error")
+            msg = ("%i pick pairs have conflicting cross correlation "
+                   "results in the shards." % len(conflicts))
+            raise HypoDDException(msg)
+        self.report.increment("cc_shards_merged", shard_count)
+        self.log("Merged %i cross correlation shards." % shard_count)
+        if outfile:
+            self.save_cross_correlation_results(outfile)
+
+    def cross_correlate_shards_locally(self, shard_count, processes=None,
+                                       outfile=None):
+        """
+        Prepares the working directory, cross correlates all shards in local
+        worker processes standing in for separate nodes and merges them.
+
+        :param processes: Number of shards correlated in parallel. Defaults
+            to the number of CPUs.
+        :param outfile: Filename of cross correlation results output.
+        """
+        from hypodd_sharding import _cross_correlate_shard
+
+        self.prepare_cross_correlation()
+        cc_results_files = []
+        if self.cc_results:
+            # The workers load the already loaded results from a file.
+            cc_results_file = os.path.join(self.paths["working_files"],
+                                           "cc_shards", "loaded.json")
+            if not os.path.exists(os.path.dirname(cc_results_file)):
+                os.makedirs(os.path.dirname(cc_results_file))
+            with open(cc_results_file, "w") as open_file:
+                json.dump(self.cc_results, open_file)
+            cc_results_files.append(cc_results_file)
+        specs = [{
+            "working_dir": self.working_dir,
+            "cc_param": self.cc_param,
+            "forced_configuration_values": self.forced_configuration_values,
+            "external_binaries": self.external_binaries,
+            "binary_cache_dir": self.binary_cache_dir,
+            "pick_quality_param": self.pick_quality_param,
+            "cc_time_budget": self.cc_time_budget,
+            "cc_results_files": cc_results_files,
+            "shard_index": _i,
+            "shard_count": shard_count} for _i in range(shard_count)]
+        self.log("Cross correlating %i shards..." % shard_count)
+        pool = self._start_worker_pool(processes)
+        try:
+            pool.map(_cross_correlate_shard, specs)
+        finally:
+            self._stop_worker_pool(pool)
+        self.merge_cross_correlation_shards(shard_count, outfile=outfile)
+
+    def _setup_subset_working_dir(self, working_dir, events):
+        """
+        Prepares a working directory to relocate a subset of the events. The
+        already parsed station, event and waveform information as well as the
+        compiled binaries are placed in it so the relocator working on it
+        will not parse or compile anything again.
+        """
+        paths = {}
+        for path in ["bin", "input_files", "working_files", "output_files"]:
+            paths[path] = os.path.join(working_dir, path)
+            if not os.path.exists(paths[path]):
+                os.makedirs(paths[path])
+        working_files = paths["working_files"]
+        with open(os.path.join(working_files, "stations.json"), "w") as \
+                open_file:
+            json.dump(self.stations, open_file)
+        _serialize_events(events, os.path.join(working_files, "events.json"))
+        # All subsets share the waveform information of this relocator.
+        waveform_information_file = os.path.join(
+            working_files, "waveform_information.json")
+        if not os.path.exists(waveform_information_file):
+            shared_file = os.path.abspath(os.path.join(
+                self.paths["working_files"], "waveform_information.json"))
+            if hasattr(os, "symlink"):
+                os.symlink(shared_file, waveform_information_file)
+            else:
+                shutil.copyfile(shared_file, waveform_information_file)
+        for binary in ["hypoDD", "ph2dt", "hypoDD.inc"]:
+            # hypoDD.inc does not exist for external binaries.
+            if os.path.exists(os.path.join(self.paths["bin"], binary)):
+                shutil.copy2(os.path.join(self.paths["bin"], binary),
+                             os.path.join(paths["bin"], binary))
+
+    def _relocate_subset(self, output_cross_correlation_file=None):
+        """
+        Runs all steps up to HypoDD in a working directory prepared by
+        _setup_subset_working_dir(). hypoDD is recompiled in it with arrays
+        sized for the data of the subset.
+        """
+        self._run_stages([
+            (self._parse_station_files, {}),
+            (self._write_station_input_file, {}),
+            (self._read_event_information, {}),
+            (self._write_ph2dt_inp_file, {}),
+            (self._create_event_id_map, {}),
+            (self._write_catalog_input_file, {}),
+            (self._run_ph2dt, {}),
+            (self._parse_waveform_files, {}),
+            (self._screen_picks, {}),
+            (self._cross_correlate_picks,
+             {"outfile": output_cross_correlation_file}),
+            (self._resize_hypodd, {}),
+            (self._write_hypoDD_inp_file, {}),
+            (self._run_hypodd, {})])
 
     def add_event_files(self, event_files):
         """
@@ -193,6 +971,111 @@ class HypoDDRelocator(object):
                 continue
             self.waveform_files.append(waveform_file)
 
+    def add_catalog(self, catalog):
+        """
+        Adds an ObsPy Catalog or a list of events. They are used like the
+        events of the event files and also written to the output file, the
+        catalog itself is not modified.
+        """
+        from obspy.core.event import Catalog
+
+        if not isinstance(catalog, Catalog):
+            catalog = Catalog(events=list(catalog))
+        self.catalogs.append(catalog)
+
+    def add_inventory(self, inventory):
+        """
+        Adds an ObsPy Inventory. Its stations are used like the stations of
+        the station files.
+        """
+        self.inventories.append(inventory)
+
+    def add_streams(self, streams):
+        """
+        Adds ObsPy Streams or Traces. Every stream is used like a waveform
+        file and gets a waveform id of the form memory://<md5 hash> in
+        self.waveform_files. The hash covers the trace ids, times and data so
+        the id identifies the same stream in every session. The traces are
+        never modified and not copied, so they should not be changed until
+        the relocation has finished. They are kept in self.memory_streams and
+        released with the relocator.
+
+        Returns the list of the waveform ids.
+        """
+        from obspy.core import Stream, Trace
+
+        if isinstance(streams, (Stream, Trace)):
+            streams = [streams]
+        waveform_ids = []
+        for stream in streams:
+            if isinstance(stream, Trace):
+                stream = Stream(traces=[stream])
+            waveform_id = _memory_stream_id(stream)
+            self.memory_streams[waveform_id] = stream
+            if waveform_id not in self.waveform_files:
+                self.waveform_files.append(waveform_id)
+            waveform_ids.append(waveform_id)
+        return waveform_ids
+
+    def _read_waveform(self, waveform_file, headonly=False):
+        """
+        Reads a waveform file or returns the in-memory stream of a waveform
+        id returned by add_streams(). In-memory streams are returned as a new
+        Stream object with the same traces.
+        """
+        from obspy.core import read, Stream
+
+        if not waveform_file.startswith(MEMORY_PREFIX):
+            return read(waveform_file, headonly=headonly)
+        stream = self._get_memory_stream(waveform_file)
+        if stream is None:
+            msg = "In-memory stream %s is not known. Streams have to be " + \
+                "added again with add_streams() in every session."
+            raise HypoDDException(msg % waveform_file)
+        return Stream(traces=list(stream))
+
+    def _get_memory_stream(self, waveform_id):
+        """
+        Returns the in-memory stream of a waveform id or None. Relocators in
+        worker processes see the streams of the relocator that forked them.
+        """
+        stream = self.memory_streams.get(waveform_id)
+        if stream is None:
+            stream = _INHERITED_MEMORY_STREAMS.get(waveform_id)
+        return stream
+
+    def _start_worker_pool(self, processes):
+        """
+        Returns a multiprocessing pool for subset or shard relocators. The
+        in-memory streams are handed to the forked workers for the lifetime
+        of the pool, see _stop_worker_pool().
+        """
+        import multiprocessing
+
+        _INHERITED_MEMORY_STREAMS.update(self.memory_streams)
+        return multiprocessing.Pool(processes=processes)
+
+    def _stop_worker_pool(self, pool):
+        """
+        Waits for the workers of a pool of _start_worker_pool() and releases
+        the streams handed to them.
+        """
+        try:
+            pool.close()
+            pool.join()
+        finally:
+            _INHERITED_MEMORY_STREAMS.clear()
+
+    def _get_waveform_size(self, waveform_file):
+        """
+        Returns the size of a waveform file or the bytes of the data of an
+        in-memory stream.
+        """
+        if waveform_file.startswith(MEMORY_PREFIX):
+            return sum(_i.data.nbytes for _i in
+                       self._get_memory_stream(waveform_file) or [])
+        return os.path.getsize(waveform_file)
+
     def set_forced_configuration_value(self, key, value):
         """
         Force a configuration key to a certain value. This will overwrite any
@@ -217,9 +1100,15 @@ class HypoDDRelocator(object):
             * MAXDIST - DIST in the hypoDD manual for hypoDD.inp. Same as
                 MAXDIST in ph2dt.inp. (Will be set so that all
                 event_pair-station pairs are included.)
+            * ISOLV   (Will be set to 2, LSQR. 1 uses SVD which needs much
+                       larger arrays and is only feasible for small
+                       clusters.)
+            * OBSCC   (Will be set to 8. The sum of OBSCC and OBSCT is the
+                       minimum number of observations linking two events.)
+            * OBSCT   (Will be set to 0.)
         """
         allowed_keys = ["MINWGHT", "MAXDIST", "MAXSEP", "MAXNGH", "MINLNK",
-                        "MINOBS", "MAXOBS"]
+                        "MINOBS", "MAXOBS", "ISOLV", "OBSCC", "OBSCT"]
         if not isinstance(key, basestring):
             msg = "The configuration key needs to be a string"
             warnings.warn(msg)
@@ -231,6 +1120,28 @@ class HypoDDRelocator(object):
             return
         self.forced_configuration_values[key] = value
 
+    def set_external_binaries(self, hypodd_binary, ph2dt_binary):
+        """
+        Use already existing hypoDD and ph2dt executables instead of compiling
+        them from the HypoDD archive. Useful for the stand-in binaries of
+        hypodd_synthetic.
+
+        :param hypodd_binary: Path to the hypoDD executable.
+        :param ph2dt_binary: Path to the ph2dt executable.
+        """
+        self.external_binaries = {
+            "hypodd_binary": os.path.abspath(hypodd_binary),
+            "ph2dt_binary": os.path.abspath(ph2dt_binary)}
+
+    def set_binary_cache(self, binary_cache_dir):
+        """
+        Share the compiled hypoDD and ph2dt binaries with other relocations.
+        Compilations with the same array sizes are then only done once.
+
+        :param binary_cache_dir: Directory of the cached compilations.
+        """
+        self.binary_cache_dir = os.path.abspath(binary_cache_dir)
+
     def _configure_paths(self):
         """
         Central place to setup up all the paths needed for running HypoDD.
@@ -263,8 +1174,12 @@ class HypoDDRelocator(object):
     def _parse_station_files(self):
         """
         Parse all station files and serialize the necessary information as a
-        JSON object to working_dir/working_files/stations.json.
+        JSON object to working_dir/working_files/stations.json. StationXML
+        and (X)SEED files are supported, see hypodd_stations.
         """
+        from hypodd_stations import inventory_coordinates, \
+            parse_station_files
+
         serialized_station_file = os.path.join(self.paths["working_files"],
                                                "stations.json")
         # If already parsed before, just read the serialized station file.
@@ -275,22 +1190,11 @@ class HypoDDRelocator(object):
                 self.stations = json.load(open_file)
                 return
         self.log("Parsing stations...")
-        self.stations = {}
-        for station_file in self.station_files:
-            p = Parser(station_file)
-            # In theory it would be enough to parse Blockette 50, put faulty
-            # SEED files do not store enough information in them, so
-            # blockettes 52 need to be parsed...
-            for station in p.stations:
-                for blockette in station:
-                    if blockette.id != 52:
-                        continue
-                    station_id = "%s.%s" % (station[0].network_code,
-                                            station[0].station_call_letters)
-                    self.stations[station_id] = {
-                        "latitude": blockette.latitude,
-                        "longitude": blockette.longitude,
-                        "elevation": int(round(blockette.elevation))}
+        self.stations = parse_station_files(
+            self.station_files, cache_file=self.station_cache_file,
+            log_function=self.log)
+        for inventory in self.inventories:
+            self.stations.update(inventory_coordinates(inventory))
         with open(serialized_station_file, "w") as open_file:
             json.dump(self.stations, open_file)
         self.log("Done parsing stations.")
@@ -366,32 +1270,14 @@ class HypoDDRelocator(object):
                                  event_id=self.event_map[event["event_id"]])
             event_strings.append(event_string)
             # Now loop over every pick and add station traveltimes.
-            for pick in event["picks"]:
-                # Only P and S phases currently supported by HypoDD.
-                if pick["phase"].upper() != "P" and \
-                        pick["phase"].upper() != "S":
-                    continue
-                string = "{station_id} {travel_time:.6f} {weight:.2f} {phase}"
-                travel_time = pick["pick_time"] - event["origin_time"]
-                # Simple check to assure no negative travel times are used.
-                if travel_time < 0:
-                    msg = "Negative absolute travel time. " + \
-                        "{phase} phase pick for event {event_id} at " + \
-                        "station {station_id} will not be used."
-                    msg = msg.format(
-                        phase=pick["phase"],
-                        event_id=event["event_id"],
-                        station_id=pick["station_id"])
-                    self.log(msg, level="warning")
-                    continue
-                weight = phase_weighting(pick['station_id'], pick['phase'],
-                                         pick['pick_time'],
-                                         pick['pick_time_error'])
+            string = "{station_id} {travel_time:.6f} {weight:.2f} {phase}"
+            for station_id, travel_time, weight, phase in \
+                    self._get_hypodd_phases(event, phase_weighting):
                 pick_string = string.format(
-                    station_id=pick["station_id"],
+                    station_id=station_id,
                     travel_time=travel_time,
                     weight=weight,
-                    phase=pick["phase"].upper())
+                    phase=phase)
                 event_strings.append(pick_string)
         event_string = "\n".join(event_strings)
         # Write the phase.dat file.
@@ -399,6 +1285,36 @@ class HypoDDRelocator(object):
             open_file.write(event_string)
         self.log("Created phase.dat input file.")
 
+    def _get_hypodd_phases(self, event, phase_weighting):
+        """
+        Returns a list of (station_id, travel_time, weight, phase) tuples for
+        all picks of an event usable by HypoDD.
+        """
+        phases = []
+        for pick in event["picks"]:
+            # Only P and S phases currently supported by HypoDD.
+            if pick["phase"].upper() != "P" and \
+                    pick["phase"].upper() != "S":
+                continue
+            travel_time = pick["pick_time"] - event["origin_time"]
+            # Simple check to assure no negative travel times are used.
+            if travel_time < 0:
+                msg = "Negative absolute travel time. " + \
+                    "{phase} phase pick for event {event_id} at " + \
+                    "station {station_id} will not be used."
+                msg = msg.format(
+                    phase=pick["phase"],
+                    event_id=event["event_id"],
+                    station_id=pick["station_id"])
+                self.log(msg, level="warning")
+                continue
+            weight = phase_weighting(pick['station_id'], pick['phase'],
+                                     pick['pick_time'],
+                                     pick['pick_time_error'])
+            phases.append((pick["station_id"], travel_time, weight,
+                           pick["phase"].upper()))
+        return phases
+
     def _read_event_information(self):
         """
         Read all event files and extract the needed information and serialize
@@ -406,6 +1322,9 @@ class HypoDDRelocator(object):
         development as the JSON file is just much faster to read then the full
         event files.
         """
+        from obspy.core import UTCDateTime
+        from obspy.core.event import Catalog, read_events
+
         serialized_event_file = os.path.join(self.paths["working_files"],
                                              "events.json")
         if os.path.exists(serialized_event_file):
@@ -424,6 +1343,8 @@ class HypoDDRelocator(object):
         catalog = Catalog()
         for event in self.event_files:
             catalog += read_events(event)
+        for events in self.catalogs:
+            catalog += events
         self.events = []
         # Keep track of the number of discarded picks.
         discarded_picks = 0
@@ -487,15 +1408,8 @@ class HypoDDRelocator(object):
                 current_event["picks"].append(current_pick)
         # Sort events by origin time
         self.events.sort(key=lambda event: event["origin_time"])
-        # Serialize the event dict. Copy it so the times can be converted to
-        # strings.
-        events = copy.deepcopy(self.events)
-        for event in events:
-            event["origin_time"] = str(event["origin_time"])
-            for pick in event["picks"]:
-                pick["pick_time"] = str(pick["pick_time"])
-        with open(serialized_event_file, "w") as open_file:
-            json.dump(events, open_file)
+        # Serialize the event dict.
+        _serialize_events(self.events, serialized_event_file)
         self.log("Reading all events successful.")
         self.log(("%i picks discarded because of " % discarded_picks) +
                  "unavailable station information.")
@@ -524,37 +1438,61 @@ class HypoDDRelocator(object):
         # MAXDIST is reused in the hypoDD.inp file. It always needs to be
         # calculated. Fake a forced configuration
         # value.
-        values = {}
         if "MAXDIST" not in self.forced_configuration_values:
-            # Calculate MAXDIST so that all event-station pairs are definitely
-            # inluded. This is a very simple way of doing it.
-            lats = []
-            longs = []
-            depths = []
-            for event in self.events:
-                lats.append(event["origin_latitude"])
-                longs.append(event["origin_longitude"])
-                # Convert to km.
-                depths.append(event["origin_depth"] / 1000.0)
-            for _, station in self.stations.iteritems():
-                lats.append(station["latitude"])
-                longs.append(station["longitude"])
-                # station elevation is in meter.
-                depths.append(station["elevation"] / 1000.0)
-            lat_range = (max(lats) - min(lats)) * 111.0
-            long_range = (max(longs) - min(longs)) * 111.0
-            depth_range = max(depths) - min(depths)
-            maxdist = math.sqrt(lat_range ** 2 + long_range ** 2 +
-                                depth_range ** 2)
-            values["MAXDIST"] = int(math.ceil(maxdist))
-            self.log("MAXDIST for ph2dt.inp calculated to %i." %
-                     values["MAXDIST"])
-            self.forced_configuration_values["MAXDIST"] = values["MAXDIST"]
+            self.forced_configuration_values["MAXDIST"] = \
+                self._calculate_maxdist()
 
         ph2dt_inp_file = os.path.join(self.paths["input_files"], "ph2dt.inp")
         if os.path.exists(ph2dt_inp_file):
             self.log("ph2dt.inp input file already exists.")
             return
+        values = self._get_ph2dt_values()
+        # Use this construction to get rid of leading whitespaces.
+        ph2dt_string = [
+            "station.dat",
+            "phase.dat",
+            "{MINWGHT} {MAXDIST} {MAXSEP} {MAXNGH} {MINLNK} {MINOBS} {MAXOBS}"]
+        ph2dt_string = "\n".join(ph2dt_string)
+        ph2dt_string = ph2dt_string.format(**values)
+        with open(ph2dt_inp_file, "w") as open_file:
+            open_file.write(ph2dt_string)
+        self.log("Writing ph2dt.inp successful")
+
+    def _calculate_maxdist(self):
+        """
+        Calculate MAXDIST so that all event-station pairs are definitely
+        inluded. This is a very simple way of doing it.
+        """
+        lats = []
+        longs = []
+        depths = []
+        for event in self.events:
+            lats.append(event["origin_latitude"])
+            longs.append(event["origin_longitude"])
+            # Convert to km.
+            depths.append(event["origin_depth"] / 1000.0)
+        for _, station in self.stations.iteritems():
+            lats.append(station["latitude"])
+            longs.append(station["longitude"])
+            # station elevation is in meter.
+            depths.append(station["elevation"] / 1000.0)
+        lat_range = (max(lats) - min(lats)) * 111.0
+        long_range = (max(longs) - min(longs)) * 111.0
+        depth_range = max(depths) - min(depths)
+        maxdist = math.sqrt(lat_range ** 2 + long_range ** 2 +
+                            depth_range ** 2)
+        maxdist = int(math.ceil(maxdist))
+        self.log("MAXDIST for ph2dt.inp calculated to %i." % maxdist)
+        return maxdist
+
+    def _get_ph2dt_values(self, maxsep_sample_size=None):
+        """
+        Returns the ph2dt control parameters.
+
+        :param maxsep_sample_size: If given, an automatically determined
+            MAXSEP is estimated from this many random event pairs instead of
+            all of them.
+        """
         # Determine the necessary variables. See the documentation of the
         # set_forced_configuration_value method for the reasoning.
         values = {}
@@ -563,7 +1501,12 @@ class HypoDDRelocator(object):
         values["MINLNK"] = 8
         values["MINOBS"] = 8
         values["MAXOBS"] = 50
-        if "MAXSEP" not in self.forced_configuration_values:
+        if "MAXSEP" not in self.forced_configuration_values and \
+                maxsep_sample_size is not None:
+            from hypodd_planner import estimate_maxsep
+            values["MAXSEP"] = estimate_maxsep(
+                self.events, sample_size=maxsep_sample_size)
+        elif "MAXSEP" not in self.forced_configuration_values:
             # Set MAXSEP to the 10-percentile of all inter-event distances.
             distances = []
             for event_1 in self.events:
@@ -590,21 +1533,22 @@ class HypoDDRelocator(object):
         for key in keys:
             if key in self.forced_configuration_values:
                 values[key] = self.forced_configuration_values[key]
-        # Use this construction to get rid of leading whitespaces.
-        ph2dt_string = [
-            "station.dat",
-            "phase.dat",
-            "{MINWGHT} {MAXDIST} {MAXSEP} {MAXNGH} {MINLNK} {MINOBS} {MAXOBS}"]
-        ph2dt_string = "\n".join(ph2dt_string)
-        ph2dt_string = ph2dt_string.format(**values)
-        with open(ph2dt_inp_file, "w") as open_file:
-            open_file.write(ph2dt_string)
-        self.log("Writing ph2dt.inp successful")
+        if "MAXDIST" not in values:
+            values["MAXDIST"] = self._calculate_maxdist()
+        return values
 
-    def _compile_hypodd(self):
+    def _compile_hypodd(self, event_count=None, statistics=None):
         """
         Compiles HypoDD and ph2dt using
+
+        :param event_count: The number of events the binaries have to be
+            able to handle. Defaults to the number of events.
+        :param statistics: Link statistics of the differential time files as
+            returned by hypodd_sizing.read_link_statistics(). If given, the
+            arrays are sized for them.
         """
+        if event_count is None:
+            event_count = len(self.events)
         logfile = os.path.join(self.working_dir, "compilation.log")
         self.log("Initating HypoDD compilation (logfile: %s)..." % logfile)
         with open(logfile, "w") as fh:
@@ -612,16 +1556,59 @@ class HypoDDRelocator(object):
                 fh.write(line)
                 fh.write(os.linesep)
             compiler = HypoDDCompiler(working_dir=self.working_dir,
-                                      log_function=logfunc)
-            compiler.configure(MAXEVE=len(self.events) + 30,
-                               #MAXEVE0=len(self.events) + 30,
-                               MAXEVE0=200,
-                               MAXDATA=100000,
-                               MAXDATA0=60000,
-                               MAXCL=20,
-                               MAXSTA=len(self.stations) + 10)
+                                      log_function=logfunc,
+                                      binary_cache_dir=self.binary_cache_dir,
+                                      **self.external_binaries)
+            compiler.configure(**self._get_hypodd_array_sizes(
+                event_count, statistics=statistics))
             compiler.make()
 
+    def _get_hypodd_array_sizes(self, event_count, statistics=None):
+        """
+        Returns the array sizes of hypoDD.inc for HypoDDCompiler.configure()
+        for event_count events.
+
+        :param statistics: Link statistics of the differential time files.
+            Without them, default sizes for the first compilation are used
+            as the data is not known yet.
+        """
+        isolv = self.forced_configuration_values.get("ISOLV", 2)
+        if statistics is not None:
+            return hypodd_array_sizes(statistics, event_count,
+                                      len(self.stations), isolv=isolv)
+        sizes = {"MAXEVE": event_count + 30,
+                 "MAXEVE0": 200,
+                 "MAXDATA": 100000,
+                 "MAXDATA0": 60000,
+                 "MAXCL": 20,
+                 "MAXSTA": len(self.stations) + 10}
+        # LSQR does not need the SVD arrays.
+        if isolv == 2:
+            sizes["MAXEVE0"] = 2
+            sizes["MAXDATA0"] = 1
+        return sizes
+
+    def _resize_hypodd(self):
+        """
+        Recompiles hypoDD with arrays sized for the actual data in dt.cc and
+        dt.ct. Nothing is compiled if the sizes did not change.
+        """
+        dt_cc = os.path.join(self.paths["input_files"], "dt.cc")
+        dt_ct = os.path.join(self.paths["input_files"], "dt.ct")
+        event_sel = os.path.join(self.paths["input_files"], "event.sel")
+        # With IDAT=3, hypoDD links events with OBSCC + OBSCT observations.
+        link_thresholds = self._get_link_thresholds()
+        statistics = read_link_statistics(
+            dt_cc if os.path.exists(dt_cc) else None,
+            dt_ct if os.path.exists(dt_ct) else None,
+            min_links=link_thresholds["OBSCC"] + link_thresholds["OBSCT"])
+        with open(event_sel, "r") as open_file:
+            event_count = len([_i for _i in open_file if _i.strip()])
+        self.log("%i observations of %i events in %i clusters." % (
+            statistics["observations"], event_count,
+            len(statistics["clusters"])))
+        self._compile_hypodd(event_count=event_count, statistics=statistics)
+
     def _run_hypodd(self):
         """
         Runs HypoDD with the necessary input files.
@@ -664,10 +1651,10 @@ class HypoDDRelocator(object):
         for filename in necessary_files:
             shutil.copyfile(os.path.join(self.paths["input_files"], filename),
                             os.path.join(hypodd_dir, filename))
-        # Run ph2dt
-        retcode = subprocess.Popen([hypodd_path, "hypoDD.inp"],
-                                   cwd=hypodd_dir).wait()
-        if retcode != 0:
+        # Run HypoDD
+        metrics = self._run_external([hypodd_path, "hypoDD.inp"], hypodd_dir,
+                                     "hypoDD")
+        if metrics["returncode"] != 0:
             msg = "Problem running HypoDD."
             raise HypoDDException(msg)
         # Check if all are there.
@@ -683,12 +1670,45 @@ class HypoDDRelocator(object):
         # Also copy the log file.
         log_file = os.path.join(hypodd_dir, "hypoDD.log")
         if os.path.exists(log_file):
+            with open(log_file, "r") as open_file:
+                log_metrics = parse_hypodd_log(open_file.readlines())
+            # The iteration timings can only be taken from the timestamped
+            # output.
+            output_metrics = parse_hypodd_log(metrics["output"])
+            if len(output_metrics["iterations"]) == \
+                    len(log_metrics["iterations"]):
+                log_metrics["iterations"] = output_metrics["iterations"]
+            self.report.external_runs["hypoDD"]["log"] = log_metrics
             shutil.move(log_file,
                         os.path.join(self.working_dir, "hypoDD_log.txt"))
         # Remove the temporary ph2dt running directory.
         shutil.rmtree(hypodd_dir)
         self.log("HypoDD run was successful!")
 
+    def _run_external(self, command, cwd, name):
+        """
+        Runs an external executable, echoes its output and adds its metrics
+        to the run report. The timestamped output is written to
+        working_dir/<name>_output.txt.
+        """
+        def echo(line):
+            print line
+            sys.stdout.flush()
+
+        metrics = run_external(
+            command, cwd,
+            output_filename=os.path.join(self.working_dir,
+                                         "%s_output.txt" % name),
+            log_function=echo,
+            warning_function=lambda msg: self.log(msg, level="warning"))
+        self.report.add_external_run(name, metrics)
+        cpu_time = (metrics["user_cpu_time"] or 0.0) + \
+            (metrics["system_cpu_time"] or 0.0)
+        self.log("%s finished after %.1f s (%.1f s CPU time, %.1f MB peak "
+                 "memory)." % (name, metrics["wall_time"], cpu_time,
+                               (metrics["peak_rss"] or 0) / 1024.0 ** 2))
+        return metrics
+
     def _run_ph2dt(self):
         """
         Runs ph2dt with the necessary input files.
@@ -734,9 +1754,9 @@ class HypoDDRelocator(object):
         shutil.copyfile(phase_file, os.path.join(ph2dt_dir, "phase.dat"))
         shutil.copyfile(input_file, os.path.join(ph2dt_dir, "ph2dt.inp"))
         # Run ph2dt
-        retcode = subprocess.Popen([ph2dt_path, "ph2dt.inp"],
-                                   cwd=ph2dt_dir).wait()
-        if retcode != 0:
+        metrics = self._run_external([ph2dt_path, "ph2dt.inp"], ph2dt_dir,
+                                     "ph2dt")
+        if metrics["returncode"] != 0:
             msg = "Problem running ph2dt."
             raise HypoDDException(msg)
         # Check if all are there.
@@ -763,21 +1783,38 @@ class HypoDDRelocator(object):
         Read all specified waveform files and store information about them in
         working_dir/working_files/waveform_information.json
         """
+        import progressbar
+        from obspy.core import UTCDateTime
+
         serialized_waveform_information_file = \
             os.path.join(self.paths["working_files"],
                          "waveform_information.json")
         # If already parsed before, just read the serialized waveform file.
         if os.path.exists(serialized_waveform_information_file):
-            self.log("Waveforms already parsed. Will load the serialized " +
-                     "information.")
             with open(serialized_waveform_information_file, "r") as open_file:
-                self.waveform_information = json.load(open_file)
+                waveform_information = json.load(open_file)
+            # The in-memory streams are added again in every session. Only
+            # reuse the information if they are the same ones. Relocators of
+            # subsets and shards have no waveforms of their own.
+            indexed_streams = set(
+                item["filename"] for items in waveform_information.values()
+                for item in items
+                if item["filename"].startswith(MEMORY_PREFIX))
+            memory_streams = set(_i for _i in self.waveform_files
+                                 if _i.startswith(MEMORY_PREFIX) and
+                                 len(self._get_memory_stream(_i) or []))
+            if not self.waveform_files or indexed_streams == memory_streams:
+                self.log("Waveforms already parsed. Will load the "
+                         "serialized information.")
+                self.waveform_information = waveform_information
                 # Convert all times to UTCDateTimes.
                 for value in self.waveform_information.values():
                     for item in value:
                         item["starttime"] = UTCDateTime(item["starttime"])
                         item["endtime"] = UTCDateTime(item["endtime"])
                 return
+            self.log("The in-memory streams differ from the parsed ones. "
+                     "Parsing all waveforms again.", level="warning")
         file_count = len(self.waveform_files)
         self.log("Parsing %i waveform files..." % file_count)
         self.waveform_information = {}
@@ -786,8 +1823,12 @@ class HypoDDRelocator(object):
         pbar.start()
         # Use a progress bar for displaying.
         for _i, waveform_file in enumerate(self.waveform_files):
+            filename = waveform_file
+            if not waveform_file.startswith(MEMORY_PREFIX):
+                filename = os.path.abspath(waveform_file)
             try:
-                st = read(waveform_file)
+                st = self._read_waveform(waveform_file)
+                self.report.increment("waveform_files_decoded")
             except:
                 msg = "Waveform file %s could not be read." % waveform_file
                 self.log(msg, level="warning")
@@ -799,35 +1840,124 @@ class HypoDDRelocator(object):
                 self.waveform_information[trace.id].append(
                     {"starttime": trace.stats.starttime,
                      "endtime": trace.stats.endtime,
-                     "filename": os.path.abspath(waveform_file)})
+                     "filename": filename})
             pbar.update(_i + 1)
         pbar.finish()
         # Serialze it as a json object.
-        waveform_information = copy.deepcopy(self.waveform_information)
-        for value in waveform_information.values():
-            for item in value:
-                item["starttime"] = str(item["starttime"])
-                item["endtime"] = str(item["endtime"])
-        with open(serialized_waveform_information_file, "w") as open_file:
-            json.dump(waveform_information, open_file)
+        _serialize_waveform_information(self.waveform_information,
+                                        serialized_waveform_information_file)
         self.log("Successfully parsed all waveform files.")
 
+    def _screen_picks(self):
+        """
+        Screens the data quality of all picks if set up with
+        setup_pick_quality_screen() and fills self.excluded_picks, see
+        hypodd_pick_quality. The result of every pick is cached in
+        working_dir/working_files/pick_quality.json for the parameters and
+        the waveform index it was screened with.
+        """
+        from hypodd_pick_quality import screen_picks
+        from hypodd_stations import file_hash
+
+        if self.pick_quality_param is None:
+            return
+        quality_file = os.path.join(self.paths["working_files"],
+                                    "pick_quality.json")
+        # Picks are screened again once other waveforms are indexed.
+        param = json.loads(json.dumps({
+            "cc_param": self.cc_param,
+            "pick_quality_param": self.pick_quality_param,
+            "waveform_information_md5": file_hash(os.path.join(
+                self.paths["working_files"], "waveform_information.json"))}))
+        quality = {}
+        if os.path.exists(quality_file):
+            with open(quality_file, "r") as open_file:
+                cached = json.load(open_file)
+            # Results for other thresholds are useless.
+            if cached["param"] == param:
+                quality = cached["picks"]
+        picks = [pick for event in self.events for pick in event["picks"]
+                 if pick["id"] not in quality]
+        if picks:
+            self.log("Screening the data quality of %i picks..." %
+                     len(picks))
+            quality.update(screen_picks(
+                picks, self._find_data, self._read_waveform, self.cc_param,
+                self.pick_quality_param))
+            with open(quality_file + ".tmp", "w") as open_file:
+                json.dump({"param": param, "picks": quality}, open_file)
+            os.rename(quality_file + ".tmp", quality_file)
+        else:
+            self.log("Pick quality already screened.")
+
+        pick_ids = set(pick["id"] for event in self.events
+                       for pick in event["picks"])
+        reasons = {}
+        for pick_id, reason in quality.iteritems():
+            if reason is not None and pick_id in pick_ids:
+                reasons[reason] = reasons.get(reason, 0) + 1
+        self.excluded_picks = set(
+            pick_id for pick_id, reason in quality.iteritems()
+            if reason is not None and pick_id in pick_ids)
+        self.report.increment("picks_excluded_quality",
+                              len(self.excluded_picks))
+        self.log("%i of %i picks are excluded from the cross correlation "
+                 "because of their data quality%s" % (
+                     len(self.excluded_picks), len(pick_ids),
+                     ": " + ", ".join("%s %i" % _i for _i in
+                                      sorted(reasons.items()))
+                     if reasons else "."))
+
     def save_cross_correlation_results(self, filename):
-        with open(filename, "w") as open_file:
-            json.dump(self.cc_results, open_file)
+        """
+        Saves all cross correlation results, the loaded ones and the ones of
+        the cross correlation stage, to filename. Files ending in .jsonl are
+        written line by line without keeping all results in memory, all
+        other files as a single JSON object.
+        """
+        from hypodd_cross_correlation import iter_cc_results
+
+        results_file = os.path.join(self.paths["working_files"],
+                                    "cc_results.jsonl")
+        new_results = iter_cc_results(results_file) \
+            if os.path.exists(results_file) else []
+        if filename.endswith(".jsonl"):
+            with open(filename, "w") as open_file:
+                for id1, items in self.cc_results.iteritems():
+                    for id2, result in items.iteritems():
+                        open_file.write(json.dumps([id1, id2, result]))
+                        open_file.write("\n")
+                for result in new_results:
+                    open_file.write(json.dumps(result))
+                    open_file.write("\n")
+        else:
+            cc_results = dict((_i, dict(_j))
+                              for _i, _j in self.cc_results.iteritems())
+            for id1, id2, result in new_results:
+                cc_results.setdefault(id1, {})[id2] = result
+            with open(filename, "w") as open_file:
+                json.dump(cc_results, open_file)
         self.log("Successfully saved cross correlation results to file: %s." %
                  filename)
 
     def load_cross_correlation_results(self, filename, purge=False):
         """
-        Load previously computed and saved cross correlation results.
+        Load previously computed and saved cross correlation results. Pick
+        pairs with loaded results are not cross correlated again.
 
         :param purge: If True any already present cross correlation
             information will be discarded, if False loaded information will be
             used to update any currently present information.
         """
-        with open(filename, "r") as open_file:
-            cc_ = json.load(open_file)
+        from hypodd_cross_correlation import iter_cc_results
+
+        if filename.endswith(".jsonl"):
+            cc_ = {}
+            for id1, id2, result in iter_cc_results(filename):
+                cc_.setdefault(id1, {})[id2] = result
+        else:
+            with open(filename, "r") as open_file:
+                cc_ = json.load(open_file)
         if purge:
             self.cc_results = cc_
         else:
@@ -836,293 +1966,365 @@ class HypoDDRelocator(object):
         self.log("Successfully loaded cross correlation results from file: "
                  "%s." % filename)
 
-    def _cross_correlate_picks(self, outfile=None):
+    def _cross_correlate_picks(self, outfile=None, shard=None):
         """
         Reads the event pairs matched in dt.ct which are selected by ph2dt and
         calculate cross correlated differential travel_times for every pair.
 
+        The event pairs are streamed from dt.ct in chunks and every finished
+        chunk is appended to dt.cc, see hypodd_cross_correlation. The new
+        cross correlation results are written to
+        working_dir/working_files/cc_results.jsonl and not kept in memory.
+
         :param outfile: Filename of cross correlation results output.
+        :param shard: (shard_index, shard_count) tuple. If given, only the
+            event pairs of this shard are correlated and dt.cc and the
+            results are written to the shard directory, see
+            hypodd_sharding.
         """
+        import progressbar
+        from hypodd_cross_correlation import CHUNK_SIZE, chunked, \
+            count_dt_ct_pairs, CrossCorrelationSink, CrossCorrelator, \
+            iter_dt_ct_pairs, ParallelCrossCorrelator
+
         ct_file_path = os.path.join(self.paths["input_files"], "dt.cc")
         if os.path.exists(ct_file_path):
             self.log("ct.cc input file already exists")
             return
-        # This is by far the lengthiest operation and will be broken up in
-        # smaller steps
-        cc_dir = os.path.join(self.paths["working_files"], "cc_files")
-        if not os.path.exists(cc_dir):
-            os.makedirs(cc_dir)
         # Read the dt.ct file and get all event pairs.
         dt_ct_path = os.path.join(self.paths["input_files"], "dt.ct")
         if not os.path.exists(dt_ct_path):
             msg = "dt.ct does not exists. Did ph2dt run successfully?"
             raise HypoDDException(msg)
-        event_id_pairs = []
-        with open(dt_ct_path, "r") as open_file:
-            for line in open_file:
-                line = line.strip()
-                if not line.startswith("#"):
-                    continue
-                # Remove leading hashtag.
-                line = line[1:]
-                event_id_1, event_id_2 = map(int, line.split())
-                event_id_pairs.append((event_id_1, event_id_2))
+        pair_count = count_dt_ct_pairs(dt_ct_path)
+        start, stop = 0, pair_count
+        output_dir = self.paths["working_files"]
+        if shard is not None:
+            from hypodd_sharding import shard_directory, shard_range, \
+                write_shard_manifest
+            from hypodd_stations import file_hash
+
+            start, stop = shard_range(pair_count, *shard)
+            pair_count = stop - start
+            output_dir = shard_directory(self.paths["working_files"], *shard)
+            ct_file_path = os.path.join(output_dir, "dt.cc")
+            conflicts = write_shard_manifest(output_dir, {
+                "shard_index": shard[0],
+                "shard_count": shard[1],
+                "event_pairs": (start, stop),
+                "dt_ct_md5": file_hash(dt_ct_path),
+                "cc_param": self.cc_param,
+                "pick_quality_param": self.pick_quality_param})
+            if conflicts:
+                msg = ("The shard directory %s belongs to another "
+                       "relocation: %s" % (output_dir, ", ".join(conflicts)))
+                raise HypoDDException(msg)
+            if os.path.exists(ct_file_path):
+                self.log("Shard %i of %i is already finished." % shard)
+                return
+        # This is by far the lengthiest operation. The sink continues after
+        # the last finished chunk of an interrupted run.
+        sink = CrossCorrelationSink(
+            os.path.join(output_dir, "dt.cc.partial"),
+            os.path.join(output_dir, "cc_results.jsonl"),
+            os.path.join(output_dir, "cc_progress.json"))
+        if sink.completed_pairs:
+            self.log("Continuing after %i finished event pairs." %
+                     sink.completed_pairs)
+            self.report.increment("event_pairs_skipped",
+                                  sink.completed_pairs)
+        event_pairs = itertools.islice(iter_dt_ct_pairs(dt_ct_path),
+                                       start + sink.completed_pairs, stop)
+        events_by_id = dict((_i["event_id"], _i) for _i in self.events)
+        if self.cc_processes > 1:
+            correlator = ParallelCrossCorrelator(
+                self.cc_param, self._find_data, self._read_waveform,
+                self.cc_shared_dir, processes=self.cc_processes)
+        else:
+            correlator = CrossCorrelator(self.cc_param, self._find_data,
+                                         self._read_waveform)
         # Now for every event pair, calculate cross correlated differential
         # travel times for every pick.
         # Setup a progress bar.
         self.log("Cross correlating arrival times for %i event_pairs..." %
-                 len(event_id_pairs))
+                 pair_count)
         pbar = progressbar.ProgressBar(widgets=[progressbar.Percentage(),
-            progressbar.Bar(), progressbar.ETA()], maxval=len(event_id_pairs))
-        pbar_progress = 1
+            progressbar.Bar(), progressbar.ETA()], maxval=max(pair_count, 1))
         pbar.start()
-        for event_1, event_2 in event_id_pairs:
-            # Update the progress bar.
-            pbar.update(pbar_progress)
-            pbar_progress += 1
-            # filename for event_pair
-            event_pair_file = os.path.join(cc_dir, "%i_%i.txt" %
-                                           (event_1, event_2))
-            if os.path.exists(event_pair_file):
-                continue
-            current_pair_strings = []
-            # Find the corresponding events.
-            event_id_1 = self.event_map[event_1]
-            event_id_2 = self.event_map[event_2]
-            event_1_dict = event_2_dict = None
-            for event in self.events:
-                if event["event_id"] == event_id_1:
-                    event_1_dict = event
-                if event["event_id"] == event_id_2:
-                    event_2_dict = event
-                if event_1_dict is not None and event_2_dict is not None:
+        # Problems are counted per reason and only some samples of every
+        # reason are logged in a background thread.
+        async_log = AsyncLog(self.log)
+        problems = LogAggregator(async_log)
+        try:
+            if self.cc_time_budget is not None:
+                correlator = self._cross_correlate_prioritized(
+                    lambda: itertools.islice(
+                        iter_dt_ct_pairs(dt_ct_path),
+                        start + sink.completed_pairs, stop),
+                    events_by_id, correlator, problems, output_dir)
+            for chunk in chunked(event_pairs, CHUNK_SIZE):
+                blocks, results = self._cross_correlate_event_pairs(
+                    chunk, events_by_id, correlator, problems)
+                sink.write_chunk(blocks, results, len(chunk))
+                pbar.update(sink.completed_pairs)
+        finally:
+            async_log.close()
+            correlator.close()
+            sink.close()
+        pbar.finish()
+        sink.finish(ct_file_path)
+        self.log("Finished calculating cross correlations.")
+        self._log_problem_summary(problems)
+        if outfile:
+            self.save_cross_correlation_results(outfile)
+
+    def _cross_correlate_prioritized(self, event_pairs, events_by_id,
+                                     correlator, problems, output_dir):
+        """
+        Cross correlates the pick pairs of the event pairs in the order of
+        their priority until self.cc_time_budget is used up, see
+        hypodd_cc_priority. The coverage is logged and written to
+        cc_coverage.json in output_dir.
+
+        :param event_pairs: Function returning a new iterator over the event
+            pairs, each selection pass iterates them again.
+        :param output_dir: Directory of the coverage and the spilled
+            results. The working files or the directory of a shard.
+
+        Returns a PrecomputedCorrelator with the results to write dt.cc.
+        """
+        import time
+        from hypodd_cc_priority import BUDGET_BATCH_SIZE, \
+            CorrelationCoverage, MAX_SELECTED_PICK_PAIRS, pick_pair_priority, \
+            pick_pair_rank, PrecomputedCorrelator, ResultSpill, \
+            select_pick_pairs, SELECTION_HEADROOM
+        from hypodd_cross_correlation import common_picks, \
+            schedule_pick_pairs
+
+        start_time = time.time()
+        coverage = CorrelationCoverage(self.cc_time_budget)
+        window = self.cc_param["cc_time_before"] + \
+            self.cc_param["cc_time_after"]
+
+        def candidates(count):
+            # Yields all pick pairs to correlate. Only the first pass counts
+            # them for the coverage.
+            for pair_index, (event_1, event_2) in enumerate(event_pairs()):
+                event_1_dict = events_by_id.get(self.event_map[event_1])
+                event_2_dict = events_by_id.get(self.event_map[event_2])
+                if event_1_dict is None or event_2_dict is None:
+                    continue
+                for pick_index, (pick_1, pick_2) in enumerate(
+                        common_picks(event_1_dict, event_2_dict)):
+                    if pick_1["phase"] not in ("P", "S"):
+                        continue
+                    if pick_1["id"] in self.excluded_picks or \
+                            pick_2["id"] in self.excluded_picks:
+                        continue
+                    if self._get_loaded_cc_result(pick_1, pick_2) is not None:
+                        if count:
+                            coverage.pick_pairs_loaded += 1
+                        continue
+                    priority = pick_pair_priority(
+                        event_1_dict, event_2_dict, pick_1, pick_2,
+                        self.stations[pick_1["station_id"]], window)
+                    if count:
+                        coverage.pick_pairs += 1
+                        coverage.priority_total += priority
+                    yield priority, (pair_index, pick_index), pick_1, pick_2
+
+        spill = ResultSpill(os.path.join(output_dir, "cc_budget_results"))
+        selection_size = MAX_SELECTED_PICK_PAIRS
+        after = None
+        batch_time = 0.0
+        try:
+            while True:
+                selected, more = select_pick_pairs(
+                    candidates(after is None), selection_size, after=after)
+                if after is None:
+                    self.log("Cross correlating %i pick pairs by priority "
+                             "within %.1f seconds..." % (
+                                 coverage.pick_pairs, self.cc_time_budget))
+                self.report.increment("cc_budget_selections")
+                for _i in range(0, len(selected), BUDGET_BATCH_SIZE):
+                    # Stop before the next batch would exceed the budget.
+                    elapsed_time = time.time() - start_time
+                    if elapsed_time + batch_time > self.cc_time_budget:
+                        coverage.budget_exhausted = True
+                        break
+                    batch = selected[_i:_i + BUDGET_BATCH_SIZE]
+                    tasks = [{"pick_1": pick_1, "pick_2": pick_2}
+                             for _, _, pick_1, pick_2 in batch]
+                    correlator.correlate_tasks(schedule_pick_pairs(tasks))
+                    for task, (priority, position, _, _) in zip(tasks, batch):
+                        spill.add(position, task["pick_1"]["id"],
+                                  task["pick_2"]["id"], task["result"])
+                        coverage.priority_correlated += priority
+                    coverage.pick_pairs_correlated += len(batch)
+                    batch_time = time.time() - start_time - elapsed_time
+                if coverage.budget_exhausted or not more or not selected:
                     break
+                # Size the next selection for the remaining budget at the
+                # throughput achieved so far.
+                after = pick_pair_rank(*selected[-1][:2])
+                elapsed_time = time.time() - start_time
+                expected = SELECTION_HEADROOM * \
+                    coverage.pick_pairs_correlated / elapsed_time * \
+                    max(self.cc_time_budget - elapsed_time, 0.0)
+                selection_size = int(min(MAX_SELECTED_PICK_PAIRS,
+                                         max(BUDGET_BATCH_SIZE, expected)))
+        except:
+            spill.close()
+            raise
+        counters, correlator_problems = correlator.drain()
+        for counter, value in counters.iteritems():
+            self.report.increment(counter, value)
+        for reason, message, level, kwargs in correlator_problems:
+            problems(reason, message, level=level, **kwargs)
+
+        coverage.elapsed_time = time.time() - start_time
+        coverage = coverage.as_dict()
+        with open(os.path.join(output_dir, "cc_coverage.json"), "w") as \
+                open_file:
+            json.dump(coverage, open_file, indent=2, sort_keys=True)
+        self.log("Cross correlated %i of %i pick pairs in %.1f seconds "
+                 "(%.1f%% of the pick pairs, %.1f%% of the priority)." % (
+                     coverage["pick_pairs_correlated"],
+                     coverage["pick_pairs"], coverage["elapsed_time"],
+                     100.0 * coverage["pick_pair_coverage"],
+                     100.0 * coverage["priority_coverage"]))
+        return PrecomputedCorrelator(spill, correlator)
+
+    def _cross_correlate_event_pairs(self, event_pairs, events_by_id,
+                                     correlator, problems):
+        """
+        Cross correlates all common picks of the event pairs of a chunk.
+
+        Returns the dt.cc blocks of the event pairs in their original order
+        and a list of the new (pick_id_1, pick_id_2, result) cross
+        correlation results.
+        """
+        from hypodd_cross_correlation import common_picks, \
+            schedule_pick_pairs
+
+        # Collect the pick pairs of all event pairs. Pick pairs with loaded
+        # results are not correlated again.
+        pairs = []
+        tasks = []
+        for event_1, event_2 in event_pairs:
+            self.report.increment("event_pairs_processed")
+            event_1_dict = events_by_id.get(self.event_map[event_1])
+            event_2_dict = events_by_id.get(self.event_map[event_2])
             # Some safety measures to ensure the script keeps running even if
             # something unexpected happens.
-            if event_1_dict is None:
-                msg = "Event %s not be found. This is likely a bug." % \
-                    event_id_1
-                self.log(msg, level="warning")
+            if event_1_dict is None or event_2_dict is None:
+                problems("missing_event",
+                         "Event {event} not be found. This is likely a bug.",
+                         event=self.event_map[event_1]
+                         if event_1_dict is None else self.event_map[event_2])
                 continue
-            if event_2_dict is None:
-                msg = "Event %s not be found. This is likely a bug." % \
-                    event_id_2
-                self.log(msg, level="warning")
-                continue
-            # Write the leading string in the dt.cc file.
-            current_pair_strings.append(
-                "# {event_id_1}  {event_id_2} 0.0".format(
-                    event_id_1=event_1, event_id_2=event_2))
-            # Now try to cross-correlate as many picks as possible.
-            for pick_1 in event_1_dict["picks"]:
-                pick_1_station_id = pick_1["station_id"]
-                pick_1_phase = pick_1["phase"]
-                # Try to find the corresponding pick for the second event.
-                pick_2 = None
-                for pick in event_2_dict["picks"]:
-                    if pick["station_id"] == pick_1_station_id and \
-                            pick["phase"] == pick_1_phase:
-                        pick_2 = pick
-                        break
-                # No corresponding pick could be found.
-                if pick_2 is None:
+            pick_pairs = []
+            for pick_1, pick_2 in common_picks(event_1_dict, event_2_dict):
+                # Picks failing the quality screen are never correlated.
+                if pick_1["id"] in self.excluded_picks or \
+                        pick_2["id"] in self.excluded_picks:
+                    self.report.increment("pick_pairs_skipped_quality")
                     continue
-                # we got some previously computed information..
-                if pick_2['id'] in self.cc_results.get(pick_1['id'], {}):
-                    cc_result = self.cc_results.get(pick_1['id'], {})[pick_2['id']]
-                    # .. and it's actual data
-                    if isinstance(cc_result, (list, tuple)) and len(cc_result) == 2:
-                        pick2_corr, cross_corr_coeff = cc_result
-                    # .. but it's only an error message or None for a silent skip
-                    else:
-                        self.log("Skipping pick pair due to error message in preloaded cross correlation result: %s" % str(cc_result))
-                        continue
-                # we got some previously computed information (but picks were order other way round)..
-                elif pick_1['id'] in self.cc_results.get(pick_2['id'], {}):
-                    cc_result = self.cc_results.get(pick_2['id'], {})[pick_1['id']]
-                    # .. and it's actual data
-                    if isinstance(cc_result, (list, tuple)) and len(cc_result) == 2:
-                        # revert time correction for other pick order!
-                        pick2_corr, cross_corr_coeff = -cc_result[0], cc_result[1]
-                    # .. but it's only an error message or None for a silent skip
-                    else:
-                        self.log("Skipping pick pair due to error message in preloaded cross correlation result: %s" % str(cc_result))
-                        continue
+                cc_result = self._get_loaded_cc_result(pick_1, pick_2)
+                if cc_result is None:
+                    task = {"pick_1": pick_1, "pick_2": pick_2}
+                    tasks.append(task)
                 else:
-                    station_id = pick_1["station_id"]
-                    # Try to find data for both picks.
-                    data_files_1 = self._find_data(station_id,
-                                               pick_1["pick_time"] -
-                                               self.cc_param["cc_time_before"],
-                                               self.cc_param["cc_time_before"] +
-                                               self.cc_param["cc_time_after"])
-                    data_files_2 = self._find_data(station_id,
-                                               pick_2["pick_time"] -
-                                               self.cc_param["cc_time_before"],
-                                               self.cc_param["cc_time_before"] +
-                                               self.cc_param["cc_time_after"])
-                    # If any pick has no data, skip this pick pair.
-                    if data_files_1 is False or data_files_2 is False:
-                        continue
-                    # Read all files.
-                    stream_1 = Stream()
-                    stream_2 = Stream()
-                    for waveform_file in data_files_1:
-                        stream_1 += read(waveform_file)
-                    for waveform_file in data_files_2:
-                        stream_2 += read(waveform_file)
-                    # Get the corresponing pick weighting dictionary.
-                    if pick_1_phase == "P":
-                        pick_weight_dict = self.cc_param[
-                            "cc_p_phase_weighting"]
-                    elif pick_1_phase == "S":
-                        pick_weight_dict = self.cc_param[
-                            "cc_s_phase_weighting"]
-                    all_cross_correlations = []
-                    # Loop over all picks and weight them.
-                    for channel, channel_weight in pick_weight_dict.iteritems():
-                        if channel_weight == 0.0:
-                            continue
-                        # Filter the files to obtain the correct trace.
-                        network, station = station_id.split(".")
-                        st_1 = stream_1.select(network=network, station=station,
-                                               channel="*%s" % channel)
-                        st_2 = stream_2.select(network=network, station=station,
-                                               channel="*%s" % channel)
-                        max_starttime_st_1 = pick_1["pick_time"] - \
-                            self.cc_param["cc_time_before"]
-                        min_endtime_st_1 = pick_1["pick_time"] + \
-                            self.cc_param["cc_time_after"]
-                        max_starttime_st_2 = pick_2["pick_time"] - \
-                            self.cc_param["cc_time_before"]
-                        min_endtime_st_2 = pick_2["pick_time"] + \
-                            self.cc_param["cc_time_after"]
-                        # Attempt to find the correct trace.
-                        for trace in st_1:
-                            if trace.stats.starttime > max_starttime_st_1 or \
-                               trace.stats.endtime < min_endtime_st_1:
-                                st_1.remove(trace)
-                        for trace in st_2:
-                            if trace.stats.starttime > max_starttime_st_2 or \
-                               trace.stats.endtime < min_endtime_st_2:
-                                st_2.remove(trace)
-
-                        # cleanup merges, in case the event is included in
-                        # multiple traces (happens for events with very close
-                        # origin times)
-                        st_1.merge(-1)
-                        st_2.merge(-1)
-
-                        if len(st_1) > 1:
-                            msg = "More than one matching trace found for {pick}"
-                            self.log(msg.format(pick=str(pick_1)), level="warning")
-                            self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
-                            continue
-                        elif len(st_1) == 0:
-                            msg = "No matching trace found for {pick}"
-                            self.log(msg.format(pick=str(pick_1)), level="warning")
-                            self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
-                            continue
-                        trace_1 = st_1[0]
-
-                        if len(st_2) > 1:
-                            msg = "More than one matching trace found for {pick}"
-                            self.log(msg.format(pick=str(pick_1)), level="warning")
-                            self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
-                            continue
-                        elif len(st_2) == 0:
-                            msg = "No matching trace found for {pick}"
-                            self.log(msg.format(pick=str(pick_1)), level="warning")
-                            self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
-                            continue
-                        trace_2 = st_2[0]
-
-                        if trace_1.id != trace_2.id:
-                            msg = "Non matching ids during cross correlation. "
-                            msg += "(%s and %s)" % (trace_1.id, trace_2.id)
-                            self.log(msg, level="warning")
-                            self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
-                            continue
-                        if trace_1.stats.sampling_rate != \
-                                trace_2.stats.sampling_rate:
-                            msg = ("Non matching sampling rates during cross "
-                                   "correlation. ")
-                            msg += "(%s and %s)" % (trace_1.id, trace_2.id)
-                            self.log(msg, level="warning")
-                            self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
-                            continue
-
-                        # Call the cross correlation function.
-                        with warnings.catch_warnings():
-                            warnings.simplefilter("ignore")
-                            try:
-                                pick2_corr, cross_corr_coeff = \
-                                    xcorr_pick_correction(
-                                        pick_1["pick_time"], trace_1,
-                                        pick_2["pick_time"], trace_2,
-                                        t_before=self.cc_param["cc_time_before"],
-                                        t_after=self.cc_param["cc_time_after"],
-                                        cc_maxlag=self.cc_param["cc_maxlag"],
-                                        filter="bandpass",
-                                        filter_options={
-                                            "freqmin":
-                                            self.cc_param["cc_filter_min_freq"],
-                                            "freqmax":
-                                            self.cc_param["cc_filter_max_freq"]},
-                                        plot=False)
-                            except Exception, err:
-                                # XXX: Maybe maxlag is too short?
-                                if not err.message.startswith("Less than 3"):
-                                    msg = "Error during cross correlating: "
-                                    msg += err.message
-                                    self.log(msg, level="error")
-                                    self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = msg
-                                    continue
-                        all_cross_correlations.append((pick2_corr,
-                                               cross_corr_coeff, channel_weight))
-                    if len(all_cross_correlations) == 0:
-                        self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = "No cross correlations performed"
-                        continue
-                    # Now combine all of them based upon their weight.
-                    pick2_corr = sum([_i[0] * _i[2] for _i in
-                                      all_cross_correlations])
-                    cross_corr_coeff = sum([_i[1] * _i[2] for _i in
-                                            all_cross_correlations])
-                    weight = sum([_i[2] for _i in all_cross_correlations])
-                    pick2_corr /= weight
-                    cross_corr_coeff /= weight
-                    self.cc_results.setdefault(pick_1['id'], {})[pick_2['id']] = (pick2_corr, cross_corr_coeff)
+                    self.report.increment("cc_cache_hits")
+                    task = {"pick_1": pick_1, "pick_2": pick_2,
+                            "result": cc_result, "loaded": True}
+                pick_pairs.append(task)
+            pairs.append((event_1, event_2, event_1_dict, event_2_dict,
+                          pick_pairs))
+
+        # Correlate in station and time order so the waveform files are
+        # mostly served from the stream cache while the files of the
+        # following pick pairs are read ahead. The order of dt.cc is not
+        # affected. Only the pick pairs of this chunk are reordered, so on
+        # large catalogs a waveform file is still decoded again for every
+        # chunk needing it once it left the cache.
+        correlator.correlate_tasks(schedule_pick_pairs(tasks))
+        counters, correlator_problems = correlator.drain()
+        for counter, value in counters.iteritems():
+            self.report.increment(counter, value)
+        for reason, message, level, kwargs in correlator_problems:
+            problems(reason, message, level=level, **kwargs)
+
+        blocks = []
+        results = []
+        for event_1, event_2, event_1_dict, event_2_dict, pick_pairs in pairs:
+            # The leading string in the dt.cc file.
+            lines = ["# {event_id_1}  {event_id_2} 0.0".format(
+                event_id_1=event_1, event_id_2=event_2)]
+            for task in pick_pairs:
+                pick_1, pick_2 = task["pick_1"], task["pick_2"]
+                cc_result = task["result"]
+                if not task.get("loaded") and cc_result is not None:
+                    results.append((pick_1["id"], pick_2["id"], cc_result))
+                # .. but it's only an error message or None for a silent skip
+                if not isinstance(cc_result, (list, tuple)):
+                    if task.get("loaded"):
+                        problems("preloaded_error", "Skipping pick pair due "
+                                 "to error message in preloaded cross "
+                                 "correlation result: {result}",
+                                 level="info", result=cc_result)
+                    continue
+                pick2_corr, cross_corr_coeff = cc_result
                 # If the cross_corr_coeff is under the allowed limit, discard
                 # it.
                 if cross_corr_coeff < \
                         self.cc_param["cc_min_allowed_cross_corr_coeff"]:
+                    self.report.increment("pick_pairs_below_min_coeff")
                     continue
+                self.report.increment("pick_pairs_written")
                 # Otherwise calculate the corrected differential travel time.
                 diff_travel_time = (pick_2["pick_time"] + pick2_corr -
                     event_2_dict["origin_time"]) - (pick_1["pick_time"] -
                     event_1_dict["origin_time"])
                 string = "{station_id} {travel_time:.6f} {weight:.4f} {phase}"
-                string = string.format(
+                lines.append(string.format(
                     station_id=pick_1["station_id"],
                     travel_time=diff_travel_time,
                     weight=cross_corr_coeff,
-                    phase=pick_1["phase"])
-                current_pair_strings.append(string)
-            # Write the file.
-            with open(event_pair_file, "w") as open_file:
-                open_file.write("\n".join(current_pair_strings))
-        pbar.finish()
-        self.log("Finished calculating cross correlations.")
-        if outfile:
-            self.save_cross_correlation_results(outfile)
-        # Assemble final file.
-        final_string = []
-        for cc_file in glob.iglob(os.path.join(cc_dir, "*.txt")):
-            with open(cc_file, "r") as open_file:
-                final_string.append(open_file.read().strip())
-        final_string = "\n".join(final_string)
-        with open(ct_file_path, "w") as open_file:
-            open_file.write(final_string)
+                    phase=pick_1["phase"]))
+            blocks.append("\n".join(lines))
+        return blocks, results
+
+    def _get_loaded_cc_result(self, pick_1, pick_2):
+        """
+        Returns the loaded cross correlation result of a pick pair or None.
+        Results stored for the reversed pick order are converted.
+        """
+        # we got some previously computed information..
+        if pick_2['id'] in self.cc_results.get(pick_1['id'], {}):
+            return self.cc_results[pick_1['id']][pick_2['id']]
+        # we got some previously computed information (but picks were order
+        # other way round)..
+        if pick_1['id'] in self.cc_results.get(pick_2['id'], {}):
+            cc_result = self.cc_results[pick_2['id']][pick_1['id']]
+            # revert time correction for other pick order!
+            if isinstance(cc_result, (list, tuple)) and len(cc_result) == 2:
+                return (-cc_result[0], cc_result[1])
+            return cc_result
+        return None
+
+    def _log_problem_summary(self, problems):
+        """
+        Logs the summary table of a LogAggregator and adds its counts to the
+        run report.
+        """
+        lines = problems.summary_lines()
+        if not lines:
+            return
+        self.log("Problems during cross correlation:\n\t" +
+                 "\n\t".join(lines), level="warning")
+        for reason, count in problems.counts.iteritems():
+            self.report.increment("cc_problem_%s" % reason, count)
 
     def _find_data(self, station_id, starttime, duration):
         """"
@@ -1135,6 +2337,7 @@ class HypoDDRelocator(object):
         :param starttime: The minimum starttime of the data.
         :param duration: The minimum duration of the data.
         """
+        self.report.increment("find_data_calls")
         endtime = starttime + duration
         # Find all possible keys for the station_id.
         id_pattern = "{station_id}.*.*[E,N,Z]".format(station_id=station_id)
@@ -1187,10 +2390,7 @@ class HypoDDRelocator(object):
         values["IPHA"] = 3
         # Max distance between centroid of event cluster and stations.
         values["DIST"] = self.forced_configuration_values["MAXDIST"]
-        # Always set it to 8.
-        values["OBSCC"] = 8
-        # If IDAT=3, the sum of OBSCC and OBSCT is taken for both.
-        values["OBSCT"] = 0
+        values.update(self._get_link_thresholds())
         # Set min/max distances/azimuthal gap to -999 (not used)
         values["MINDS"] = -999
         values["MAXDS"] = -999
@@ -1198,7 +2398,7 @@ class HypoDDRelocator(object):
         # Start from catalog locations
         values["ISTART"] = 2
         # Least squares solution via conjugate gradients
-        values["ISOLV"] = 2
+        values["ISOLV"] = self.forced_configuration_values.get("ISOLV", 2)
         values["IAQ"] = 2
         # Create the data_weighting and reweightig scheme. Currently static.
         # Iterative 10 times for only cross correlated travel time data and
@@ -1218,6 +2418,45 @@ class HypoDDRelocator(object):
             open_file.write(hypodd_inp)
         self.log("Created hypoDD.inp input file.")
 
+    def _get_link_thresholds(self):
+        """
+        Returns the OBSCC and OBSCT values of hypoDD.inp, the minimum number
+        of cross correlation and catalog observations linking an event pair.
+        """
+        # Defaults to 8. If IDAT=3, the sum of OBSCC and OBSCT is taken for
+        # both.
+        values = {"OBSCC": 8, "OBSCT": 0}
+        for key in values:
+            if key in self.forced_configuration_values:
+                values[key] = self.forced_configuration_values[key]
+        return values
+
+    def setup_pick_quality_screen(self, min_snr=2.0, min_coverage=1.0,
+                                  reject_gaps=True, reject_clipped=True,
+                                  noise_length=None):
+        """
+        Screens the data of every pick once before the cross correlation
+        and excludes the picks whose data fail on all channels from all
+        pick pairs, see hypodd_pick_quality.
+
+        :param min_snr: Minimum signal to noise ratio in the cross
+            correlation band.
+        :param min_coverage: Minimum covered fraction of the cross
+            correlation window.
+        :param reject_gaps: Reject data with gaps in the cross correlation
+            window.
+        :param reject_clipped: Reject clipped data.
+        :param noise_length: Length of the noise window before the cross
+            correlation window in seconds. Defaults to three times the
+            length of the cross correlation window.
+        """
+        self.pick_quality_param = {
+            "min_snr": min_snr,
+            "min_coverage": min_coverage,
+            "reject_gaps": reject_gaps,
+            "reject_clipped": reject_clipped,
+            "noise_length": noise_length}
+
     def setup_velocity_model(self, model_type, **kwargs):
         """
         Defines the used velocity model for the forward simulation. The chosen
@@ -1277,167 +2516,240 @@ class HypoDDRelocator(object):
             raise HypoDDException(msg)
         return self.forward_model_string
 
-    def _create_output_event_file(self):
+    def _read_relocated_origins(self):
         """
-        Write the final output file in QuakeML format.
+        Parses hypoDD.reloc and returns a dictionary mapping the event id
+        strings to new Origin objects and a dictionary mapping them to the
+        HypoDD cluster ids.
         """
-        self.log("Writing final output file...")
+        from obspy.core import UTCDateTime
+        from obspy.core.event import Comment, Origin
+        from hypodd_output import read_reloc
+
         hypodd_reloc = os.path.join(os.path.join(self.working_dir,
             "output_files", "hypoDD.reloc"))
+        origins = {}
+        cluster_ids = {}
+        reloc = read_reloc(hypodd_reloc)
+        for row in reloc:
+            event_id = self.event_map[int(row["ID"])]
+            cluster_id = int(row["CID"])
+            second = float(row["SC"])
+            # Create new origin.
+            new_origin = Origin()
+            sec = int(second)
+            # Correct for a bug in hypoDD which can write 60 seconds...
+            add_minute = False
+            if sec >= 60:
+                sec = 0
+                add_minute = True
+            new_origin.time = UTCDateTime(int(row["YR"]), int(row["MO"]),
+                int(row["DY"]), int(row["HR"]), int(row["MI"]), sec,
+                int((second % 1.0) * 1E6))
+            if add_minute is True:
+                new_origin.time = new_origin.time + 60.0
+            new_origin.latitude = float(row["LAT"])
+            new_origin.longitude = float(row["LON"])
+            # Convert back to meters.
+            new_origin.depth = float(row["DEPTH"]) * 1000.0
+            new_origin.method_id = "HypoDD"
+            # Put the cluster id in the comments to be able to use it later
+            # on.
+            new_origin.comments.append(Comment(
+                text="HypoDD cluster id: %i" % cluster_id))
+            origins[event_id] = new_origin
+            cluster_ids[event_id] = cluster_id
+        return origins, cluster_ids
+
+    def _create_output_event_file(self, origin_sidecar=None):
+        """
+        Write the final output file in QuakeML format.
 
-        cat = Catalog()
-        self.output_catalog = cat
-        for filename in self.event_files:
-            cat += read_events(filename)
-
-        with open(hypodd_reloc, "r") as open_file:
-            for line in open_file:
-                event_id, lat, lon, depth, _, _, _, _, _, _, year, month, \
-                    day, hour, minute, second, _, _, _, _, _, _, _, \
-                    cluster_id = line.split()
-                event_id = self.event_map[int(event_id)]
-                cluster_id = int(cluster_id)
-                res_id = ResourceIdentifier(event_id)
-                lat, lon, depth = map(float, [lat, lon, depth])
-                # Convert back to meters.
-                depth *= 1000.0
-                event = res_id.getReferredObject()
-                # Create new origin.
-                new_origin = Origin()
-                sec = int(float(second))
-                # Correct for a bug in hypoDD which can write 60 seconds...
-                add_minute = False
-                if sec >= 60:
-                    sec = 0
-                    add_minute = True
-                new_origin.time = UTCDateTime(int(year), int(month), int(day),
-                    int(hour), int(minute), sec,
-                    int((float(second) % 1.0) * 1E6))
-                if add_minute is True:
-                    new_origin.time = new_origin.time + 60.0
-                new_origin.latitude = lat
-                new_origin.longitude = lon
-                new_origin.depth = depth
-                new_origin.method_id = "HypoDD"
-                # Put the cluster id in the comments to be able to use it later
-                # on.
-                new_origin.comments.append(Comment(
-                    text="HypoDD cluster id: %i" % cluster_id))
-                event.origins.append(new_origin)
-        cat.write(self.output_event_file, format="quakeml")
+        The input events are streamed one at a time from the event files and
+        the in-memory catalogs, the relocated origin is attached and the event
+        is directly appended to the output file so the full catalog is never
+        kept in memory.
+
+        :param origin_sidecar: If "csv" or "npz", additionally write only the
+            relocated origins to a compact file next to the output file.
+        """
+        from hypodd_quakeml import iter_events, QuakeMLStreamWriter
+
+        self.log("Writing final output file...")
+        origins, cluster_ids = self._read_relocated_origins()
+
+        relocated_count = 0
+        # Events of in-memory catalogs are copied to leave them unchanged.
+        events = itertools.chain(
+            itertools.chain.from_iterable(
+                iter_events(_i) for _i in self.event_files),
+            (event.copy() for catalog in self.catalogs for event in catalog))
+        with QuakeMLStreamWriter(self.output_event_file) as writer:
+            for event in events:
+                origin = origins.get(str(event.resource_id))
+                if origin is not None:
+                    event.origins.append(origin)
+                    relocated_count += 1
+                writer.write(event)
+        self.log("Wrote %i events, %i of them relocated." %
+                 (writer.count, relocated_count))
+        if origin_sidecar is not None:
+            self._write_origin_sidecar(origins, cluster_ids, origin_sidecar)
 
         self.log("Finished! Final output file: %s" % self.output_event_file)
 
-    def _create_plots(self):
+    def export_output_files(self, filename):
+        """
+        Export the parsed HypoDD output files hypoDD.loc, hypoDD.reloc,
+        hypoDD.sta, hypoDD.res and hypoDD.src to a single compressed columnar
+        NumPy .npz file. See hypodd_output.export_columnar() for the naming of
+        the arrays.
+
+        :param filename: The filename of the .npz file.
+        """
+        from hypodd_output import export_columnar
+
+        arrays = export_columnar(self.paths["output_files"], filename)
+        self.log("Exported %i columns of the HypoDD output files to: %s" %
+                 (len(arrays), filename))
+
+    def _check_origin_sidecar(self, origin_sidecar):
+        """
+        Raises before any work is done if origin_sidecar is not a known
+        format.
+        """
+        if origin_sidecar not in ORIGIN_SIDECAR_FORMATS:
+            msg = "Unknown origin sidecar format '%s'. Use one of %s." % (
+                origin_sidecar, ", ".join(
+                    repr(_i) for _i in ORIGIN_SIDECAR_FORMATS))
+            raise HypoDDException(msg)
+
+    def _check_plot_style(self, plot_style):
+        """
+        Raises before any work is done if plot_style is not a known style.
+        """
+        from hypodd_plotting import PLOT_STYLES
+
+        if plot_style not in PLOT_STYLES:
+            msg = "Unknown plot style '%s'. Use one of %s." % (
+                plot_style, ", ".join(PLOT_STYLES))
+            raise HypoDDException(msg)
+
+    def _write_origin_sidecar(self, origins, cluster_ids, file_format):
         """
-        Creates some plots of the relocated event Catalog.
+        Writes all relocated origins to a compact CSV or NPZ file next to the
+        output event file.
+
+        :param file_format: "csv" or "npz".
         """
-        import matplotlib.pylab as plt
-        from matplotlib.cm import get_cmap
-        from matplotlib.colors import ColorConverter
+        import numpy as np
+
+        event_ids = sorted(origins.keys(), key=lambda x: self.event_map[x])
+        filename = "%s_origins.%s" % (
+            os.path.splitext(self.output_event_file)[0], file_format)
+        if file_format == "csv":
+            import csv
+            with open(filename, "w") as open_file:
+                writer = csv.writer(open_file)
+                writer.writerow(["event_id", "time", "latitude", "longitude",
+                                 "depth", "cluster_id"])
+                for event_id in event_ids:
+                    origin = origins[event_id]
+                    writer.writerow([event_id, str(origin.time),
+                                     "%.6f" % origin.latitude,
+                                     "%.6f" % origin.longitude,
+                                     "%.1f" % origin.depth,
+                                     cluster_ids[event_id]])
+        elif file_format == "npz":
+            np.savez_compressed(
+                filename,
+                event_id=np.array(event_ids),
+                time=np.array([origins[_i].time.timestamp
+                               for _i in event_ids]),
+                latitude=np.array([origins[_i].latitude for _i in event_ids]),
+                longitude=np.array([origins[_i].longitude
+                                    for _i in event_ids]),
+                depth=np.array([origins[_i].depth for _i in event_ids]),
+                cluster_id=np.array([cluster_ids[_i] for _i in event_ids]))
+        else:
+            msg = "Unknown origin sidecar format '%s'." % file_format
+            raise HypoDDException(msg)
+        self.log("Relocated origins written to: %s" % filename)
+
+    def _create_plots(self, plot_style="auto", background=True):
+        """
+        Creates some plots of the original and relocated event locations in
+        working_dir/output_files.
+
+        The coordinates are collected in arrays in a single pass and the
+        figures are by default rendered in a background process so the
+        relocation does not block on matplotlib. Use wait_for_plots() to
+        wait for them.
+
+        :param plot_style: One of "auto", "scatter", "rasterized" or
+            "density". "auto" chooses depending on the number of events. See
+            the hypodd_plotting module.
+        :param background: Render the plots in a separate process.
+        """
+        import multiprocessing
+        import numpy as np
+        from hypodd_output import read_reloc
+        from hypodd_plotting import render_location_plots
 
-        catalog = self.output_catalog
         # Generate the output plot filenames.
         original_filename = os.path.join(self.paths["output_files"],
             "original_event_location.pdf")
         relocated_filename = os.path.join(self.paths["output_files"],
             "relocated_event_location.pdf")
 
-        # Some lists to store everything in.
-        original_latitudes = []
-        original_longitudes = []
-        original_depths = []
-        relocated_latitudes = []
-        relocated_longitudes = []
-        relocated_depths = []
-        # The colors will be used to distinguish between different event types.
-        # grey: event will/have not been relocated.
-        # red: relocated with cluster id 1
-        # green: relocated with cluster id 2
-        # blue: relocated with cluster id 3
-        # yellow: relocated with cluster id 4
-        # orange: relocated with cluster id 5
-        # cyan: relocated with cluster id 6
-        # magenta: relocated with cluster id 7
-        # brown: relocated with cluster id 8
-        # lime: relocated with cluster id >8 or undetermined cluster_id
-        color_invalid = ColorConverter().to_rgba("grey")
-        cmap = get_cmap("Paired", 12)
-
-        colors = []
-        magnitudes = []
+        event_count = len(self.events)
+        latitudes = np.empty(event_count)
+        longitudes = np.empty(event_count)
+        depths = np.empty(event_count)
+        for _i, event in enumerate(self.events):
+            latitudes[_i] = event["origin_latitude"]
+            longitudes[_i] = event["origin_longitude"]
+            depths[_i] = event["origin_depth"] / 1000.0
+        # Not relocated events keep their original location and have a
+        # negative cluster id.
+        relocated_latitudes = latitudes.copy()
+        relocated_longitudes = longitudes.copy()
+        relocated_depths = depths.copy()
+        cluster_ids = -np.ones(event_count, dtype=np.int64)
+        reloc = read_reloc(os.path.join(self.paths["output_files"],
+                                        "hypoDD.reloc"))
+        # HypoDD ids are the position in self.events plus one.
+        index = reloc["ID"] - 1
+        relocated_latitudes[index] = reloc["LAT"]
+        relocated_longitudes[index] = reloc["LON"]
+        relocated_depths[index] = reloc["DEPTH"]
+        cluster_ids[index] = reloc["CID"]
+
+        args = ((latitudes, longitudes, depths),
+                (relocated_latitudes, relocated_longitudes, relocated_depths),
+                cluster_ids, (original_filename, relocated_filename),
+                plot_style)
+        if not background:
+            render_location_plots(*args)
+            self.log("Output figures: %s, %s" % (original_filename,
+                                                 relocated_filename))
+            return
+        self._plot_process = multiprocessing.Process(
+            target=render_location_plots, args=args)
+        self._plot_process.start()
+        self.log("Rendering output figures in the background: %s, %s" %
+                 (original_filename, relocated_filename))
 
-        for event in catalog:
-            # The first event is always the original one.
-            original_latitudes.append(event.origins[0].latitude)
-            original_longitudes.append(event.origins[0].longitude)
-            original_depths.append(event.origins[0].depth / 1000.0)
-            # The last one can either be a relocated one or an original one.
-            relocated_latitudes.append(event.origins[-1].latitude)
-            relocated_longitudes.append(event.origins[-1].longitude)
-            relocated_depths.append(event.origins[-1].depth / 1000.0)
-            magnitudes.append(event.magnitudes[0])
-            # Use color to Code the different events. Colorcode by event
-            # cluster or indicate if an event did not get relocated.
-            if event.origins[-1].method_id is None or \
-               "HYPODD" not in str(event.origins[-1].method_id).upper():
-                colors.append(color_invalid)
-            # Otherwise get the cluster id, stored in the comments.
-            else:
-                for comment in event.origins[-1].comments:
-                    comment = comment.text
-                    if comment and "HypoDD cluster id" in comment:
-                        cluster_id = int(comment.split(":")[-1])
-                        break
-                else:
-                    cluster_id = 0
-                colors.append(cmap(int(cluster_id)))
-
-        # Plot the original event location.
-        plt.subplot(221)
-        plt.scatter(original_latitudes, original_depths, c=colors)
-        plt.xlabel("Latitude")
-        plt.ylabel("Depth in km")
-        # Invert the depth axis.
-        plt.ylim(plt.ylim()[::-1])
-        plot1_xlim = plt.xlim()
-        plot1_ylim = plt.ylim()
-        plt.subplot(222)
-        plt.scatter(original_longitudes, original_depths, c=colors)
-        plt.xlabel("Longitude")
-        plt.ylabel("Depth in km")
-        plt.ylim(plt.ylim()[::-1])
-        # Invert the depth axis.
-        plot2_xlim = plt.xlim()
-        plot2_ylim = plt.ylim()
-        plt.subplot(212)
-        plt.scatter(original_longitudes, original_latitudes, c=colors)
-        plt.xlabel("Longitude")
-        plt.ylabel("Latitude")
-        plot3_xlim = plt.xlim()
-        plot3_ylim = plt.ylim()
-        plt.savefig(original_filename)
-        self.log("Output figure: %s" % original_filename)
-
-        # Plot the relocated event locations.
-        plt.clf()
-        plt.subplot(221)
-        plt.scatter(relocated_latitudes, relocated_depths, c=colors)
-        plt.xlabel("Latitude")
-        plt.ylabel("Depth in km")
-        plt.xlim(plot1_xlim)
-        plt.ylim(plot1_ylim)
-        plt.subplot(222)
-        plt.scatter(relocated_longitudes, relocated_depths, c=colors)
-        plt.xlabel("Longitude")
-        plt.ylabel("Depth in km")
-        plt.xlim(plot2_xlim)
-        plt.ylim(plot2_ylim)
-        plt.subplot(212)
-        plt.scatter(relocated_longitudes, relocated_latitudes, c=colors)
-        plt.xlabel("Longitude")
-        plt.ylabel("Latitude")
-        plt.xlim(plot3_xlim)
-        plt.ylim(plot3_ylim)
-        plt.savefig(relocated_filename)
-        self.log("Output figure: %s" % relocated_filename)
+    def wait_for_plots(self):
+        """
+        Wait until the plots rendered in the background are finished.
+        """
+        process = getattr(self, "_plot_process", None)
+        if process is None:
+            return
+        process.join()
+        self._plot_process = None
+        if process.exitcode != 0:
+            self.log("Rendering the output figures failed.", level="error")
+        else:
+            self.log("Output figures finished.")
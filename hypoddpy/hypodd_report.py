@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Timing and counter report of a relocation run.
+
+Every stage of a run is timed with its wall time, the CPU time of the process
+and its children (ph2dt and hypoDD) and the peak resident set size. Counters
+of the hot paths and the metrics of the external ph2dt and hypoDD runs are
+collected alongside. The report is written as JSON to
+working_dir/run_report.json.
+"""
+import contextlib
+import json
+import resource
+import sys
+import time
+
+
+def _rusage():
+    """
+    Returns the CPU time of the process and its waited for children in
+    seconds and the peak RSS of the process and of its largest child in
+    bytes.
+    """
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_time = usage_self.ru_utime + usage_self.ru_stime + \
+        usage_children.ru_utime + usage_children.ru_stime
+    # Linux reports kilobytes, macOS bytes.
+    factor = 1 if sys.platform == "darwin" else 1024
+    return cpu_time, usage_self.ru_maxrss * factor, \
+        usage_children.ru_maxrss * factor
+
+
+class RunReport(object):
+    """
+    Collects stage timings and counters.
+
+    Usage
+    =====
+
+    >>> report = RunReport()
+    >>> with report.stage("read_event_information"):
+    ...     report.increment("events_read", 100)
+    >>> report.write("run_report.json")
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.stages = []
+        self.counters = {}
+        self.external_runs = {}
+
+    def increment(self, counter, value=1):
+        """
+        Increments a counter by value.
+        """
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def add_external_run(self, name, metrics):
+        """
+        Adds the metrics of a run of an external executable as returned by
+        hypodd_external.run_external(). The captured output is replaced by
+        its number of lines.
+        """
+        metrics = dict(metrics)
+        metrics["output_lines"] = len(metrics.pop("output", []))
+        self.external_runs[name] = metrics
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager timing a stage. A failing stage is recorded with its
+        error message before the exception is passed on.
+        """
+        record = {"name": name, "status": "running"}
+        self.stages.append(record)
+        cpu_before = _rusage()[0]
+        wall_before = time.time()
+        try:
+            yield record
+        except Exception as err:
+            record["status"] = "failed"
+            record["error"] = str(err)
+            raise
+        else:
+            record["status"] = "ok"
+        finally:
+            cpu_after, peak_rss, children_peak_rss = _rusage()
+            record["wall_time"] = time.time() - wall_before
+            record["cpu_time"] = cpu_after - cpu_before
+            # The peak RSS is a high-water mark of the whole process.
+            record["peak_rss"] = peak_rss
+            record["children_peak_rss"] = children_peak_rss
+
+    def as_dict(self):
+        """
+        Returns the report as a JSON serializable dictionary.
+        """
+        return {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                     time.localtime(self.start_time)),
+            "total_wall_time": time.time() - self.start_time,
+            "stages": self.stages,
+            "counters": self.counters,
+            "external_runs": self.external_runs}
+
+    def write(self, filename):
+        """
+        Writes the report as JSON to filename.
+        """
+        with open(filename, "w") as open_file:
+            json.dump(self.as_dict(), open_file, indent=2, sort_keys=True)
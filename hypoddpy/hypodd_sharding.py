@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Sharding of the cross correlation stage over several invocations or nodes.
+
+The event pairs of dt.ct are split into shard_count contiguous shards of
+nearly equal size. The shards only depend on the number of event pairs, so
+every invocation working on the same dt.ct selects the same event pairs for
+the same shard index. Every shard is correlated independently into its own
+directory working_dir/working_files/cc_shards/shard_<index>_of_<count>
+with a manifest recording the shard, the md5 hash of dt.ct and the cross
+correlation parameters. An interrupted shard continues where it stopped.
+
+merge_shards() concatenates the dt.cc files of all shards in shard order,
+which is the dt.ct order of an unsharded run, and merges their cross
+correlation results with bounded memory. Shards disagreeing about the result
+of a pick pair are reported as conflicts and nothing is written.
+
+Usage
+=====
+
+All nodes have to see the same working directory and waveform files. The
+working directory is prepared once, then every node correlates one shard
+and finally the shards are merged and the relocation continues:
+
+>>> relocator.prepare_cross_correlation()
+>>> relocator.cross_correlate_shard(shard_index, shard_count)
+>>> relocator.merge_cross_correlation_shards(shard_count)
+>>> relocator.start_relocation(output_event_file="relocated_events.xml")
+
+relocator.cross_correlate_shards_locally(shard_count) runs all shards in
+local worker processes standing in for the nodes and merges them.
+"""
+import json
+import os
+
+from hypodd_cc_priority import RESULT_RUN_SIZE, ResultSpill
+from hypodd_cross_correlation import iter_cc_results
+
+
+def shard_range(pair_count, shard_index, shard_count):
+    """
+    Returns the (start, stop) indices of the event pairs of dt.ct belonging
+    to a shard.
+    """
+    if not 0 <= shard_index < shard_count:
+        msg = "shard_index has to be between 0 and shard_count - 1."
+        raise ValueError(msg)
+    return (pair_count * shard_index // shard_count,
+            pair_count * (shard_index + 1) // shard_count)
+
+
+def shard_directory(working_files, shard_index, shard_count):
+    """
+    Returns the directory of a shard.
+    """
+    return os.path.join(working_files, "cc_shards",
+                        "shard_%04i_of_%04i" % (shard_index, shard_count))
+
+
+def read_shard_manifest(directory):
+    """
+    Returns the manifest of a shard directory or None if there is none.
+    """
+    manifest_file = os.path.join(directory, "shard.json")
+    if not os.path.exists(manifest_file):
+        return None
+    with open(manifest_file, "r") as open_file:
+        return json.load(open_file)
+
+
+def write_shard_manifest(directory, manifest):
+    """
+    Writes the manifest of a shard. Returns the list of manifest keys that
+    differ from an already existing manifest, in which case the existing
+    manifest is kept.
+    """
+    # Compare the JSON representations, tuples become lists.
+    manifest = json.loads(json.dumps(manifest))
+    existing = read_shard_manifest(directory)
+    if existing is not None:
+        return sorted(_i for _i in set(manifest) | set(existing)
+                      if manifest.get(_i) != existing.get(_i))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    manifest_file = os.path.join(directory, "shard.json")
+    with open(manifest_file + ".tmp", "w") as open_file:
+        json.dump(manifest, open_file, sort_keys=True)
+    os.rename(manifest_file + ".tmp", manifest_file)
+    return []
+
+
+def _normalized_result(pick_id_1, pick_id_2, result):
+    """
+    Returns the key and result of a cross correlation result independent of
+    the order of the picks.
+    """
+    if pick_id_1 <= pick_id_2:
+        return (pick_id_1, pick_id_2), result
+    if isinstance(result, (list, tuple)) and len(result) == 2:
+        result = [-result[0], result[1]]
+    return (pick_id_2, pick_id_1), result
+
+
+def merge_shards(shard_dirs, dt_cc_file, results_file,
+                 run_size=RESULT_RUN_SIZE):
+    """
+    Merges finished shards.
+
+    The dt.cc files of the shards are concatenated in the given order to
+    dt_cc_file. Their cross correlation results and those already in the
+    JSON lines results_file are merged into results_file, ordered by pick
+    pair. The memory usage does not depend on the number of results: they
+    are spilled to disk in sorted runs of run_size results by a
+    ResultSpill and merged, so only one pick pair is compared at a time.
+    For pick pairs with several results, the first one in results_file or
+    in shard order is kept.
+
+    Returns a list of (pick_id_1, pick_id_2, result_1, result_2) tuples of
+    all pick pairs with different results. Nothing is written if there are
+    any.
+    """
+    sources = [os.path.join(_i, "cc_results.jsonl") for _i in shard_dirs]
+    if os.path.exists(results_file):
+        sources.insert(0, results_file)
+    spill = ResultSpill(results_file + ".merge", run_size=run_size)
+    conflicts = []
+    temp_file = results_file + ".tmp"
+    try:
+        for _i, filename in enumerate(sources):
+            for _j, (pick_id_1, pick_id_2, result) in \
+                    enumerate(iter_cc_results(filename)):
+                key, _ = _normalized_result(pick_id_1, pick_id_2, result)
+                # The source and line make the positions unique.
+                spill.add(key + (_i, _j), pick_id_1, pick_id_2, result)
+        with open(temp_file, "w") as open_file:
+            current_key, current = None, None
+            for _, pick_id_1, pick_id_2, result in spill:
+                key, normalized = _normalized_result(pick_id_1, pick_id_2,
+                                                     result)
+                if key != current_key:
+                    current_key, current = key, normalized
+                    open_file.write(json.dumps([pick_id_1, pick_id_2,
+                                                result]) + "\n")
+                elif normalized != current:
+                    conflicts.append((key[0], key[1], current, normalized))
+    finally:
+        spill.close()
+    if conflicts:
+        os.remove(temp_file)
+        return conflicts
+    os.rename(temp_file, results_file)
+
+    temp_file = dt_cc_file + ".tmp"
+    with open(temp_file, "w") as open_file:
+        for shard_dir in shard_dirs:
+            with open(os.path.join(shard_dir, "dt.cc"), "r") as shard_dt_cc:
+                for line in shard_dt_cc:
+                    open_file.write(line)
+    os.rename(temp_file, dt_cc_file)
+    return []
+
+
+def _cross_correlate_shard(spec):
+    """
+    Correlates a single shard in a fresh relocator on a prepared working
+    directory. Module level function so it can be used with a
+    multiprocessing pool.
+    """
+    # Imported here to avoid a circular import.
+    from hypodd_relocator import HypoDDRelocator
+
+    relocator = HypoDDRelocator(working_dir=spec["working_dir"],
+                                **spec["cc_param"])
+    relocator.forced_configuration_values.update(
+        spec["forced_configuration_values"])
+    relocator.external_binaries = spec.get("external_binaries", {})
+    relocator.binary_cache_dir = spec.get("binary_cache_dir")
+    relocator.pick_quality_param = spec.get("pick_quality_param")
+    relocator.cc_time_budget = spec.get("cc_time_budget")
+    for filename in spec.get("cc_results_files", []):
+        relocator.load_cross_correlation_results(filename)
+    relocator.cross_correlate_shard(spec["shard_index"],
+                                    spec["shard_count"])
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Data driven array sizes for hypoDD.inc.
+
+hypoDD allocates all arrays statically. Too small arrays make hypoDD abort,
+too large ones waste memory. The sizes are derived from the actual
+differential time files:
+
+    * MAXDATA: All observations in dt.cc and dt.ct.
+    * MAXCL: The number of clusters. As hypoDD, events are linked if a pair
+      has at least min_links observations in both files together and the
+      clusters are the connected components of the links.
+    * MAXEVE0 and MAXDATA0: The events and observations of the largest
+      cluster as these are the dimensions of the SVD system. If LSQR
+      (ISOLV=2) is used, they are set to their minimal values of 2 and 1.
+
+All sizes get some headroom.
+"""
+import math
+
+
+# Relative headroom of all derived sizes.
+HEADROOM = 1.2
+# Absolute headroom of all derived sizes.
+MINIMUM_HEADROOM = 10
+
+
+def _read_pairs(filename, counts):
+    """
+    Adds the number of observations of every event pair in a dt.cc or dt.ct
+    file to counts.
+    """
+    pair = None
+    with open(filename, "r") as open_file:
+        for line in open_file:
+            if line.startswith("#"):
+                items = line[1:].split()
+                pair = (int(items[0]), int(items[1]))
+                counts.setdefault(pair, 0)
+            elif pair is not None and line.strip():
+                counts[pair] += 1
+
+
+def read_link_statistics(dt_cc=None, dt_ct=None, min_links=8):
+    """
+    Reads dt.cc and dt.ct and returns a dictionary with:
+
+        * "observations": The total number of observations.
+        * "clusters": A list of (number of events, number of observations)
+          tuples of all clusters, sorted by decreasing size.
+        * "linked_events": The number of events in all clusters.
+
+    :param min_links: Minimum number of observations of a pair to link its
+        events.
+    """
+    counts = {}
+    for filename in [dt_cc, dt_ct]:
+        if filename:
+            _read_pairs(filename, counts)
+
+    parents = {}
+
+    def find(event):
+        parents.setdefault(event, event)
+        while parents[event] != event:
+            parents[event] = parents[parents[event]]
+            event = parents[event]
+        return event
+
+    for (event_1, event_2), count in counts.items():
+        if count >= min_links:
+            parents[find(event_1)] = find(event_2)
+    clusters = {}
+    for event in list(parents.keys()):
+        clusters.setdefault(find(event), [0, 0])[0] += 1
+    for (event_1, event_2), count in counts.items():
+        if event_1 in parents and event_2 in parents and \
+                find(event_1) == find(event_2):
+            clusters[find(event_1)][1] += count
+    clusters = sorted((tuple(_i) for _i in clusters.values()), reverse=True)
+    return {"observations": sum(counts.values()),
+            "clusters": clusters,
+            "linked_events": sum(_i[0] for _i in clusters)}
+
+
+def _with_headroom(value):
+    return int(math.ceil(value * HEADROOM)) + MINIMUM_HEADROOM
+
+
+def hypodd_array_sizes(statistics, event_count, station_count, isolv=2):
+    """
+    Returns the array sizes for HypoDDCompiler.configure().
+
+    :param statistics: Dictionary as returned by read_link_statistics().
+    :param event_count: Number of events in event.sel.
+    :param station_count: Number of stations.
+    :param isolv: The hypoDD solver. 1 for SVD, 2 for LSQR.
+    """
+    sizes = {"MAXEVE": event_count + 30,
+             "MAXDATA": _with_headroom(statistics["observations"]),
+             "MAXCL": _with_headroom(len(statistics["clusters"])),
+             "MAXSTA": station_count + 10}
+    if isolv == 2:
+        sizes["MAXEVE0"] = 2
+        sizes["MAXDATA0"] = 1
+    else:
+        largest = statistics["clusters"][0] if statistics["clusters"] \
+            else (0, 0)
+        sizes["MAXEVE0"] = _with_headroom(largest[0])
+        sizes["MAXDATA0"] = _with_headroom(largest[1])
+    return sizes
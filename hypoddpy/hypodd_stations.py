@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Parsing of the station coordinates of station files.
+
+Only the coordinates needed for station.dat are extracted:
+
+    * StationXML files are parsed incrementally with lxml.etree.iterparse
+      without building an ObsPy Inventory.
+    * Dataless SEED and XSEED files are parsed with obspy.io.xseed.Parser.
+
+Files are parsed in parallel. The result of every file is cached by the md5
+hash of its content, so unchanged files are never parsed again.
+
+Usage
+=====
+
+>>> stations = parse_station_files(["stations.xml"], "station_cache.json")
+>>> stations["BW.FURT"]
+{'latitude': 48.16, 'longitude': 11.27, 'elevation': 565}
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+
+
+def _local_name(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def is_stationxml(filename):
+    """
+    Returns True if the file looks like a StationXML file.
+    """
+    with open(filename, "rb") as open_file:
+        start = open_file.read(2048)
+    return b"FDSNStationXML" in start
+
+
+def _parse_stationxml(filename):
+    """
+    Returns the coordinates of all stations of a StationXML file.
+    """
+    from lxml import etree
+
+    stations = {}
+    network_code = None
+    for event, element in etree.iterparse(filename, events=("start", "end")):
+        name = _local_name(element.tag)
+        if event == "start":
+            if name == "Network":
+                network_code = element.get("code")
+            continue
+        if name != "Station":
+            # Channels are not needed, free them as soon as possible.
+            if name == "Channel":
+                element.clear()
+            continue
+        values = {}
+        for child in element:
+            if isinstance(child.tag, basestring) and _local_name(
+                    child.tag) in ("Latitude", "Longitude", "Elevation"):
+                values[_local_name(child.tag)] = float(child.text)
+        stations["%s.%s" % (network_code, element.get("code"))] = {
+            "latitude": values["Latitude"],
+            "longitude": values["Longitude"],
+            "elevation": int(round(values["Elevation"]))}
+        element.clear()
+    return stations
+
+
+def _parse_seed(filename):
+    """
+    Returns the coordinates of all stations of a (X)SEED file.
+    """
+    from obspy.io.xseed import Parser
+
+    stations = {}
+    p = Parser(filename)
+    # In theory it would be enough to parse Blockette 50, put faulty SEED
+    # files do not store enough information in them, so blockettes 52 need
+    # to be parsed...
+    for station in p.stations:
+        for blockette in station:
+            if blockette.id != 52:
+                continue
+            station_id = "%s.%s" % (station[0].network_code,
+                                    station[0].station_call_letters)
+            stations[station_id] = {
+                "latitude": blockette.latitude,
+                "longitude": blockette.longitude,
+                "elevation": int(round(blockette.elevation))}
+    return stations
+
+
+def parse_station_file(filename):
+    """
+    Returns a dictionary mapping the network.station ids of all stations in
+    a StationXML or (X)SEED file to their coordinates.
+    """
+    if is_stationxml(filename):
+        return _parse_stationxml(filename)
+    return _parse_seed(filename)
+
+
+def _parse_station_file_with_hash(args):
+    """
+    Module level function so it can be used with a multiprocessing pool.
+    """
+    filename, file_hash = args
+    return file_hash, parse_station_file(filename)
+
+
+def file_hash(filename):
+    """
+    md5 hash of the content of a file.
+    """
+    md5 = hashlib.md5()
+    with open(filename, "rb") as open_file:
+        for chunk in iter(lambda: open_file.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def inventory_coordinates(inventory):
+    """
+    Returns the coordinates of all stations of an ObsPy Inventory.
+    """
+    stations = {}
+    for network in inventory:
+        for station in network:
+            stations["%s.%s" % (network.code, station.code)] = {
+                "latitude": station.latitude,
+                "longitude": station.longitude,
+                "elevation": int(round(station.elevation))}
+    return stations
+
+
+def parse_station_files(filenames, cache_file=None, processes=None,
+                        log_function=None):
+    """
+    Returns the coordinates of all stations in all files. Stations in later
+    files replace stations with the same id in earlier files.
+
+    :param cache_file: JSON file caching the stations of every file by the
+        hash of the file.
+    :param processes: Number of parallel processes. Defaults to the number of
+        CPUs.
+    """
+    cache = {}
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, "r") as open_file:
+            cache = json.load(open_file)
+    hashes = [file_hash(_i) for _i in filenames]
+    missing = dict((_j, _i) for _i, _j in zip(filenames, hashes)
+                   if _j not in cache)
+    if log_function:
+        cached = len([_i for _i in hashes if _i in cache])
+        log_function("%i of %i station files are cached, parsing %i "
+                     "distinct files." % (cached, len(filenames),
+                                          len(missing)))
+    if len(missing) > 1 and processes != 1:
+        pool = multiprocessing.Pool(processes=processes)
+        try:
+            results = pool.map(_parse_station_file_with_hash,
+                               [(_j, _i) for _i, _j in missing.items()])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_parse_station_file_with_hash((_j, _i))
+                   for _i, _j in missing.items()]
+    cache.update(dict(results))
+    if cache_file and missing:
+        temp_file = "%s.%i.tmp" % (cache_file, os.getpid())
+        with open(temp_file, "w") as open_file:
+            json.dump(cache, open_file)
+        os.rename(temp_file, cache_file)
+
+    stations = {}
+    for _i in hashes:
+        stations.update(cache[_i])
+    return stations
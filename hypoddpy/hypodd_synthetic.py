@@ -0,0 +1,969 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Synthetic data sets and stand-in executables for scale tests.
+
+generate_dataset() writes QuakeML event files, station metadata and MiniSEED
+waveform files for any number of events:
+
+    * Events are grouped in families of nearby events. All events of a
+      family share a source wavelet per station and phase so neighbouring
+      events have similar waveforms. The similarity parameter controls how
+      much of every waveform is event specific.
+    * Picks are the straight ray arrival times in a homogeneous half space
+      plus Gaussian noise with a standard deviation of pick_error seconds.
+    * The waveforms are written as one file per station, channel and
+      file_length seconds. Files without any arrival are not written.
+    * The true locations are written to truth.json.
+
+write_standin_binaries() writes Python scripts that can be used in place of
+the ph2dt and hypoDD executables with HypoDDRelocator.set_external_binaries().
+They read the regular input files and write format-correct output files so
+the whole pipeline can run end-to-end without a Fortran compiler:
+
+    * ph2dt selects the event pairs with a KD-tree neighbour search honouring
+      the control parameters of ph2dt.inp.
+    * hypoDD does not invert anything. Events are clustered by their links
+      in dt.cc and dt.ct and moved a fraction of the way to the centroid of
+      their cluster.
+
+Usage
+=====
+
+>>> dataset = generate_dataset("synthetic", 10000)
+>>> relocator = create_synthetic_relocator(dataset, "working_dir")
+>>> relocator.start_relocation("relocated.xml")
+"""
+import json
+import math
+import os
+import sys
+
+import numpy as np
+
+
+# Rough conversion factor from degree to km.
+DEG2KM = 111.0
+
+# Sampling rate independent wavelet parameters.
+WAVELET_LENGTH = {"P": 1.0, "S": 2.0}
+WAVELET_DECAY = {"P": 0.1, "S": 0.25}
+WAVELET_AMPLITUDE = {"P": 1.0, "S": 2.0}
+
+# Standard deviation of the noise in counts.
+NOISE_LEVEL = 50.0
+
+# Fraction of the distance to their cluster centroid the stand-in hypoDD
+# moves the events.
+STANDIN_COLLAPSE = 0.1
+
+EVENT_TEMPLATE = """    <event publicID="smi:local/synthetic/event/{index}">
+      <origin publicID="smi:local/synthetic/origin/{index}">
+        <time>
+          <value>{time}</value>
+          <uncertainty>{time_error}</uncertainty>
+        </time>
+        <latitude>
+          <value>{latitude}</value>
+          <uncertainty>{horizontal_error}</uncertainty>
+        </latitude>
+        <longitude>
+          <value>{longitude}</value>
+          <uncertainty>{horizontal_error}</uncertainty>
+        </longitude>
+        <depth>
+          <value>{depth}</value>
+          <uncertainty>{depth_error}</uncertainty>
+        </depth>
+      </origin>
+      <magnitude publicID="smi:local/synthetic/magnitude/{index}">
+        <mag>
+          <value>{magnitude}</value>
+        </mag>
+      </magnitude>
+{picks}    </event>
+"""
+
+PICK_TEMPLATE = """      <pick publicID="smi:local/synthetic/pick/{index}/{station_id}/{phase}">
+        <time>
+          <value>{time}</value>
+          <uncertainty>{time_error}</uncertainty>
+        </time>
+        <waveformID networkCode="{network}" stationCode="{station}" \
+channelCode="{channel}"></waveformID>
+        <phaseHint>{phase}</phaseHint>
+      </pick>
+"""
+
+STANDIN_TEMPLATE = """#!{executable}
+# Stand-in {name} executable written by hypoddpy.hypodd_synthetic.
+import sys
+sys.path.insert(0, {path!r})
+from hypoddpy.hypodd_synthetic import {function}
+sys.exit({function}(sys.argv))
+"""
+
+RELOC_FORMAT = "%9i %10.6f %11.6f %9.3f %10.1f %10.1f %10.1f %8.1f %8.1f " + \
+    "%8.1f %4i %2i %2i %2i %2i %6.3f %4.1f %5i %5i %5i %5i %6.3f %6.3f %3i"
+STA_FORMAT = "%-7s %9.4f %10.4f %9.4f %9.4f %7i %7i %7i %7i %9.4f %9.4f %3i"
+RES_FORMAT = "%-7s %12.5f %9i %9i %1i %9.2f %12.6f %12.6f %8.1f"
+
+# Output formats of the stand-in ph2dt.
+EVENT_FORMAT = "%8i  %8i %9.4f %10.4f %9.3f %4.1f %6.2f %6.2f %5.2f %10i"
+STATION_FORMAT = "%-7s %9.4f %10.4f %5i"
+PAIR_FORMAT = "# %9i %9i"
+OBSERVATION_FORMAT = "%-7s %8.3f %8.3f %6.4f %s"
+
+PH2DT_KEYS = ["MINWGHT", "MAXDIST", "MAXSEP", "MAXNGH", "MINLNK", "MINOBS",
+              "MAXOBS"]
+
+
+def _station_ids(station_count):
+    return ["SY.S%03i" % _i for _i in range(station_count)]
+
+
+def _wavelet(rng, phase, sampling_rate, min_frequency, max_frequency):
+    """
+    Returns a band limited, normalized wavelet with an exponential decay.
+    """
+    npts = int(round(WAVELET_LENGTH[phase] * sampling_rate))
+    spectrum = np.fft.rfft(rng.normal(0.0, 1.0, npts))
+    frequencies = np.fft.rfftfreq(npts, 1.0 / sampling_rate)
+    spectrum[(frequencies < min_frequency) |
+             (frequencies > max_frequency)] = 0.0
+    wavelet = np.fft.irfft(spectrum, npts)
+    time = np.arange(npts) / float(sampling_rate)
+    # Short onset followed by an exponential decay.
+    envelope = np.minimum(time / 0.02, 1.0) * \
+        np.exp(-time / WAVELET_DECAY[phase])
+    wavelet *= envelope
+    maximum = np.abs(wavelet).max()
+    if maximum > 0:
+        wavelet /= maximum
+    return wavelet
+
+
+def _write_station_files(directory, station_ids, latitudes, longitudes,
+                         elevations, channels, sampling_rate):
+    """
+    Writes the stations as StationXML and in the serialized form of the
+    stations.json working file. Returns the filenames.
+    """
+    from obspy.core.inventory import Channel, Inventory, Network, Station
+
+    stations = {}
+    network = Network(code=station_ids[0].split(".")[0])
+    for _i, station_id in enumerate(station_ids):
+        stations[station_id] = {"latitude": float(latitudes[_i]),
+                                "longitude": float(longitudes[_i]),
+                                "elevation": int(elevations[_i])}
+        station = Station(code=station_id.split(".")[1],
+                          latitude=float(latitudes[_i]),
+                          longitude=float(longitudes[_i]),
+                          elevation=float(elevations[_i]))
+        for channel in channels:
+            station.channels.append(Channel(
+                code="HH" + channel, location_code="",
+                latitude=float(latitudes[_i]),
+                longitude=float(longitudes[_i]),
+                elevation=float(elevations[_i]), depth=0.0,
+                sample_rate=sampling_rate))
+        network.stations.append(station)
+    station_xml = os.path.join(directory, "stations.xml")
+    Inventory(networks=[network], source="hypoddpy synthetic").write(
+        station_xml, format="STATIONXML")
+    stations_json = os.path.join(directory, "stations.json")
+    with open(stations_json, "w") as open_file:
+        json.dump(stations, open_file)
+    return station_xml, stations_json, stations
+
+
+def generate_dataset(directory, event_count, station_count=10,
+                     family_size=20, family_radius=0.2, region_radius=10.0,
+                     latitude=45.0, longitude=10.0, min_depth=2.0,
+                     max_depth=12.0, event_interval=60.0, pick_error=0.01,
+                     similarity=0.9, channels="Z", sampling_rate=100.0,
+                     file_length=3600.0, events_per_file=1000, vp=6.0,
+                     vp_vs_ratio=1.73, seed=12345):
+    """
+    Writes a synthetic data set to directory.
+
+    :param event_count: Number of events.
+    :param station_count: Number of stations. They are randomly placed in a
+        circle with 1.5 times region_radius around the events.
+    :param family_size: Average number of events per family.
+    :param family_radius: Standard deviation of the event locations around
+        the center of their family in km.
+    :param region_radius: Radius of the circle the family centers are placed
+        in in km.
+    :param latitude: Latitude of the center of the region.
+    :param longitude: Longitude of the center of the region.
+    :param min_depth: Minimum depth of the family centers in km.
+    :param max_depth: Maximum depth of the family centers in km.
+    :param event_interval: Average time between two events in seconds.
+    :param pick_error: Standard deviation of the pick errors in seconds. Also
+        written as the pick uncertainty.
+    :param similarity: Between 0 and 1. Weight of the family wavelet in the
+        waveforms. The rest is an event specific wavelet.
+    :param channels: The component codes of the channels. The channel codes
+        are "HH" + component.
+    :param sampling_rate: Sampling rate of the waveforms in Hz.
+    :param file_length: Length of the waveform files in seconds.
+    :param events_per_file: Number of events per QuakeML file.
+    :param vp: P wave velocity of the half space in km/s.
+    :param vp_vs_ratio: vp/vs ratio of the half space.
+    :param seed: Seed of the random number generator.
+
+    Returns a dictionary with the lists of "event_files", "waveform_files"
+    and "station_files", the "stations" dictionary in the form of
+    HypoDDRelocator.stations, the filename of the serialized stations as
+    "stations_json" and the "velocity_model" as keyword arguments for
+    HypoDDRelocator.setup_velocity_model().
+    """
+    from obspy.core import Stream, Trace, UTCDateTime
+
+    rng = np.random.RandomState(seed)
+    for subdirectory in ["events", "waveforms"]:
+        path = os.path.join(directory, subdirectory)
+        if not os.path.exists(path):
+            os.makedirs(path)
+    starttime = UTCDateTime(2010, 1, 1)
+    km_per_deg_lon = DEG2KM * math.cos(math.radians(latitude))
+
+    # Stations.
+    station_ids = _station_ids(station_count)
+    radius = 1.5 * region_radius * np.sqrt(rng.uniform(0, 1, station_count))
+    azimuth = rng.uniform(0, 2 * np.pi, station_count)
+    station_x = radius * np.sin(azimuth)
+    station_y = radius * np.cos(azimuth)
+    station_elevations = rng.uniform(0, 1000, station_count).astype(np.int64)
+    station_xml, stations_json, stations = _write_station_files(
+        directory, station_ids, latitude + station_y / DEG2KM,
+        longitude + station_x / km_per_deg_lon, station_elevations, channels,
+        sampling_rate)
+
+    # Event families and events.
+    family_count = max(1, int(round(event_count / float(family_size))))
+    radius = region_radius * np.sqrt(rng.uniform(0, 1, family_count))
+    azimuth = rng.uniform(0, 2 * np.pi, family_count)
+    family_centers = np.column_stack([
+        radius * np.sin(azimuth), radius * np.cos(azimuth),
+        rng.uniform(min_depth, max_depth, family_count)])
+    families = rng.randint(0, family_count, event_count)
+    event_xyz = family_centers[families] + \
+        rng.normal(0.0, family_radius, (event_count, 3))
+    event_xyz[:, 2] = np.maximum(event_xyz[:, 2], 0.1)
+    origin_times = np.arange(event_count) * event_interval + \
+        rng.uniform(0, event_interval / 2.0, event_count)
+    # Gutenberg-Richter distributed magnitudes with a b-value of 1.
+    magnitudes = 0.5 + rng.exponential(1.0 / math.log(10), event_count)
+
+    # Straight ray travel times of all events to all stations.
+    station_xyz = np.column_stack([station_x, station_y,
+                                   -station_elevations / 1000.0])
+    distances = np.sqrt(((event_xyz[:, np.newaxis, :] -
+                          station_xyz[np.newaxis, :, :]) ** 2).sum(axis=2))
+    travel_times = {"P": distances / vp,
+                    "S": distances / (vp / vp_vs_ratio)}
+    pick_times = dict((phase, origin_times[:, np.newaxis] + value +
+                       rng.normal(0.0, pick_error, value.shape))
+                      for phase, value in travel_times.items())
+
+    # Event files.
+    event_files = []
+    truth = []
+    documents = []
+    header = "<?xml version='1.0' encoding='utf-8'?>\n" + \
+        "<q:quakeml xmlns:q=\"http://quakeml.org/xmlns/quakeml/1.2\" " + \
+        "xmlns=\"http://quakeml.org/xmlns/bed/1.2\">\n" + \
+        "  <eventParameters publicID=\"smi:local/synthetic/catalog/%i\">\n"
+    footer = "  </eventParameters>\n</q:quakeml>\n"
+    for _i in range(event_count):
+        # The catalog locations are perturbed by the location errors.
+        horizontal_error = 0.5
+        depth_error = 1.0
+        x, y, z = event_xyz[_i] + rng.normal(
+            0.0, [horizontal_error, horizontal_error, depth_error])
+        picks = []
+        for _j, station_id in enumerate(station_ids):
+            network, station = station_id.split(".")
+            for phase in ["P", "S"]:
+                picks.append(PICK_TEMPLATE.format(
+                    index=_i, station_id=station_id, phase=phase,
+                    time=starttime + pick_times[phase][_i, _j],
+                    time_error=pick_error, network=network,
+                    station=station, channel="HH" + channels[0]))
+        documents.append(EVENT_TEMPLATE.format(
+            index=_i, time=starttime + origin_times[_i],
+            time_error=0.1,
+            latitude=latitude + y / DEG2KM,
+            longitude=longitude + x / km_per_deg_lon,
+            depth=max(z, 0.0) * 1000.0, horizontal_error=horizontal_error,
+            depth_error=depth_error * 1000.0,
+            magnitude="%.2f" % magnitudes[_i], picks="".join(picks)))
+        truth.append({
+            "event_id": "smi:local/synthetic/event/%i" % _i,
+            "family": int(families[_i]),
+            "origin_time": str(starttime + origin_times[_i]),
+            "latitude": latitude + event_xyz[_i, 1] / DEG2KM,
+            "longitude": longitude + event_xyz[_i, 0] / km_per_deg_lon,
+            "depth": event_xyz[_i, 2]})
+        if len(documents) == events_per_file or _i == event_count - 1:
+            filename = os.path.join(directory, "events",
+                                    "events_%06i.xml" % len(event_files))
+            with open(filename, "w") as open_file:
+                open_file.write(header % len(event_files))
+                open_file.write("".join(documents))
+                open_file.write(footer)
+            event_files.append(filename)
+            documents = []
+    with open(os.path.join(directory, "truth.json"), "w") as open_file:
+        json.dump(truth, open_file)
+
+    # Waveform files.
+    waveform_files = []
+    max_frequency = min(15.0, 0.4 * sampling_rate)
+    npts_file = int(round(file_length * sampling_rate))
+    for _j, station_id in enumerate(station_ids):
+        network, station = station_id.split(".")
+        # All arrivals at this station sorted by time.
+        arrival_times = np.concatenate([pick_times["P"][:, _j],
+                                        pick_times["S"][:, _j]])
+        arrival_phases = np.repeat(["P", "S"], event_count)
+        arrival_events = np.tile(np.arange(event_count), 2)
+        # The waveforms start at the true arrival, not at the pick.
+        onsets = np.concatenate([
+            origin_times + travel_times["P"][:, _j],
+            origin_times + travel_times["S"][:, _j]])
+        amplitudes = NOISE_LEVEL * 20.0 * 10 ** (0.5 * (magnitudes - 1.0)) / \
+            np.maximum(distances[:, _j] / 10.0, 1.0)
+        order = np.argsort(arrival_times, kind="mergesort")
+        file_indices = (onsets[order] // file_length).astype(np.int64)
+        for channel in channels:
+            # Per station and channel one wavelet per family and phase.
+            family_wavelets = {}
+            for file_index in np.unique(file_indices):
+                data = rng.normal(0.0, NOISE_LEVEL, npts_file)
+                file_start = file_index * file_length
+                for _k in order[file_indices == file_index]:
+                    phase = arrival_phases[_k]
+                    event = arrival_events[_k]
+                    key = (families[event], phase)
+                    if key not in family_wavelets:
+                        family_wavelets[key] = _wavelet(
+                            rng, phase, sampling_rate, 1.0, max_frequency)
+                    wavelet = similarity * family_wavelets[key] + \
+                        (1.0 - similarity) * _wavelet(
+                            rng, phase, sampling_rate, 1.0, max_frequency)
+                    wavelet *= amplitudes[event] * WAVELET_AMPLITUDE[phase]
+                    index = int(round((onsets[_k] - file_start) *
+                                      sampling_rate))
+                    wavelet = wavelet[:max(npts_file - index, 0)]
+                    data[index:index + len(wavelet)] += wavelet
+                trace = Trace(data=data.astype(np.int32), header={
+                    "network": network, "station": station,
+                    "channel": "HH" + channel,
+                    "starttime": starttime + file_start,
+                    "sampling_rate": sampling_rate})
+                filename = os.path.join(
+                    directory, "waveforms", "%s.HH%s.%06i.mseed" %
+                    (station_id, channel, file_index))
+                Stream(traces=[trace]).write(filename, format="MSEED")
+                waveform_files.append(filename)
+
+    return {"event_files": event_files,
+            "waveform_files": waveform_files,
+            "station_files": [station_xml],
+            "stations": stations,
+            "stations_json": stations_json,
+            "velocity_model": {
+                "model_type": "layered_p_velocity_with_constant_vp_vs_ratio",
+                "vp_vs_ratio": vp_vs_ratio,
+                "layer_tops": [(0.0, vp)]}}
+
+
+def write_standin_binaries(directory):
+    """
+    Writes the stand-in ph2dt and hypoDD executables to directory.
+
+    Returns the filenames of the hypoDD and the ph2dt stand-in.
+    """
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__)))
+    filenames = []
+    for name, function in [("hypoDD", "standin_hypodd_main"),
+                           ("ph2dt", "standin_ph2dt_main")]:
+        filename = os.path.join(directory, name)
+        with open(filename, "w") as open_file:
+            open_file.write(STANDIN_TEMPLATE.format(
+                executable=sys.executable, name=name, path=package_parent,
+                function=function))
+        os.chmod(filename, 0o755)
+        filenames.append(filename)
+    return tuple(filenames)
+
+
+def create_synthetic_relocator(dataset, working_dir, standin_binaries=True,
+                               **kwargs):
+    """
+    Returns a HypoDDRelocator set up for a data set of generate_dataset().
+    The stations are read from the StationXML file of the data set.
+
+    :param standin_binaries: Use the stand-in ph2dt and hypoDD executables
+        instead of compiling HypoDD.
+    :param kwargs: Passed to HypoDDRelocator. Sensible cross correlation
+        parameters are used for all missing ones.
+    """
+    from hypodd_relocator import HypoDDRelocator
+
+    parameters = {
+        "cc_time_before": 0.05,
+        "cc_time_after": 0.2,
+        "cc_maxlag": 0.1,
+        "cc_filter_min_freq": 1.0,
+        "cc_filter_max_freq": 15.0,
+        "cc_p_phase_weighting": {"Z": 1.0},
+        "cc_s_phase_weighting": {"Z": 1.0},
+        "cc_min_allowed_cross_corr_coeff": 0.6}
+    parameters.update(kwargs)
+    relocator = HypoDDRelocator(working_dir=working_dir, **parameters)
+    relocator.add_station_files(dataset["station_files"])
+    relocator.add_event_files(dataset["event_files"])
+    relocator.add_waveform_files(dataset["waveform_files"])
+    relocator.setup_velocity_model(**dataset["velocity_model"])
+    if standin_binaries:
+        hypodd_binary, ph2dt_binary = write_standin_binaries(
+            os.path.join(working_dir, "standin_binaries"))
+        relocator.set_external_binaries(hypodd_binary, ph2dt_binary)
+    return relocator
+
+
+def _read_ph2dt_inp(filename):
+    """
+    Reads the ph2dt control parameters from a ph2dt.inp file.
+
+    Returns a dictionary with the station and phase input filenames as the
+    "station_file" and "phase_file" keys and all control parameters.
+    """
+    with open(filename, "r") as open_file:
+        lines = [line.strip() for line in open_file
+                 if line.strip() and not line.startswith("*")]
+    values = dict(zip(PH2DT_KEYS, map(float, lines[2].split())))
+    for key in ["MAXNGH", "MINLNK", "MINOBS", "MAXOBS"]:
+        values[key] = int(values[key])
+    values["station_file"] = lines[0]
+    values["phase_file"] = lines[1]
+    return values
+
+
+def _read_station_dat(filename):
+    """
+    Reads a station.dat file into a dictionary in the same form as
+    HypoDDRelocator.stations.
+    """
+    stations = {}
+    with open(filename, "r") as open_file:
+        for line in open_file:
+            items = line.split()
+            if len(items) < 3:
+                continue
+            stations[items[0]] = {
+                "latitude": float(items[1]),
+                "longitude": float(items[2]),
+                "elevation": int(float(items[3])) if len(items) > 3 else 0}
+    return stations
+
+
+def _read_phase_dat(filename):
+    """
+    Reads a phase.dat file into a list of event dictionaries as expected by
+    _select_event_pairs().
+    """
+    events = []
+    with open(filename, "r") as open_file:
+        for line in open_file:
+            items = line.split()
+            if not items:
+                continue
+            if items[0] == "#":
+                year, month, day, hour, minute = map(int, items[1:6])
+                second = float(items[6])
+                events.append({
+                    "id": int(items[14]),
+                    "date": year * 10000 + month * 100 + day,
+                    "time": hour * 1000000 + minute * 10000 +
+                    int(round(second * 100)),
+                    "latitude": float(items[7]),
+                    "longitude": float(items[8]),
+                    "depth": float(items[9]),
+                    "magnitude": float(items[10]),
+                    "horizontal_error": float(items[11]),
+                    "depth_error": float(items[12]),
+                    "rms": float(items[13]),
+                    "phases": []})
+                continue
+            events[-1]["phases"].append(
+                (items[0], float(items[1]), float(items[2]), items[3]))
+    return events
+
+
+def _standin_coordinates(latitudes, longitudes, depths, reference_latitude):
+    """
+    Converts geographic coordinates to local cartesian coordinates in km.
+    """
+    x = np.asarray(longitudes) * DEG2KM * \
+        math.cos(math.radians(reference_latitude))
+    y = np.asarray(latitudes) * DEG2KM
+    return np.column_stack([x, y, np.asarray(depths, dtype=np.float64)])
+
+
+def _select_event_pairs(events, stations, values, output_dir,
+                        log_function=None):
+    """
+    Selects the event pairs like ph2dt and writes dt.ct, event.sel,
+    event.dat and station.sel to output_dir.
+
+    The neighbours within MAXSEP km of every event are visited in order of
+    increasing distance. A pair is written to dt.ct if both events have at
+    least MINOBS common P or S picks with a weight of at least MINWGHT at
+    stations within MAXDIST km. At most MAXOBS observations, the ones at the
+    closest stations, are used. Pairs with at least MINLNK observations are
+    strong links and the search for an event stops after MAXNGH strong
+    neighbours. The files have the fields of the ph2dt files but not their
+    exact column layout.
+
+    :param events: List of event dictionaries with the keys "id", "date"
+        (yyyymmdd), "time" (hhmmsscc), "latitude", "longitude", "depth" (km),
+        "magnitude", "horizontal_error", "depth_error" (km), "rms" and
+        "phases", a list of (station_id, travel_time, weight, phase) tuples.
+    :param stations: Dictionary of stations as in HypoDDRelocator.stations.
+    :param values: Dictionary with the ph2dt control parameters MINWGHT,
+        MAXDIST, MAXSEP, MAXNGH, MINLNK, MINOBS and MAXOBS.
+    :param output_dir: Directory to write the output files to.
+    :param log_function: Function to use to log activity.
+
+    Returns a dictionary with some statistics about the selection.
+    """
+    from scipy.spatial import cKDTree
+
+    if log_function is None:
+        log_function = lambda string: None
+    station_ids = sorted(stations.keys())
+    station_index = dict((station_id, _i)
+                         for _i, station_id in enumerate(station_ids))
+    if not events:
+        reference_latitude = 0.0
+    else:
+        reference_latitude = np.mean([event["latitude"] for event in events])
+    station_coordinates = _standin_coordinates(
+        [stations[_i]["latitude"] for _i in station_ids],
+        [stations[_i]["longitude"] for _i in station_ids],
+        [-stations[_i]["elevation"] / 1000.0 for _i in station_ids],
+        reference_latitude)
+
+    # Every observation is encoded as 2 * station_index + phase with P = 0
+    # and S = 1 so the phases of two events can be matched with a sorted
+    # array intersection.
+    keys, travel_times, weights = [], [], []
+    for event in events:
+        phases = {}
+        for station_id, travel_time, weight, phase in event["phases"]:
+            if station_id not in station_index or phase not in ("P", "S"):
+                continue
+            key = 2 * station_index[station_id] + (phase == "S")
+            # As ph2dt only the first pick per station and phase is used.
+            phases.setdefault(key, (travel_time, weight))
+        event_keys = np.array(sorted(phases.keys()), dtype=np.int64)
+        keys.append(event_keys)
+        travel_times.append(np.array([phases[_i][0] for _i in event_keys],
+                                     dtype=np.float64))
+        weights.append(np.array([phases[_i][1] for _i in event_keys],
+                                dtype=np.float64))
+
+    event_coordinates = _standin_coordinates(
+        [event["latitude"] for event in events],
+        [event["longitude"] for event in events],
+        [event["depth"] for event in events], reference_latitude)
+    tree = cKDTree(event_coordinates)
+
+    # Maps all selected pairs to whether they are strong links.
+    selected_pairs = {}
+    selected_events = set()
+    selected_stations = set()
+    statistics = {"event_pairs": 0, "observations": 0, "strong_links": 0,
+                  "weakly_linked_events": 0}
+
+    with open(os.path.join(output_dir, "dt.ct"), "w") as dt_ct:
+        for _i in range(len(events)):
+            if len(keys[_i]) == 0:
+                continue
+            neighbours = np.array(tree.query_ball_point(
+                event_coordinates[_i], values["MAXSEP"]), dtype=np.int64)
+            neighbours = neighbours[neighbours != _i]
+            distances = np.sqrt(((event_coordinates[neighbours] -
+                                  event_coordinates[_i]) ** 2).sum(axis=1))
+            neighbours = neighbours[np.argsort(distances, kind="mergesort")]
+            strong_neighbours = 0
+            for _k in neighbours:
+                if strong_neighbours >= values["MAXNGH"]:
+                    break
+                pair = (min(_i, _k), max(_i, _k))
+                if pair in selected_pairs:
+                    strong_neighbours += selected_pairs[pair]
+                    continue
+                common, index_1, index_2 = np.intersect1d(
+                    keys[_i], keys[_k], assume_unique=True,
+                    return_indices=True)
+                if len(common) < values["MINOBS"]:
+                    continue
+                weight = (weights[_i][index_1] + weights[_k][index_2]) / 2.0
+                centroid = (event_coordinates[_i] +
+                            event_coordinates[_k]) / 2.0
+                station_distances = np.sqrt(
+                    ((station_coordinates[common // 2] - centroid) ** 2)
+                    .sum(axis=1))
+                mask = (station_distances <= values["MAXDIST"]) & \
+                    (weights[_i][index_1] >= values["MINWGHT"]) & \
+                    (weights[_k][index_2] >= values["MINWGHT"])
+                if mask.sum() < values["MINOBS"]:
+                    continue
+                order = np.nonzero(mask)[0]
+                order = order[np.argsort(station_distances[order],
+                                         kind="mergesort")]
+                order = order[:values["MAXOBS"]]
+                selected_pairs[pair] = len(order) >= values["MINLNK"]
+                if selected_pairs[pair]:
+                    strong_neighbours += 1
+                    statistics["strong_links"] += 1
+                selected_events.update((_i, _k))
+                dt_ct.write(PAIR_FORMAT % (events[_i]["id"], events[_k]["id"]))
+                dt_ct.write("\n")
+                for _j in order:
+                    station_id = station_ids[common[_j] // 2]
+                    selected_stations.add(station_id)
+                    dt_ct.write(OBSERVATION_FORMAT % (
+                        station_id, travel_times[_i][index_1[_j]],
+                        travel_times[_k][index_2[_j]], weight[_j],
+                        "S" if common[_j] % 2 else "P"))
+                    dt_ct.write("\n")
+                statistics["event_pairs"] += 1
+                statistics["observations"] += len(order)
+            if strong_neighbours < values["MAXNGH"]:
+                statistics["weakly_linked_events"] += 1
+
+    with open(os.path.join(output_dir, "event.dat"), "w") as event_dat, \
+            open(os.path.join(output_dir, "event.sel"), "w") as event_sel:
+        for _i, event in enumerate(events):
+            line = EVENT_FORMAT % (
+                event["date"], event["time"], event["latitude"],
+                event["longitude"], event["depth"], event["magnitude"],
+                event["horizontal_error"], event["depth_error"],
+                event["rms"], event["id"]) + "\n"
+            event_dat.write(line)
+            if _i in selected_events:
+                event_sel.write(line)
+
+    with open(os.path.join(output_dir, "station.sel"), "w") as station_sel:
+        for station_id in station_ids:
+            if station_id not in selected_stations:
+                continue
+            station = stations[station_id]
+            station_sel.write(STATION_FORMAT % (
+                station_id, station["latitude"], station["longitude"],
+                station["elevation"]) + "\n")
+
+    statistics["selected_events"] = len(selected_events)
+    statistics["selected_stations"] = len(selected_stations)
+    log_function("%i event pairs with %i observations, %i of %i "
+                 "events selected." % (statistics["event_pairs"],
+                                       statistics["observations"],
+                                       len(selected_events), len(events)))
+    return statistics
+
+
+def standin_ph2dt_main(argv):
+    """
+    Stand-in for the ph2dt executable. Called with the ph2dt.inp file as the
+    only argument in the directory with the input files.
+    """
+    values = _read_ph2dt_inp(argv[1] if len(argv) > 1 else "ph2dt.inp")
+    stations = _read_station_dat(values["station_file"])
+    events = _read_phase_dat(values["phase_file"])
+    print("Reading data ...")
+    print("> stations = %i" % len(stations))
+    print("> events total = %i" % len(events))
+
+    def log(string):
+        print(string)
+        sys.stdout.flush()
+
+    statistics = _select_event_pairs(events, stations, values, ".",
+                                     log_function=log)
+    with open("ph2dt.log", "w") as open_file:
+        json.dump(statistics, open_file)
+    print("Done.")
+    return 0
+
+
+def _read_hypodd_inp(filename):
+    """
+    Returns the filenames and the iteration counts of a hypoDD.inp file.
+
+    The nine filenames are the lines before the first line with IDAT, IPHA
+    and DIST.
+    """
+    with open(filename, "r") as open_file:
+        lines = [line.rstrip("\r\n") for line in open_file
+                 if not line.startswith("*")]
+    for _i, line in enumerate(lines):
+        items = line.split()
+        if len(items) != 3:
+            continue
+        try:
+            [float(_j) for _j in items]
+        except ValueError:
+            continue
+        if _i >= 9:
+            break
+    else:
+        raise ValueError("Could not parse %s." % filename)
+    keys = ["dt.cc", "dt.ct", "event.sel", "station.sel", "hypoDD.loc",
+            "hypoDD.reloc", "hypoDD.sta", "hypoDD.res", "hypoDD.src"]
+    filenames = dict((key, value.strip() or key)
+                     for key, value in zip(keys, lines[_i - 9:_i]))
+    # Number of iterations of every data weighting set.
+    nset = int(lines[_i + 2].split()[-1])
+    iterations = [int(line.split()[0])
+                  for line in lines[_i + 3:_i + 3 + nset]]
+    return filenames, iterations
+
+
+def _read_differential_times(filename, is_cc):
+    """
+    Yields (id1, id2, station, dt, weight, phase) for every observation of
+    a dt.cc or dt.ct file.
+    """
+    if not filename or not os.path.exists(filename):
+        return
+    with open(filename, "r") as open_file:
+        for line in open_file:
+            items = line.split()
+            if not items:
+                continue
+            if items[0] == "#":
+                id1, id2 = int(items[1]), int(items[2])
+                continue
+            if is_cc:
+                yield id1, id2, items[0], float(items[1]), \
+                    float(items[2]), items[3]
+            else:
+                yield id1, id2, items[0], \
+                    float(items[1]) - float(items[2]), float(items[3]), \
+                    items[4]
+
+
+def standin_hypodd_main(argv):
+    """
+    Stand-in for the hypoDD executable. Called with the hypoDD.inp file as
+    the only argument in the directory with the input files.
+    """
+    filenames, iterations = _read_hypodd_inp(
+        argv[1] if len(argv) > 1 else "hypoDD.inp")
+    log = open("hypoDD.log", "w")
+
+    def write(string):
+        print(string)
+        sys.stdout.flush()
+        log.write(string + "\n")
+
+    write("starting hypoDD (stand-in)")
+    events = {}
+    with open(filenames["event.sel"], "r") as open_file:
+        for line in open_file:
+            items = line.split()
+            if len(items) < 10:
+                continue
+            events[int(items[9])] = items
+    stations = {}
+    with open(filenames["station.sel"], "r") as open_file:
+        for line in open_file:
+            items = line.split()
+            if len(items) >= 3:
+                stations[items[0]] = (float(items[1]), float(items[2]))
+    write("# events = %i" % len(events))
+    write("# stations = %i" % len(stations))
+
+    # Read all observations and link the events with a union find.
+    parents = dict((_i, _i) for _i in events)
+
+    def find(_i):
+        while parents[_i] != _i:
+            parents[_i] = parents[parents[_i]]
+            _i = parents[_i]
+        return _i
+
+    observations = []
+    for key, is_cc in [("dt.cc", True), ("dt.ct", False)]:
+        count = 0
+        for id1, id2, station, dt, weight, phase in \
+                _read_differential_times(filenames[key], is_cc):
+            if id1 not in events or id2 not in events or \
+                    station not in stations:
+                continue
+            observations.append((id1, id2, station, dt, weight, phase,
+                                 is_cc))
+            parents[find(id1)] = find(id2)
+            count += 1
+        write("# %s observations = %i" % ("cross corr" if is_cc
+                                          else "catalog", count))
+
+    # Only linked events are relocated. Cluster ids are sorted by size.
+    linked = set()
+    for observation in observations:
+        linked.update(observation[:2])
+    clusters = {}
+    for _i in sorted(linked):
+        clusters.setdefault(find(_i), []).append(_i)
+    clusters = sorted(clusters.values(), key=lambda _i: (-len(_i), _i[0]))
+    cluster_ids = {}
+    for cluster_id, members in enumerate(clusters):
+        for _i in members:
+            cluster_ids[_i] = cluster_id + 1
+    write("# clusters = %i" % len(clusters))
+
+    # The residual of an observation is its difference to the mean
+    # differential time of the pair and phase.
+    pair_means = {}
+    for id1, id2, station, dt, weight, phase, is_cc in observations:
+        value = pair_means.setdefault((id1, id2, phase, is_cc), [0.0, 0])
+        value[0] += dt
+        value[1] += 1
+    residuals = [dt - pair_means[(id1, id2, phase, is_cc)][0] /
+                 pair_means[(id1, id2, phase, is_cc)][1]
+                 for id1, id2, station, dt, weight, phase, is_cc
+                 in observations]
+    event_counts = dict((_i, [0, 0, 0, 0, 0.0, 0.0]) for _i in linked)
+    station_counts = dict((_i, [0, 0, 0, 0, 0.0, 0.0]) for _i in stations)
+    for observation, residual in zip(observations, residuals):
+        id1, id2, station, dt, weight, phase, is_cc = observation
+        column = (0 if is_cc else 2) + (phase == "S")
+        for counts in [event_counts[id1], event_counts[id2],
+                       station_counts[station]]:
+            counts[column] += 1
+            counts[4 if is_cc else 5] += residual ** 2
+
+    def rms(counts, is_cc):
+        count = counts[0] + counts[1] if is_cc else counts[2] + counts[3]
+        if not count:
+            return -9.0
+        return math.sqrt(counts[4 if is_cc else 5] / count)
+
+    # The relocated locations.
+    coordinates = dict((_i, (float(events[_i][2]), float(events[_i][3]),
+                             float(events[_i][4]))) for _i in linked)
+    centroids = {}
+    for members in clusters:
+        centroids[cluster_ids[members[0]]] = tuple(
+            np.mean([coordinates[_i] for _i in members], axis=0))
+    cc_rms = math.sqrt(sum(_i ** 2 for _i, _j in zip(residuals, observations)
+                           if _j[6]) / max(1, sum(_j[6]
+                                                  for _j in observations)))
+    ct_rms = math.sqrt(sum(_i ** 2 for _i, _j in zip(residuals, observations)
+                           if not _j[6]) /
+                       max(1, sum(not _j[6] for _j in observations)))
+    write("  IT   EV  CT  CC    RMSCT    RMSCC   RMSST   DX   DY   DZ   DT"
+          "   OS  AQ  CND")
+    write("        %   %   %       ms       ms      ms    m    m    m   ms"
+          "    m")
+    iteration = 0
+    total = sum(iterations)
+    for set_iterations in iterations:
+        for _ in range(set_iterations):
+            iteration += 1
+            # Decrease the rms and the updates over the iterations.
+            factor = 1.0 - 0.5 * iteration / float(max(total, 1))
+            write("%4i %4i %3i %3i %8.0f %8.0f %7.0f %4i %4i %4i %4i %4i "
+                  "%3i %4i" % (iteration, 100, 100, 100,
+                               ct_rms * 1000 * factor,
+                               cc_rms * 1000 * factor,
+                               max(ct_rms, cc_rms) * 1000 * factor,
+                               int(10 / iteration), int(10 / iteration),
+                               int(20 / iteration), int(5 / iteration), 0, 0,
+                               10))
+
+    def location_line(_i, latitude, longitude, depth, cluster_id):
+        date, time = events[_i][0], events[_i][1].zfill(8)
+        counts = event_counts.get(_i, [0, 0, 0, 0, 0.0, 0.0])
+        if cluster_id in centroids:
+            centroid = centroids[cluster_id]
+        else:
+            centroid = (latitude, longitude, depth)
+        x = (longitude - centroid[1]) * DEG2KM * \
+            math.cos(math.radians(latitude)) * 1000.0
+        y = (latitude - centroid[0]) * DEG2KM * 1000.0
+        z = (depth - centroid[2]) * 1000.0
+        return RELOC_FORMAT % (
+            _i, latitude, longitude, depth, x, y, z, -999.0, -999.0, -999.0,
+            int(date[:4]), int(date[4:6]), int(date[6:8]), int(time[:2]),
+            int(time[2:4]), int(time[4:]) / 100.0, float(events[_i][5]),
+            counts[0], counts[1], counts[2], counts[3],
+            rms(counts, True), rms(counts, False), cluster_id)
+
+    with open(filenames["hypoDD.loc"], "w") as loc, \
+            open(filenames["hypoDD.reloc"], "w") as reloc:
+        for _i in sorted(events):
+            latitude, longitude, depth = map(float, events[_i][2:5])
+            loc.write(location_line(_i, latitude, longitude, depth, 0) +
+                      "\n")
+            if _i not in linked:
+                continue
+            centroid = centroids[cluster_ids[_i]]
+            latitude, longitude, depth = [
+                value + STANDIN_COLLAPSE * (center - value)
+                for value, center in zip((latitude, longitude, depth),
+                                         centroid)]
+            reloc.write(location_line(_i, latitude, longitude, depth,
+                                      cluster_ids[_i]) + "\n")
+
+    if linked:
+        center = np.mean([coordinates[_i] for _i in linked], axis=0)
+    else:
+        center = (0.0, 0.0, 0.0)
+    with open(filenames["hypoDD.sta"], "w") as open_file:
+        for station in sorted(stations):
+            latitude, longitude = stations[station]
+            dx = (longitude - center[1]) * DEG2KM * \
+                math.cos(math.radians(center[0]))
+            dy = (latitude - center[0]) * DEG2KM
+            counts = station_counts[station]
+            open_file.write(STA_FORMAT % (
+                station, latitude, longitude, math.sqrt(dx ** 2 + dy ** 2),
+                math.degrees(math.atan2(dx, dy)) % 360.0, counts[0],
+                counts[1], counts[2], counts[3], rms(counts, True),
+                rms(counts, False), 0) + "\n")
+
+    with open(filenames["hypoDD.res"], "w") as open_file:
+        open_file.write("STA           DT        C1        C2    IDX     "
+                        "QUAL    RES [ms]   WT         OFFS\n")
+        for observation, residual in zip(observations, residuals):
+            id1, id2, station, dt, weight, phase, is_cc = observation
+            index = (1 if is_cc else 3) + (phase == "S")
+            offset = math.sqrt(sum(
+                ((a - b) * DEG2KM) ** 2 for a, b in
+                zip(coordinates[id1][:2], coordinates[id2][:2])) +
+                (coordinates[id1][2] - coordinates[id2][2]) ** 2) * 1000.0
+            open_file.write(RES_FORMAT % (
+                station, dt * 1000.0, id1, id2, index, weight,
+                residual * 1000.0, weight, offset) + "\n")
+
+    with open(filenames["hypoDD.src"], "w") as open_file:
+        for _i in sorted(linked):
+            open_file.write("%9i %10.6f %11.6f %9.3f %3i\n" % (
+                (_i,) + coordinates[_i] + (cluster_ids[_i],)))
+
+    write("# relocated events = %i" % len(linked))
+    write("Done.")
+    log.close()
+    return 0
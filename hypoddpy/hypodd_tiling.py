@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Partitioning of very large catalogs into overlapping spatial tiles or time
+windows.
+
+HypoDD uses static arrays and ph2dt pairs events in O(N^2) so whole-region
+relocations of 100k+ events are not feasible. The catalog is therefore cut
+into tiles that are relocated independently:
+
+    * Every tile has a core region. The core regions of all tiles do not
+      overlap and together cover all events.
+    * Every tile additionally contains all events within a certain margin
+      around its core so events near the core boundaries still have all
+      their neighbours.
+    * The final solution of every event is taken from the tile in which it is
+      most central.
+
+Long catalogs can in the same way be cut into overlapping time windows.
+"""
+import math
+import os
+import traceback
+
+
+# Rough conversion factor from degree to km.
+DEG2KM = 111.0
+
+
+def estimate_hypodd_memory(MAXEVE, MAXDATA, MAXEVE0, MAXDATA0, MAXLAY=30,
+                           MAXSTA=2000, MAXCL=200):
+    """
+    Estimates the memory in bytes of the static arrays of a hypoDD binary
+    compiled with the given hypoDD.inc parameters.
+
+    This is an approximation derived from the array declarations in
+    hypoDD 2.1b. The largest contributors are the SVD design matrix
+    (MAXDATA0 x 4 * MAXEVE0) and roughly 50 arrays of length MAXDATA.
+    """
+    word = 4
+    # SVD design matrix, its copy and work arrays.
+    svd = 2 * MAXDATA0 * 4 * MAXEVE0 + 4 * MAXEVE0 * 4 * MAXEVE0
+    # All data arrays.
+    data = 50 * MAXDATA
+    # LSQR solver arrays and all per-event arrays.
+    events = 40 * MAXEVE
+    other = 20 * MAXSTA + 10 * MAXLAY + MAXCL * MAXEVE
+    return word * (svd + data + events + other)
+
+
+def estimate_tile_capacity(memory_budget, max_neighbours=10,
+                           max_observations=50):
+    """
+    Estimates the maximum number of events a single tile can hold so that
+    the hypoDD arrays fit into memory_budget bytes.
+
+    Every event is assumed to have max_neighbours neighbours with
+    max_observations catalog and max_observations cross correlation
+    observations each.
+
+    :param memory_budget: Available memory per tile in bytes.
+    :param max_neighbours: MAXNGH as used by ph2dt.
+    :param max_observations: MAXOBS as used by ph2dt.
+    """
+    data_per_event = 2 * max_neighbours * max_observations
+    # The memory estimate is linear in the number of events.
+    bytes_base = estimate_hypodd_memory(MAXEVE=0, MAXDATA=0, MAXEVE0=2,
+                                        MAXDATA0=1, MAXCL=0)
+    bytes_per_event = estimate_hypodd_memory(
+        MAXEVE=1, MAXDATA=data_per_event, MAXEVE0=2, MAXDATA0=1,
+        MAXCL=0) - bytes_base
+    capacity = int((memory_budget - bytes_base) // bytes_per_event)
+    if capacity < 2:
+        msg = "A memory budget of %i bytes is too small for a single tile."
+        raise ValueError(msg % memory_budget)
+    return capacity
+
+
+def _events_in_region(events, region):
+    """
+    Returns all events within region = (min_lat, max_lat, min_lon, max_lon).
+    """
+    min_lat, max_lat, min_lon, max_lon = region
+    return [event for event in events
+            if min_lat <= event["origin_latitude"] <= max_lat and
+            min_lon <= event["origin_longitude"] <= max_lon]
+
+
+def _extend_region(region, margin):
+    """
+    Extends a region on all sides by margin km.
+    """
+    min_lat, max_lat, min_lon, max_lon = region
+    d_lat = margin / DEG2KM
+    center_lat = (min_lat + max_lat) / 2.0
+    d_lon = margin / (DEG2KM * max(math.cos(math.radians(center_lat)), 0.01))
+    return (min_lat - d_lat, max_lat + d_lat, min_lon - d_lon, max_lon + d_lon)
+
+
+def partition_events_into_tiles(events, max_events_per_tile, overlap):
+    """
+    Partitions events into overlapping spatial tiles.
+
+    The catalog is recursively bisected at the median along the longer
+    horizontal axis until every tile, including its overlap margin, holds at
+    most max_events_per_tile events.
+
+    Returns a list of dictionaries, one per tile, with the keys "core" and
+    "region", both (min_lat, max_lat, min_lon, max_lon) tuples, and "events",
+    the list of events in the extended region.
+
+    :param events: List of event dictionaries as in HypoDDRelocator.events.
+    :param max_events_per_tile: Maximum number of events in a tile.
+    :param overlap: Width of the overlap margin around each tile core in km.
+    """
+    if not events:
+        return []
+    lats = [event["origin_latitude"] for event in events]
+    lons = [event["origin_longitude"] for event in events]
+    full_core = (min(lats), max(lats), min(lons), max(lons))
+
+    tiles = []
+    # Work queue of (core region, events in the core).
+    queue = [(full_core, events)]
+    while queue:
+        core, core_events = queue.pop()
+        region = _extend_region(core, overlap)
+        tile_events = _events_in_region(events, region)
+        if len(tile_events) <= max_events_per_tile or len(core_events) < 2:
+            tiles.append({"core": core, "region": region,
+                          "events": tile_events})
+            continue
+        min_lat, max_lat, min_lon, max_lon = core
+        center_lat = (min_lat + max_lat) / 2.0
+        lat_extent = (max_lat - min_lat) * DEG2KM
+        lon_extent = (max_lon - min_lon) * DEG2KM * \
+            math.cos(math.radians(center_lat))
+        if lat_extent >= lon_extent:
+            key = "origin_latitude"
+        else:
+            key = "origin_longitude"
+        values = sorted(event[key] for event in core_events)
+        median = values[len(values) // 2]
+        lower = [event for event in core_events if event[key] < median]
+        upper = [event for event in core_events if event[key] >= median]
+        # Many events at the exact same coordinate cannot be split any
+        # further.
+        if not lower or not upper:
+            tiles.append({"core": core, "region": region,
+                          "events": tile_events})
+            continue
+        if key == "origin_latitude":
+            lower_core = (min_lat, median, min_lon, max_lon)
+            upper_core = (median, max_lat, min_lon, max_lon)
+        else:
+            lower_core = (min_lat, max_lat, min_lon, median)
+            upper_core = (min_lat, max_lat, median, max_lon)
+        queue.append((upper_core, upper))
+        queue.append((lower_core, lower))
+    return tiles
+
+
+def tile_centrality(tile, latitude, longitude):
+    """
+    Returns the normalized distance of a location to the center of the tile's
+    core. 0 is the center, 1 the boundary of the core and everything above
+    lies in the overlap margin. Smaller values are more central.
+    """
+    min_lat, max_lat, min_lon, max_lon = tile["core"]
+    half_lat = max((max_lat - min_lat) / 2.0, 1E-9)
+    half_lon = max((max_lon - min_lon) / 2.0, 1E-9)
+    return max(abs(latitude - (min_lat + max_lat) / 2.0) / half_lat,
+               abs(longitude - (min_lon + max_lon) / 2.0) / half_lon)
+
+
+def partition_events_into_time_windows(events, window_length, overlap):
+    """
+    Partitions events into overlapping time windows.
+
+    Returns a list of dictionaries, one per window containing at least two
+    events, with the keys "starttime", "endtime" and "events".
+
+    :param events: List of event dictionaries as in HypoDDRelocator.events.
+    :param window_length: Length of each window in seconds.
+    :param overlap: Overlap of neighbouring windows in seconds.
+    """
+    if not events:
+        return []
+    events = sorted(events, key=lambda event: event["origin_time"])
+    first_time = events[0]["origin_time"]
+    last_time = events[-1]["origin_time"]
+    step = window_length - overlap
+    windows = []
+    starttime = first_time
+    first_index = 0
+    while True:
+        endtime = starttime + window_length
+        # Events are sorted so the window start only moves forward.
+        while first_index < len(events) and \
+                events[first_index]["origin_time"] < starttime:
+            first_index += 1
+        window_events = []
+        for event in events[first_index:]:
+            if event["origin_time"] > endtime:
+                break
+            window_events.append(event)
+        if len(window_events) >= 2:
+            windows.append({"starttime": starttime, "endtime": endtime,
+                            "events": window_events})
+        if endtime >= last_time:
+            break
+        starttime += step
+    return windows
+
+
+def time_window_centrality(window, time):
+    """
+    Returns the normalized distance of a time to the center of the window. 0
+    is the center and 1 the beginning or end of the window. Smaller values are
+    more central.
+    """
+    half_length = (window["endtime"] - window["starttime"]) / 2.0
+    center = window["starttime"] + half_length
+    return abs(time - center) / max(half_length, 1E-9)
+
+
+def _relocate_tile(spec):
+    """
+    Relocates a single tile or time window. Module level function so it can
+    be used with a multiprocessing pool.
+
+    Returns a list of (event_id, hypoDD.reloc line) tuples.
+    """
+    # Imported here to avoid a circular import.
+    from hypodd_relocator import HypoDDRelocator
+
+    relocator = HypoDDRelocator(working_dir=spec["working_dir"],
+                                **spec["cc_param"])
+    relocator.forced_configuration_values.update(
+        spec["forced_configuration_values"])
+    relocator.forward_model_string = spec["forward_model_string"]
+    relocator.external_binaries = spec.get("external_binaries", {})
+    relocator.binary_cache_dir = spec.get("binary_cache_dir")
+    relocator.pick_quality_param = spec.get("pick_quality_param")
+    for filename in spec.get("cc_results_files", []):
+        if os.path.exists(filename):
+            relocator.load_cross_correlation_results(filename)
+    relocator._relocate_subset(
+        output_cross_correlation_file=spec["output_cross_correlation_file"])
+
+    reloc_file = os.path.join(relocator.paths["output_files"],
+                              "hypoDD.reloc")
+    results = []
+    with open(reloc_file, "r") as open_file:
+        for line in open_file:
+            line = line.strip()
+            if not line:
+                continue
+            hypodd_id = int(line.split()[0])
+            results.append((relocator.event_map[hypodd_id], line))
+    return results
+
+
+def _try_relocate_tile(spec):
+    """
+    Calls _relocate_tile() and returns a (results, error) tuple so a failing
+    tile does not abort the relocation of all other tiles. error is None on
+    success and the formatted traceback otherwise.
+    """
+    try:
+        return _relocate_tile(spec), None
+    except Exception:
+        return None, traceback.format_exc()
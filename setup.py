@@ -38,7 +38,10 @@ URL = 'None so far...'
 LICENSE = 'GNU General Public License, version 3 (GPLv3)'
 KEYWORDS = ['seismology', 'earthquakes', 'relocation']
 INSTALL_REQUIRES = ['obspy', 'progressbar']
-ENTRY_POINTS = {}
+ENTRY_POINTS = {
+    'console_scripts': [
+        'hypoddpy-batch = hypoddpy.batch:main',
+    ]}
 
 
 def getVersion():
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the batch runner in hypoddpy.batch.
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from hypoddpy.batch import read_config, run_batch, \
+    write_waveform_information
+from hypoddpy.hypodd_synthetic import generate_dataset, \
+    write_standin_binaries
+
+
+RELOCATOR = {
+    "cc_time_before": 0.05,
+    "cc_time_after": 0.2,
+    "cc_maxlag": 0.1,
+    "cc_filter_min_freq": 1.0,
+    "cc_filter_max_freq": 15.0,
+    "cc_p_phase_weighting": {"Z": 1.0},
+    "cc_s_phase_weighting": {"Z": 1.0},
+    "cc_min_allowed_cross_corr_coeff": 0.6}
+
+
+class ReadConfigTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, "data"))
+        for name in ["b.xml", "a.xml", "c.mseed"]:
+            open(os.path.join(self.directory, "data", name), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write_config(self, config):
+        filename = os.path.join(self.directory, "batch.json")
+        with open(filename, "w") as open_file:
+            json.dump(config, open_file)
+        return filename
+
+    def test_defaults_paths_and_patterns(self):
+        config = read_config(self._write_config({
+            "max_concurrent_projects": 2,
+            "defaults": {
+                "relocator": RELOCATOR,
+                "forced_configuration_values": {"MAXSEP": 5.0},
+                "relocation": {"create_plots": False}},
+            "projects": [
+                {"name": "north",
+                 "output_event_file": "north/relocated.xml",
+                 "event_files": ["data/*.xml"],
+                 "waveform_files": ["data/c.mseed"],
+                 "relocator": {"cc_maxlag": 0.2},
+                 "forced_configuration_values": {"MAXDIST": 100}},
+                {"name": "south",
+                 "working_dir": "work/south",
+                 "output_event_file": "south.xml",
+                 "method": "start_tiled_relocation"}]}))
+        self.assertEqual(config["max_concurrent_projects"], 2)
+        self.assertEqual(config["cache_dir"], os.path.join(
+            self.directory, "hypoddpy_batch_cache"))
+        north, south = config["projects"]
+        data_dir = os.path.join(self.directory, "data")
+        self.assertEqual(north["event_files"], [
+            os.path.join(data_dir, "a.xml"), os.path.join(data_dir, "b.xml")])
+        self.assertEqual(north["waveform_files"],
+                         [os.path.join(data_dir, "c.mseed")])
+        self.assertEqual(north["station_files"], [])
+        self.assertEqual(north["working_dir"],
+                         os.path.join(self.directory, "north"))
+        self.assertEqual(north["output_event_file"],
+                         os.path.join(self.directory, "north",
+                                      "relocated.xml"))
+        self.assertEqual(north["method"], "start_relocation")
+        # Projects override the defaults key by key.
+        self.assertEqual(north["relocator"]["cc_maxlag"], 0.2)
+        self.assertEqual(north["relocator"]["cc_time_before"], 0.05)
+        self.assertEqual(north["forced_configuration_values"],
+                         {"MAXSEP": 5.0, "MAXDIST": 100})
+        self.assertEqual(south["relocator"], RELOCATOR)
+        self.assertEqual(south["relocation"], {"create_plots": False})
+        self.assertEqual(south["working_dir"],
+                         os.path.join(self.directory, "work", "south"))
+        self.assertEqual(south["method"], "start_tiled_relocation")
+
+    def test_invalid_projects(self):
+        for projects in [
+                [{"output_event_file": "a.xml"}],
+                [{"name": "a", "output_event_file": "a.xml"},
+                 {"name": "a", "output_event_file": "b.xml"}],
+                [{"name": "a", "output_event_file": "a.xml",
+                  "method": "start_unknown_relocation"}]]:
+            filename = self._write_config({"projects": projects})
+            self.assertRaises(ValueError, read_config, filename)
+
+
+class WaveformInformationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_rewritten_when_the_index_changes(self):
+        index = {
+            "a.mseed": {"traces": [["SY.A..HHZ", "2020-01-01T00:00:00",
+                                    "2020-01-01T01:00:00"]]},
+            "b.mseed": {"traces": [["SY.A..HHZ", "2020-01-01T01:00:00",
+                                    "2020-01-01T02:00:00"]]}}
+        filename = os.path.join(self.directory, "working_files",
+                                "waveform_information.json")
+        self.assertTrue(write_waveform_information(index, ["a.mseed"],
+                                                   self.directory))
+        self.assertFalse(write_waveform_information(index, ["a.mseed"],
+                                                    self.directory))
+        # A file added to the index by the next run has to show up.
+        self.assertTrue(write_waveform_information(
+            index, ["a.mseed", "b.mseed"], self.directory))
+        with open(filename, "r") as open_file:
+            waveform_information = json.load(open_file)
+        self.assertEqual(
+            [_i["filename"] for _i in waveform_information["SY.A..HHZ"]],
+            ["a.mseed", "b.mseed"])
+
+
+class RunBatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_run_batch(self):
+        dataset = generate_dataset(
+            os.path.join(self.directory, "data"), 12, station_count=4,
+            family_size=6, sampling_rate=50.0)
+        hypodd_binary, ph2dt_binary = write_standin_binaries(
+            os.path.join(self.directory, "bin"))
+        project = {
+            "event_files": dataset["event_files"],
+            "station_files": dataset["station_files"],
+            "waveform_files": dataset["waveform_files"],
+            "external_binaries": {"hypodd_binary": hypodd_binary,
+                                  "ph2dt_binary": ph2dt_binary}}
+        config_file = os.path.join(self.directory, "batch.json")
+        with open(config_file, "w") as open_file:
+            json.dump({
+                "max_concurrent_projects": 2,
+                "cache_dir": "cache",
+                "defaults": {
+                    "relocator": RELOCATOR,
+                    "velocity_model": dataset["velocity_model"],
+                    "forced_configuration_values": {"MAXSEP": 5.0},
+                    "relocation": {"create_plots": False}},
+                "projects": [
+                    dict(project, name="first",
+                         output_event_file="first.xml"),
+                    dict(project, name="second",
+                         output_event_file="second.xml")]}, open_file)
+        config = read_config(config_file)
+
+        results = run_batch(config)
+        self.assertEqual(sorted(results), ["first", "second"])
+        for name in ["first", "second"]:
+            self.assertEqual(results[name]["status"], "ok")
+            self.assertTrue(os.path.exists(os.path.join(
+                self.directory, "%s.xml" % name)))
+        cache_dir = os.path.join(self.directory, "cache")
+        with open(os.path.join(cache_dir, "waveform_index.json"), "r") as \
+                open_file:
+            self.assertEqual(sorted(json.load(open_file)),
+                             sorted(dataset["waveform_files"]))
+        self.assertTrue(os.path.exists(os.path.join(
+            cache_dir, "station_file_cache.json")))
+
+        # Only the selected project runs again. It would skip the relocation
+        # as its output file exists.
+        results = run_batch(config, project_names=["second"])
+        self.assertEqual(list(results), ["second"])
+        self.assertRaises(ValueError, run_batch, config,
+                          project_names=["third"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Import time budget of the hypoddpy package.
+
+The heavy dependencies are only imported by the stages using them, see the
+HypoDDRelocator methods, so importing the package has to stay cheap.
+"""
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+
+# Maximum time in seconds to import the package in a fresh interpreter.
+IMPORT_TIME_BUDGET = 0.5
+
+# Modules that must not be loaded by importing the package.
+LAZY_MODULES = ["obspy", "progressbar"]
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_SCRIPT = """
+import json
+import sys
+import time
+start = time.time()
+import hypoddpy
+elapsed = time.time() - start
+print(json.dumps({"elapsed": elapsed, "modules": sorted(sys.modules)}))
+"""
+
+
+class ImportTimeTestCase(unittest.TestCase):
+    def _import_package(self):
+        """
+        Imports hypoddpy in a fresh interpreter and returns the import time
+        and the names of all loaded modules.
+        """
+        output = subprocess.check_output([sys.executable, "-c",
+                                          IMPORT_SCRIPT], cwd=REPOSITORY)
+        result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+        return result["elapsed"], set(result["modules"])
+
+    def test_import_time_budget(self):
+        elapsed, _ = self._import_package()
+        self.assertLess(elapsed, IMPORT_TIME_BUDGET)
+
+    def test_no_heavy_imports(self):
+        _, modules = self._import_package()
+        for name in LAZY_MODULES:
+            loaded = [_i for _i in modules
+                      if _i == name or _i.startswith(name + ".")]
+            self.assertEqual(loaded, [], "%s is imported eagerly." % name)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the sharded cross correlation, see hypoddpy.hypodd_sharding.
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from hypoddpy import hypodd_relocator
+from hypoddpy.hypodd_relocator import HypoDDException
+from hypoddpy.hypodd_sharding import merge_shards, shard_range
+from hypoddpy.hypodd_synthetic import create_synthetic_relocator, \
+    generate_dataset
+
+
+class ShardRangeTestCase(unittest.TestCase):
+    def test_shards_cover_all_pairs_once(self):
+        for pair_count in [0, 1, 7, 100, 1001]:
+            for shard_count in [1, 2, 3, 8]:
+                ranges = [shard_range(pair_count, _i, shard_count)
+                          for _i in range(shard_count)]
+                self.assertEqual(ranges[0][0], 0)
+                self.assertEqual(ranges[-1][1], pair_count)
+                for (_, stop), (start, _) in zip(ranges, ranges[1:]):
+                    self.assertEqual(stop, start)
+                sizes = [stop - start for start, stop in ranges]
+                self.assertTrue(max(sizes) - min(sizes) <= 1)
+                # Every invocation selects the same pairs.
+                self.assertEqual(ranges, [shard_range(pair_count, _i,
+                                                      shard_count)
+                                          for _i in range(shard_count)])
+
+    def test_invalid_shard_index(self):
+        self.assertRaises(ValueError, shard_range, 10, 3, 3)
+        self.assertRaises(ValueError, shard_range, 10, -1, 3)
+
+
+class MergeShardsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.dt_cc = os.path.join(self.directory, "dt.cc")
+        self.results_file = os.path.join(self.directory, "cc_results.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _write_shard(self, name, dt_cc, results):
+        shard_dir = os.path.join(self.directory, name)
+        os.makedirs(shard_dir)
+        with open(os.path.join(shard_dir, "dt.cc"), "w") as open_file:
+            open_file.write(dt_cc)
+        with open(os.path.join(shard_dir, "cc_results.jsonl"), "w") as \
+                open_file:
+            for result in results:
+                open_file.write(json.dumps(result) + "\n")
+        return shard_dir
+
+    def _read_results(self):
+        with open(self.results_file, "r") as open_file:
+            return [json.loads(_i) for _i in open_file]
+
+    def test_merge(self):
+        with open(self.results_file, "w") as open_file:
+            open_file.write(json.dumps(["a", "b", [0.1, 0.9]]) + "\n")
+        shards = [
+            self._write_shard("shard_0", "# 1 2 0.0\nST 0.1 0.9 P\n", [
+                ["c", "d", [0.2, 0.8]], ["a", "b", [0.1, 0.9]]]),
+            self._write_shard("shard_1", "# 1 3 0.0\nST 0.3 0.7 P\n", [
+                # The same result with the picks in the other order.
+                ["d", "c", [-0.2, 0.8]], ["e", "f", None]])]
+        # A run size of 1 spills every result to its own run.
+        self.assertEqual(merge_shards(shards, self.dt_cc, self.results_file,
+                                      run_size=1), [])
+        with open(self.dt_cc, "r") as open_file:
+            self.assertEqual(open_file.read(), "# 1 2 0.0\nST 0.1 0.9 P\n"
+                             "# 1 3 0.0\nST 0.3 0.7 P\n")
+        self.assertEqual(self._read_results(), [
+            ["a", "b", [0.1, 0.9]], ["c", "d", [0.2, 0.8]],
+            ["e", "f", None]])
+        self.assertFalse(os.path.exists(self.results_file + ".merge"))
+
+    def test_conflict(self):
+        shards = [
+            self._write_shard("shard_0", "# 1 2 0.0\n", [
+                ["a", "b", [0.1, 0.9]], ["c", "d", [0.2, 0.8]]]),
+            self._write_shard("shard_1", "# 1 3 0.0\n", [
+                ["b", "a", [-0.1, 0.9]], ["c", "d", [0.25, 0.8]]])]
+        conflicts = merge_shards(shards, self.dt_cc, self.results_file,
+                                 run_size=1)
+        self.assertEqual(conflicts, [("c", "d", [0.2, 0.8], [0.25, 0.8])])
+        # Nothing is written.
+        self.assertFalse(os.path.exists(self.dt_cc))
+        self.assertFalse(os.path.exists(self.results_file))
+
+
+class LocalShardsTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.mkdtemp()
+        cls.dataset = generate_dataset(
+            os.path.join(cls.directory, "data"), 12, station_count=4,
+            family_size=6, sampling_rate=50.0, file_length=600.0)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory)
+
+    def _relocator(self, name):
+        relocator = create_synthetic_relocator(
+            self.dataset, os.path.join(self.directory, name))
+        relocator.log = lambda *args, **kwargs: None
+        relocator.set_forced_configuration_value("MAXSEP", 5.0)
+        return relocator
+
+    def _read(self, relocator, *path):
+        with open(os.path.join(relocator.working_dir, *path), "r") as \
+                open_file:
+            return open_file.read()
+
+    def _read_results(self, relocator):
+        return sorted(tuple(json.loads(_i)[:2]) for _i in self._read(
+            relocator, "working_files", "cc_results.jsonl").splitlines())
+
+    def test_sharded_dt_cc_is_identical(self):
+        unsharded = self._relocator("unsharded")
+        unsharded.prepare_cross_correlation()
+        unsharded._cross_correlate_picks()
+        sharded = self._relocator("sharded")
+        sharded.cross_correlate_shards_locally(3, processes=2)
+
+        dt_cc = self._read(unsharded, "input_files", "dt.cc")
+        self.assertTrue(dt_cc.strip())
+        self.assertEqual(self._read(sharded, "input_files", "dt.cc"), dt_cc)
+        self.assertEqual(self._read_results(sharded),
+                         self._read_results(unsharded))
+
+    def test_in_memory_streams(self):
+        from obspy import read
+
+        on_disk = self._relocator("on_disk")
+        on_disk.cross_correlate_shards_locally(2, processes=2)
+        in_memory = self._relocator("in_memory")
+        in_memory.waveform_files = []
+        in_memory.add_streams([read(_i) for _i in
+                               self.dataset["waveform_files"]])
+        in_memory.cross_correlate_shards_locally(2, processes=2)
+
+        dt_cc = self._read(on_disk, "input_files", "dt.cc")
+        self.assertTrue(dt_cc.strip())
+        self.assertEqual(self._read(in_memory, "input_files", "dt.cc"), dt_cc)
+        # The streams are only handed to the workers while they run.
+        self.assertEqual(hypodd_relocator._INHERITED_MEMORY_STREAMS, {})
+
+    def test_conflicting_shards(self):
+        relocator = self._relocator("conflict")
+        relocator.cross_correlate_shards_locally(2, processes=2)
+        # Let one shard disagree with the other one about a pick pair and
+        # merge again.
+        shard_dirs = [os.path.join(relocator.paths["working_files"],
+                                   "cc_shards", "shard_%04i_of_0002" % _i)
+                      for _i in range(2)]
+        shard_results = []
+        for shard_dir in shard_dirs:
+            with open(os.path.join(shard_dir, "cc_results.jsonl"), "r") as \
+                    open_file:
+                shard_results.append(open_file.readlines())
+        source = 0 if shard_results[0] else 1
+        pick_id_1, pick_id_2, result = json.loads(shard_results[source][0])
+        with open(os.path.join(shard_dirs[1 - source], "cc_results.jsonl"),
+                  "a") as open_file:
+            open_file.write(json.dumps(
+                [pick_id_1, pick_id_2, [1.0, 1.0]]) + "\n")
+        os.remove(os.path.join(relocator.paths["input_files"], "dt.cc"))
+        os.remove(os.path.join(relocator.paths["working_files"],
+                               "cc_results.jsonl"))
+        self.assertRaises(HypoDDException,
+                          relocator.merge_cross_correlation_shards, 2)
+        self.assertFalse(os.path.exists(os.path.join(
+            relocator.paths["input_files"], "dt.cc")))
+
+    def test_time_budget_per_shard(self):
+        relocator = self._relocator("budget")
+        relocator.cc_time_budget = 3600.0
+        relocator.cross_correlate_shards_locally(2, processes=2)
+        for _i in range(2):
+            coverage_file = os.path.join(
+                relocator.paths["working_files"], "cc_shards",
+                "shard_%04i_of_0002" % _i, "cc_coverage.json")
+            with open(coverage_file, "r") as open_file:
+                coverage = json.load(open_file)
+            self.assertEqual(coverage["time_budget"], 3600.0)
+            self.assertFalse(coverage["budget_exhausted"])
+
+
+if __name__ == "__main__":
+    unittest.main()
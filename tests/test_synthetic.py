@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests of the synthetic data sets and the stand-in executables, see
+hypoddpy.hypodd_synthetic.
+"""
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from hypoddpy.hypodd_synthetic import create_synthetic_relocator, \
+    generate_dataset
+
+
+class SyntheticRelocationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_start_relocation(self):
+        from obspy import read_events
+
+        dataset = generate_dataset(
+            os.path.join(self.directory, "data"), 12, station_count=4,
+            family_size=6, sampling_rate=50.0, file_length=600.0)
+        working_dir = os.path.join(self.directory, "working_dir")
+        relocator = create_synthetic_relocator(dataset, working_dir)
+        relocator.log = lambda *args, **kwargs: None
+        relocator.set_forced_configuration_value("MAXSEP", 5.0)
+        output_event_file = os.path.join(self.directory, "relocated.xml")
+        relocator.start_relocation(output_event_file, create_plots=False)
+
+        # The stations are parsed from the StationXML file.
+        self.assertEqual(relocator.stations, dataset["stations"])
+        with open(os.path.join(working_dir, "input_files", "dt.cc"), "r") \
+                as open_file:
+            self.assertTrue(open_file.read().strip())
+        with open(os.path.join(working_dir, "run_report.json"), "r") as \
+                open_file:
+            report = json.load(open_file)
+        self.assertEqual(
+            [_i["name"] for _i in report["stages"]
+             if _i["status"] != "ok"], [])
+        catalog = read_events(output_event_file)
+        self.assertEqual(len(catalog), 12)
+        # The relocated origins are appended to the events.
+        self.assertTrue(any(str(origin.method_id).endswith("HypoDD")
+                            for event in catalog for origin in event.origins))
+
+
+if __name__ == "__main__":
+    unittest.main()